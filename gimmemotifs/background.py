@@ -19,20 +19,30 @@ import os
 import random
 import re
 import sys
+from itertools import product
+import multiprocessing as mp
 from tempfile import NamedTemporaryFile
-from random import choice
 
 # External imports
 import numpy as np
 import pybedtools
+import xxhash
+from diskcache import Cache
 from genomepy import Genome
 
 # GimmeMotifs imports
 from gimmemotifs import mytmpdir
-from gimmemotifs.fasta import Fasta
+from gimmemotifs.config import MotifConfig, CACHE_DIR
+from gimmemotifs.fasta import Fasta, iter_fasta
+from gimmemotifs.genome_index import (GenomeIndex, get_random_sequences, 
+        sample_regions, find_n_runs)
+from gimmemotifs.utils import ChunkedGenome, region_sequences
 
 def create_random_genomic_bedfile(out, genome, length, n):
-    features = Genome(genome).get_random_sequences(n, length)
+    if isinstance(genome, GenomeIndex):
+        features = get_random_sequences(genome.index_dir, n, length)
+    else:
+        features = Genome(genome).get_random_sequences(n, length)
 
     # Write result to bedfile
     tmp = open(out, "w")
@@ -72,6 +82,45 @@ def create_promoter_bedfile(out, genefile, length, n):
         tmp.write("%s\t%s\t%s\t0\t0\t%s\n" % (chrom, start, end, {True:"+",False:"-"}[strand]))
     tmp.flush()
 
+def track_sequences(bedfile, genome_index):
+    """Return the sequences of the regions in a BED file.
+
+    The sequences are retrieved from a GenomeIndex in one batch, on the 
+    strand of the region if the BED file has a strand column.
+
+    Parameters
+    ----------
+    bedfile : str
+        Name of the BED file.
+
+    genome_index : GenomeIndex
+        Indexed genome.
+
+    Returns
+    -------
+    ids : list
+        Region ids in chrom:start-end format.
+
+    seqs : list
+        Sequences.
+    """
+    regions = []
+    with open(bedfile) as f:
+        for line in f:
+            vals = line.rstrip("\n").split("\t")
+            strand = vals[5] if len(vals) > 5 else "+"
+            regions.append((vals[0], int(vals[1]), int(vals[2]), strand))
+    
+    ids = ["{}:{}-{}".format(chrom, start, end) 
+            for chrom, start, end, _ in regions]
+    return ids, genome_index.get_region_sequences(regions)
+
+# Number of sequences that MarkovFasta generates at a time
+MARKOV_BATCH_SIZE = 10000
+
+# Number of sequence positions of which the k-mers are counted at a time
+KMER_CHUNK_SIZE = 2 ** 24
+
 class MarkovFasta(Fasta):
     """ 
     Generates a new Fasta object containing sequences using a 1st order Markov
@@ -83,6 +132,11 @@ class MarkovFasta(Fasta):
     Optional arg 'n' specifies the number of sequences to generate
     Optional arg 'k' specifies the order of the Markov model, default is 1 for 1st
     order
+    Optional arg 'seed' makes the sequences reproducible, independent of 
+    'ncpus', the number of processes that generate the sequences
+
+    The k-mer counts of the model are cached, based on a checksum of the 
+    input sequences and k, and are reused for the same input.
 
     Returns a Fasta object
     
@@ -95,7 +149,8 @@ class MarkovFasta(Fasta):
     
     """
     
-    def __init__(self, fasta, length=None, n=None, k=1, matrix_only=False):
+    def __init__(self, fasta, length=None, n=None, k=1, matrix_only=False,
+            seed=None, ncpus=None):
         self.k = k
 
         # Initialize super Fasta object
@@ -107,84 +162,194 @@ class MarkovFasta(Fasta):
         if matrix_only:
             return
         
-        c = 0
         if not n:
             n = len(fasta)
-
-        while len(self) < n:
-            seq = choice(fasta.seqs)
-            name = "random_Markov%s_%s" % (k,c)
-            if length:
-                random_seq = self._generate_sequence(length)
-            else:
-                random_seq = self._generate_sequence(len(seq))
-            self.add(name, random_seq)    
-            c += 1
+        if seed is None:
+            seed = random.randint(0, 2**32 - 1)
+        if ncpus is None:
+            ncpus = int(MotifConfig().get_default_params()["ncpus"])
+        
+        # The lengths of the sequences and the seeds of the batches are all
+        # drawn with the same seed, so the sequences do not depend on how 
+        # the batches are divided over processes.
+        rng = np.random.RandomState(seed)
+        if length:
+            lengths = np.full(n, length, dtype=int)
+        else:
+            lengths = rng.choice([len(seq) for seq in fasta.seqs], n)
+        batches = [lengths[i:i + MARKOV_BATCH_SIZE] 
+                for i in range(0, n, MARKOV_BATCH_SIZE)]
+        seeds = rng.randint(0, 2**31 - 1, len(batches))
+        jobs = [(self.trans_cum, self.init_cum, self.alphabet, batch, 
+            batch_seed) for batch, batch_seed in zip(batches, seeds)]
+        
+        # daemonic processes, such as the workers of a Scanner, can not 
+        # start a pool
+        if ncpus > 1 and len(jobs) > 1 and not mp.current_process().daemon:
+            try:
+                ctx = mp.get_context('spawn')
+                pool = ctx.Pool(processes=min(ncpus, len(jobs)))
+            except AttributeError:
+                pool = mp.Pool(processes=min(ncpus, len(jobs)))
+            results = pool.map(_markov_sequences, jobs)
+            pool.close()
+            pool.join()
+        else:
+            results = [_markov_sequences(job) for job in jobs]
+        
+        c = 0
+        for random_seqs in results:
+            for random_seq in random_seqs:
+                self.add("random_Markov%s_%s" % (k, c), random_seq)
+                c += 1
 
     def _initialize_matrices(self, seqs, k=1, alphabet=None):
         if alphabet is None:
             alphabet = ['A','C','G','T']
 
         self.frequencies = {}
-        kmercount = {}
         
-        init = alphabet[:]
-        for i in range(k - 1):
-            new_init = []
-            for x in init:
-                for l in alphabet:
-                    new_init.append(x + l)
-            init = new_init[:]
-
-        self.trans = dict([(word, dict([(l, 0.0) for l in alphabet])) for word in init])
-        new_init = []
-        for x in init:
-            for l in alphabet:
-                new_init.append(x + l)
+        # all k-mers, in the order of the rows of the transition matrix
+        init = ["".join(x) for x in product(alphabet, repeat=k)]
         
-        kmercount = dict([(word, 0) for word in new_init])
-        lettercount =  dict([(word[:k], 0) for word in new_init])
-        p = re.compile("^[%s]+$" % "".join(alphabet))
-        total = 0
+        h = xxhash.xxh64()
         for seq in seqs:
-            seq = seq.upper()
-            for i in range(len(seq) - k):
-                if p.search(seq[i:i + k + 1]):
-                    lettercount[seq[i:i + k]] += 1
-                    kmercount[seq[i:i + k + 1]] += 1
-                    total += 1
+            h.update(seq.encode())
+            h.update(b"\n")
+        key = "{}|{}|{}|markov".format(h.hexdigest(), k, "".join(alphabet))
+        with Cache(CACHE_DIR) as cache:
+            counts = cache.get(key)
+            if counts is None:
+                counts = count_kmers(seqs, k + 1, alphabet).reshape(
+                        len(init), len(alphabet))
+                cache.set(key, counts)
+        
+        self._set_matrices(counts.astype(float), init, alphabet)
+
+    def _set_matrices(self, counts, init, alphabet):
+        """Set the transition and initial probabilities based on a 
+        4^k x 4 matrix of (k+1)-mer counts. Unobserved k-mers are followed 
+        by all nucleotides with equal probability."""
+        totals = counts.sum(1)
+        trans = np.full(counts.shape, 1.0 / len(alphabet))
+        observed = totals > 0
+        trans[observed] = counts[observed] / totals[observed][:, None]
         
-        for k,v in kmercount.items():
-            self.trans[k[:-1]][k[-1]] = float(v)
+        if totals.sum() > 0:
+            start = totals / totals.sum()
+        else:
+            start = np.full(len(init), 1.0 / len(init))
         
-        for k,v in self.trans.items():
-            s = np.sum(np.array(list(v.values())))
-            for x,y in v.items():
-                v[x] = y / s
+        self.trans = dict((word, dict(zip(alphabet, row))) 
+                for word, row in zip(init, trans))
+        self.init = dict(zip(init, start))
         
-        self.init = {}
-        total = float(np.sum(np.array(list(lettercount.values()))))
-        for k,v in lettercount.items():
-            self.init[k] = v / total
-            
+        # Cumulative probabilities, as used by _markov_sequences(). Rows 
+        # are k-mers, with the letters of the alphabet as digits.
+        self.alphabet = alphabet
+        self.trans_cum = np.cumsum(trans, 1)
+        self.init_cum = np.cumsum(start)
+
     def _generate_sequence(self, l):
-        sequence = list(self._weighted_random(list(self.init.items())))
-        for _ in range(l - self.k):
-            sequence.append(
-                    self._weighted_random(
-                        list(self.trans["".join(sequence[-self.k:])].items())
-                        ))
-        return "".join(sequence)
-
-    def _weighted_random(self, l):
-        n = random.uniform(0,1)
-        item = None
-        for item, weight in l:
-            if n < weight:
-                break    
-            else:
-                n -= weight
-        return item
+        return _markov_sequences((self.trans_cum, self.init_cum, 
+            self.alphabet, [l], random.randint(0, 2**31 - 1)))[0]
+
+def count_kmers(seqs, k, alphabet=None):
+    """Count the k-mers in sequences.
+
+    Sequences are encoded as integers and all k-mers are counted with 
+    NumPy. Upper- and lowercase letters are counted the same, k-mers with
+    other letters than the alphabet, such as N, are skipped.
+
+    Parameters
+    ----------
+    seqs : iterable
+        Sequences.
+
+    k : int
+        Length of the k-mers.
+
+    alphabet : list, optional
+        Letters of the alphabet, by default A, C, G and T.
+
+    Returns
+    -------
+    counts : numpy.ndarray
+        Count of every k-mer. The k-mers are ordered with the letters of 
+        the alphabet as digits, so AA..A first and TT..T last.
+    """
+    if alphabet is None:
+        alphabet = ['A','C','G','T']
+    n_letters = len(alphabet)
+    
+    # all other letters are encoded as n_letters
+    table = np.full(256, n_letters, dtype=np.int64)
+    for i, l in enumerate(alphabet):
+        table[ord(l.upper())] = i
+        table[ord(l.lower())] = i
+    
+    counts = np.zeros(n_letters ** k, dtype=np.int64)
+    chunk = []
+    size = 0
+    for seq in seqs:
+        chunk.append(seq)
+        size += len(seq) + 1
+        if size >= KMER_CHUNK_SIZE:
+            counts += _count_kmer_chunk(chunk, k, table, n_letters)
+            chunk = []
+            size = 0
+    if len(chunk) > 0:
+        counts += _count_kmer_chunk(chunk, k, table, n_letters)
+    
+    return counts
+
+def _count_kmer_chunk(seqs, k, table, n_letters):
+    # sequences are separated by a newline, which is not in the alphabet,
+    # so no k-mers span two sequences
+    codes = table[np.frombuffer("\n".join(seqs).encode(), dtype=np.uint8)]
+    counts = np.zeros(n_letters ** k, dtype=np.int64)
+    if len(codes) < k:
+        return counts
+    
+    n_kmers = len(codes) - k + 1
+    invalid = np.concatenate(([0], np.cumsum(codes == n_letters)))
+    valid = invalid[k:] == invalid[:-k]
+    kmers = np.zeros(n_kmers, dtype=np.int64)
+    for i in range(k):
+        kmers = kmers * n_letters + codes[i:i + n_kmers]
+    return np.bincount(kmers[valid], minlength=len(counts))
+
+def _markov_sequences(args):
+    """Generate sequences with a Markov model.
+
+    The sequences of a batch are generated at the same time, one position
+    at a time. args is a tuple of the cumulative transition matrix, the 
+    cumulative probabilities of the first k-mer, the alphabet, the lengths
+    of the sequences and the seed of the random number generator.
+    """
+    trans_cum, init_cum, alphabet, lengths, seed = args
+    rng = np.random.RandomState(seed)
+    lengths = np.asarray(lengths, dtype=int)
+    if len(lengths) == 0:
+        return []
+    n_states, n_letters = trans_cum.shape
+    k = int(round(np.log(n_states) / np.log(n_letters)))
+    max_len = max(lengths.max(), k)
+    
+    seqs = np.zeros((len(lengths), max_len), dtype=np.uint8)
+    state = np.minimum(np.searchsorted(init_cum, rng.random_sample(len(lengths)), 
+        side="right"), n_states - 1)
+    for i in range(k):
+        seqs[:, k - 1 - i] = (state // n_letters**i) % n_letters
+    for i in range(k, max_len):
+        r = rng.random_sample(len(lengths))
+        letter = np.minimum((trans_cum[state] <= r[:, None]).sum(1), 
+                n_letters - 1)
+        seqs[:, i] = letter
+        state = (state * n_letters + letter) % n_states
+    
+    letters = np.frombuffer("".join(alphabet).encode(), dtype=np.uint8)[seqs]
+    return [row[:l].tobytes().decode() for row, l in zip(letters, lengths)]
 
 def matched_gc_bedfile(bedfile, matchfile, genome, number):
     N_FRACTION = 0.1
@@ -192,9 +357,12 @@ def matched_gc_bedfile(bedfile, matchfile, genome, number):
     g = Genome(genome)
     genome_fa = g.filename
     try:
-        fa = Fasta(matchfile)
-        gc = [(seq.upper().count("C") + seq.upper().count("G")) / len(seq) for seq in fa.seqs]
-        lengths = [len(seq) for seq in fa.seqs]
+        gc = []
+        lengths = []
+        for _, seq in iter_fasta(matchfile):
+            seq = seq.upper()
+            gc.append((seq.count("C") + seq.count("G")) / len(seq))
+            lengths.append(len(seq))
     except Exception:
         try:
             # pylint: disable=unexpected-keyword-arg
@@ -213,7 +381,7 @@ def matched_gc_bedfile(bedfile, matchfile, genome, number):
 
     if number:
         norm = number * gc_hist / (float(sum(gc_hist))) + 0.5
-        inorm = norm.astype(np.int)
+        inorm = norm.astype(int)
 
         s = np.argsort(norm - inorm)
         while sum(inorm) > number:
@@ -225,44 +393,127 @@ def matched_gc_bedfile(bedfile, matchfile, genome, number):
             s[np.argmax(s)] = 0
         gc_hist = inorm
 
-    rnd = pybedtools.BedTool()
-    out = open(bedfile, "w")
-    #sys.stderr.write("Generating sequences\n")
-    #sys.stderr.write("{}\n".format(number))
+    # Sample 30 times more random regions than needed. Regions with too 
+    # many N are rejected based on the gaps file of the genome, which is
+    # written once if it does not exist yet. If it can not be written, 
+    # they are rejected when their GC% is determined.
+    length = int(length)
+    sizes = dict((seqname, len(g[seqname])) for seqname in g.keys())
+    gaps_file = getattr(g, "gaps_file", None)
+    if not gaps_file:
+        gaps_file = re.sub(r'(\.gz)?$', '', genome_fa)
+        gaps_file = os.path.splitext(gaps_file)[0] + ".gaps.bed"
+    if not os.path.exists(gaps_file):
+        try:
+            write_gaps(g, gaps_file)
+        except (IOError, OSError):
+            pass
+    n_runs = read_gaps(gaps_file)
+    features = sample_regions(sizes, sum(gc_hist) * 30, length, 
+            n_runs, N_FRACTION)
     
-    # Create a file with chromosome sizes if it doesn't exist yet
-    genome_size = genome_fa + ".sizes"
-    del_size = False
-    if not os.path.exists(genome_size):
-        genome_size = NamedTemporaryFile().name
-        del_size = True
-        with open(genome_size, "w") as f:
-            for seqname in g.keys():
-                f.write("{}\t{}\n".format(seqname, len(g[seqname])))
-   
-    # pylint: disable=unexpected-keyword-arg
-    r = rnd.random(l=length, n=number * 30, g=genome_size).nucleotide_content(fi=genome_fa)
-    if del_size:
-        os.unlink(genome_size)
+    # Only the sequences that are needed are read, until every GC% bin 
+    # has enough regions
+    genome_seqs = ChunkedGenome(g)
+    selected = [[] for _ in gc_hist]
+    batch_size = 10000
+    for i in range(0, len(features), batch_size):
+        batch = features[i:i + batch_size]
+        seqs = region_sequences(
+                ["{}:{}-{}".format(*f) for f in batch], genome_seqs)
+        for f, (_, seq) in zip(batch, seqs):
+            seq = seq.upper()
+            if seq.count("N") > length * N_FRACTION:
+                continue
+            gc = (seq.count("G") + seq.count("C")) / float(length)
+            b = np.searchsorted(bins, gc, side="right") - 1
+            if b < len(gc_hist) and len(selected[b]) < gc_hist[b]:
+                selected[b].append(f)
+        if all(len(x) >= count for x, count in zip(selected, gc_hist)):
+            break
     
-    features = [f[:3] + [float(f[7])] for f in r if float(f[12]) <= length * N_FRACTION]
-    gc = [f[3] for f in features]
+    with open(bedfile, "w") as out:
+        for bin_start, bin_end, count, bin_features in zip(
+                bins[:-1], bins[1:], gc_hist, selected):
+            for f in bin_features:
+                out.write("{}\t{}\t{}\n".format(*f))
+            if count != len(bin_features):
+                sys.stderr.write("not enough random sequences found for {} <= GC < {} ({} instead of {})\n".format(bin_start, bin_end, len(bin_features), count))
+
+# Size of the chunks in which write_gaps() reads a genome
+GAPS_CHUNK_SIZE = 2 ** 20
+
+def write_gaps(genome, fname, chunk_size=GAPS_CHUNK_SIZE):
+    """Write the runs of N in a genome to a BED file.
+
+    The genome is read in chunks, so that the memory use does not depend 
+    on the size of the chromosomes. The file is written to a temporary 
+    file first, and only renamed to fname when it is complete.
+
+    Parameters
+    ----------
+    genome : Genome
+        Genome instance.
+
+    fname : str
+        Name of the BED file.
+
+    chunk_size : int, optional
+        Size of the chunks of the genome that are read at a time.
+    """
+    tmp_name = "{}.{}.tmp".format(fname, os.getpid())
+    try:
+        with open(tmp_name, "w") as tmp:
+            for chrom in genome.keys():
+                size = len(genome[chrom])
+                run = None
+                for start in range(0, size, chunk_size):
+                    starts, ends = find_n_runs(
+                            genome[chrom][start:start + chunk_size].seq)
+                    for run_start, run_end in zip(
+                            (starts + start).tolist(), (ends + start).tolist()):
+                        # a run at the start of a chunk can continue the
+                        # run at the end of the previous chunk
+                        if run is not None and run[1] == run_start:
+                            run = (run[0], run_end)
+                            continue
+                        if run is not None:
+                            tmp.write("{}\t{}\t{}\n".format(chrom, *run))
+                        run = (run_start, run_end)
+                if run is not None:
+                    tmp.write("{}\t{}\t{}\n".format(chrom, *run))
+        os.rename(tmp_name, fname)
+    except Exception:
+        if os.path.exists(tmp_name):
+            os.unlink(tmp_name)
+        raise
+
+def read_gaps(fname):
+    """Read the runs of N in a genome from a BED file.
+
+    Parameters
+    ----------
+    fname : str
+        Name of the BED file.
+
+    Returns
+    -------
+    n_runs : dict
+        Starts and ends of the runs of N per chromosome, or None if the 
+        file does not exist.
+    """
+    if not os.path.exists(fname):
+        return None
     
-    #sys.stderr.write("Done\n")
-    for bin_start, bin_end, count in zip(bins[:-1], bins[1:], gc_hist):
-        #sys.stderr.write("CG {}-{}\n".format(bin_start, bin_end))
-        if count > 0:
-            rcount = 0
-            for f in features:
-                if (f[3] >= bin_start and f[3] < bin_end):
-                    out.write("{}\t{}\t{}\n".format(*f[:3]))
-                    rcount += 1
-                    if rcount >= count:
-                        break
-
-            if count != rcount:
-                sys.stderr.write("not enough random sequences found for {} <= GC < {} ({} instead of {})\n".format(bin_start, bin_end, rcount, count))
-    out.close()
+    n_runs = {}
+    with open(fname) as f:
+        for line in f:
+            chrom, start, end = line.split("\t")[:3]
+            n_runs.setdefault(chrom, []).append((int(start), int(end)))
+    for chrom, runs in n_runs.items():
+        runs = np.array(sorted(runs), dtype=np.int64).reshape(-1, 2)
+        n_runs[chrom] = (runs[:, 0], runs[:, 1])
+    return n_runs
 
 class MatchedGcFasta(Fasta):
     """ 
@@ -320,15 +571,21 @@ class PromoterFasta(Fasta):
         # Create bed-file with coordinates of random sequences
         create_promoter_bedfile(tmpbed, genefile, length, n)
         
-        # Convert track to fasta
-        Genome(genome).track2fasta(tmpbed, fastafile=tmpfasta, stranded=True)
-
-        # Initialize super Fasta object
-        Fasta.__init__(self, tmpfasta)
-
-        # Delete the temporary files
+        if isinstance(genome, GenomeIndex):
+            # Retrieve the sequences from the index
+            Fasta.__init__(self)
+            self.ids, self.seqs = track_sequences(tmpbed, genome)
+        else:
+            # Convert track to fasta
+            Genome(genome).track2fasta(tmpbed, fastafile=tmpfasta, 
+                    stranded=True)
+
+            # Initialize super Fasta object
+            Fasta.__init__(self, tmpfasta)
+            os.remove(tmpfasta)
+
+        # Delete the temporary file
         os.remove(tmpbed)
-        os.remove(tmpfasta)
 
 class RandomGenomicFasta(Fasta):
     """ 
@@ -351,14 +608,20 @@ class RandomGenomicFasta(Fasta):
         # Create bed-file with coordinates of random sequences
         create_random_genomic_bedfile(tmpbed, genome, length, n)
         
-        # Convert track to fasta
-        Genome(genome).track2fasta(tmpbed, fastafile=tmpfasta, stranded=True)
-
-        # Initialize super Fasta object
-        Fasta.__init__(self, tmpfasta)
-
-        # Delete the temporary files
+        if isinstance(genome, GenomeIndex):
+            # Retrieve the sequences from the index
+            Fasta.__init__(self)
+            self.ids, self.seqs = track_sequences(tmpbed, genome)
+        else:
+            # Convert track to fasta
+            Genome(genome).track2fasta(tmpbed, fastafile=tmpfasta, 
+                    stranded=True)
+
+            # Initialize super Fasta object
+            Fasta.__init__(self, tmpfasta)
+            os.remove(tmpfasta)
+
+        # Delete the temporary file
         os.remove(tmpbed)
-        os.remove(tmpfasta)
 
 
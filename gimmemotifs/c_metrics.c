@@ -9,10 +9,13 @@
  *
  */
 
+#define PY_SSIZE_T_CLEAN
 #include <Python.h>
 #include <math.h>
 #include <string.h>
 #include <stdio.h>
+#include <stdlib.h>
+#include <stdint.h>
 #if PY_MAJOR_VERSION >= 3
     #define PyInt_FromLong PyLong_FromLong
     #define PyString_Check PyUnicode_Check
@@ -638,11 +641,723 @@ static PyObject * c_metrics_pwmscan(PyObject *self, PyObject * args)
 }
 
 
+// Index of every nucleotide in the columns of a matrix (A, C, G, T).
+// Every other character (N) has index 4 and does not contribute to the score.
+// The scanning kernels work on sequences encoded with these indices, see
+// gimmemotifs.scanner.encode_sequence().
+static unsigned char nuc_index[256];
+
+void fill_nuc_index(void) {
+	int i;
+	for (i = 0; i < 256; i++) {
+		nuc_index[i] = 4;
+	}
+	nuc_index['A'] = 0; nuc_index['a'] = 0;
+	nuc_index['C'] = 1; nuc_index['c'] = 1;
+	nuc_index['G'] = 2; nuc_index['g'] = 2;
+	nuc_index['T'] = 3; nuc_index['t'] = 3;
+}
+
+unsigned char * encode_seq(const char *seq, Py_ssize_t seq_len) {
+	// Return a newly allocated encoded copy of a sequence, or NULL if 
+	// memory could not be allocated
+	Py_ssize_t i;
+	unsigned char *encoded = malloc(seq_len + 1);
+	if (encoded != NULL) {
+		for (i = 0; i < seq_len; i++) {
+			encoded[i] = nuc_index[(unsigned char) seq[i]];
+		}
+	}
+	return encoded;
+}
+
+// Matches with a score <= NO_SCORE are never reported
+#define NO_SCORE -100
+
+// Growable arrays of matches, so that scanning does not need any Python 
+// objects and can be done without holding the GIL.
+typedef struct {
+	double *scores;
+	int *pos;
+	int *strands;
+	Py_ssize_t n;
+	Py_ssize_t size;
+} matches_t;
+
+void init_matches(matches_t *matches) {
+	matches->scores = NULL;
+	matches->pos = NULL;
+	matches->strands = NULL;
+	matches->n = 0;
+	matches->size = 0;
+}
+
+void free_matches(matches_t *matches) {
+	free(matches->scores);
+	free(matches->pos);
+	free(matches->strands);
+	init_matches(matches);
+}
+
+int add_match(matches_t *matches, double score, int pos, int strand) {
+	// Add a match, returns -1 if memory could not be allocated
+	Py_ssize_t size;
+	double *scores;
+	int *positions, *strands;
+
+	if (matches->n == matches->size) {
+		size = matches->size * 2 + 64;
+		scores = realloc(matches->scores, size * sizeof(double));
+		if (scores == NULL) { return -1; }
+		matches->scores = scores;
+		positions = realloc(matches->pos, size * sizeof(int));
+		if (positions == NULL) { return -1; }
+		matches->pos = positions;
+		strands = realloc(matches->strands, size * sizeof(int));
+		if (strands == NULL) { return -1; }
+		matches->strands = strands;
+		matches->size = size;
+	}
+	matches->scores[matches->n] = score;
+	matches->pos[matches->n] = pos;
+	matches->strands[matches->n] = strand;
+	matches->n++;
+	return 0;
+}
+
+PyObject * matches_to_list(matches_t *matches, Py_ssize_t start, Py_ssize_t end) {
+	// Return the matches from start to end as a list of [score, pos, strand]
+	Py_ssize_t i;
+	PyObject *row;
+	PyObject *return_list = PyList_New(end - start);
+	
+	if (return_list == NULL) {
+		return NULL;
+	}
+	for (i = start; i < end; i++) {
+		row = Py_BuildValue("[dii]", matches->scores[i], matches->pos[i], matches->strands[i]);
+		if (row == NULL) {
+			Py_DECREF(return_list);
+			return NULL;
+		}
+		PyList_SET_ITEM(return_list, i - start, row);
+	}
+	return return_list;
+}
+
+PyObject * matches_to_arrays(matches_t *matches, Py_ssize_t starts[], int n_motifs) {
+	// Return a tuple of two bytes objects: 
+	// 1) the matches as packed records of score (float32), pos (int32) 
+	//    and strand (int8)
+	// 2) the offsets (int64) of the matches of every motif, the matches of 
+	//    motif i are the records from offsets[i] to offsets[i + 1]
+	Py_ssize_t i;
+	float score;
+	int32_t pos;
+	int8_t strand;
+	int64_t offset;
+	char *buf;
+	const Py_ssize_t record_size = sizeof(float) + sizeof(int32_t) + sizeof(int8_t);
+	PyObject *records_o, *offsets_o;
+
+	records_o = PyBytes_FromStringAndSize(NULL, matches->n * record_size);
+	offsets_o = PyBytes_FromStringAndSize(NULL, (n_motifs + 1) * sizeof(int64_t));
+	if ((records_o == NULL) || (offsets_o == NULL)) {
+		Py_XDECREF(records_o);
+		Py_XDECREF(offsets_o);
+		return NULL;
+	}
+
+	buf = PyBytes_AS_STRING(records_o);
+	for (i = 0; i < matches->n; i++) {
+		score = (float) matches->scores[i];
+		pos = (int32_t) matches->pos[i];
+		strand = (int8_t) matches->strands[i];
+		memcpy(buf, &score, sizeof(float));
+		memcpy(buf + sizeof(float), &pos, sizeof(int32_t));
+		memcpy(buf + sizeof(float) + sizeof(int32_t), &strand, sizeof(int8_t));
+		buf += record_size;
+	}
+	
+	buf = PyBytes_AS_STRING(offsets_o);
+	for (i = 0; i <= n_motifs; i++) {
+		offset = (int64_t) starts[i];
+		memcpy(buf + i * sizeof(int64_t), &offset, sizeof(int64_t));
+	}
+
+	return Py_BuildValue("(NN)", records_o, offsets_o);
+}
+
+double score_logodds(const unsigned char *seq, const double *logodds, int pwm_len) {
+	// Score one window with a precomputed log-odds matrix
+	// Structure of the matrix is [logoddsA, logoddsC, logoddsG, logoddsT] * pwm_len
+	double score = 0;
+	int m;
+	unsigned char n;
+	for (m = 0; m < pwm_len; m++) {
+		n = seq[m];
+		if (n < 4) {
+			score += logodds[m * 4 + n];
+		}
+	}
+	return score;
+}
+
+// Tolerance of the lookahead, so that rounding errors can never cause a 
+// window to be abandoned that would reach the threshold.
+#define BOUND_TOLERANCE 1e-6
+
+double score_logodds_bound(const unsigned char *seq, const double *logodds, const double *bound, int pwm_len, double threshold) {
+	// Score one window, but abandon it halfway if the score can not reach 
+	// threshold anymore. bound[m] is the maximum score of the positions 
+	// after position m (see gimmemotifs.scanner.compile_motifs()).
+	// Checking at every position is slower, as most windows are abandoned
+	// at different positions and the branch can not be predicted.
+	// Returns -INFINITY if the window is abandoned, otherwise the score, 
+	// which is identical to the score of score_logodds().
+	// Without bound (NULL), all windows are scored in full.
+	double score = 0;
+	int m, half;
+	unsigned char n;
+
+	if (bound == NULL) {
+		return score_logodds(seq, logodds, pwm_len);
+	}
+	half = pwm_len / 2;
+	for (m = 0; m < half; m++) {
+		n = seq[m];
+		if (n < 4) {
+			score += logodds[m * 4 + n];
+		}
+	}
+	if ((half > 0) && (score + bound[half - 1] < threshold - BOUND_TOLERANCE)) {
+		return -INFINITY;
+	}
+	for (; m < pwm_len; m++) {
+		n = seq[m];
+		if (n < 4) {
+			score += logodds[m * 4 + n];
+		}
+	}
+	return score;
+}
+
+void insert_top(double score, int pos, int strand, int n_report, double maxScores[], int maxPos[], int maxStrand[]) {
+	// Insert a match in the sorted list of n_report best matches
+	int p, q;
+	p = n_report - 1;
+	while ((p >= 0) && (score > maxScores[p])) {
+		p--;
+	}
+	if (p < (n_report - 1)) {
+		for (q = n_report - 1; q > (p + 1); q--) {
+			maxScores[q] = maxScores[q - 1];
+			maxPos[q] = maxPos[q - 1];
+			maxStrand[q] = maxStrand[q - 1];
+		}
+		maxScores[p + 1] = score;
+		maxPos[p + 1] = pos;
+		maxStrand[p + 1] = strand;
+	}
+}
+
+int scan_logodds(const unsigned char *seq, Py_ssize_t seq_len, const double *fwd, const double *rev, const double *fwd_bound, const double *rev_bound, int lookahead, int pwm_len, double cutoff, int n_report, int scan_rc, double maxScores[], int maxPos[], int maxStrand[], matches_t *matches) {
+	// Scan a sequence with a log-odds matrix and add the matches to matches.
+	// If n_report > 0, only the n_report best matches are added, 
+	// otherwise all matches with a score >= cutoff.
+	// Windows that can not score above the worst of the n_report best 
+	// matches so far are abandoned early (see score_logodds_bound()). 
+	// Without n_report, windows that can not score above the cutoff are
+	// only abandoned early if lookahead is set. The bounds can be NULL.
+	// maxScores, maxPos and maxStrand should be able to hold n_report values.
+	// Does not use the Python API. Returns -1 if memory could not be allocated.
+	Py_ssize_t j, j_max;
+	int i;
+	double score;
+
+	j_max = seq_len - pwm_len + 1;
+	if (j_max < 0) { j_max = 0;}
+
+	if (n_report > 0) {
+		for (i = 0; i < n_report; i++) {
+			maxScores[i] = NO_SCORE;
+			maxPos[i] = -1;
+			maxStrand[i] = 1;
+		}
+		for (j = 0; j < j_max; j++) {
+			score = score_logodds_bound(seq + j, fwd, fwd_bound, pwm_len, fmax(cutoff, maxScores[n_report - 1]));
+			if (score >= cutoff) {
+				insert_top(score, j, 1, n_report, maxScores, maxPos, maxStrand);
+			}
+		}
+		if (scan_rc) {
+			for (j = 0; j < j_max; j++) {
+				score = score_logodds_bound(seq + j, rev, rev_bound, pwm_len, fmax(cutoff, maxScores[n_report - 1]));
+				if (score >= cutoff) {
+					insert_top(score, j, -1, n_report, maxScores, maxPos, maxStrand);
+				}
+			}
+		}
+		for (i = 0; i < n_report; i++) {
+			if ((maxPos[i] > -1) && (add_match(matches, maxScores[i], maxPos[i], maxStrand[i]) < 0)) {
+				return -1;
+			}
+		}
+	}
+	else {
+		if (!lookahead) {
+			fwd_bound = NULL;
+			rev_bound = NULL;
+		}
+		for (j = 0; j < j_max; j++) {
+			score = score_logodds_bound(seq + j, fwd, fwd_bound, pwm_len, cutoff);
+			if ((score >= cutoff) && (add_match(matches, score, j, 1) < 0)) {
+				return -1;
+			}
+		}
+		if (scan_rc) {
+			for (j = 0; j < j_max; j++) {
+				score = score_logodds_bound(seq + j, rev, rev_bound, pwm_len, cutoff);
+				if ((score >= cutoff) && (add_match(matches, score, j, -1) < 0)) {
+					return -1;
+				}
+			}
+		}
+	}
+	return 0;
+}
+
+static PyObject * c_metrics_pwmscan_logodds(PyObject *self, PyObject * args)
+{
+	// Same as pwmscan, but uses a precomputed log-odds matrix for both strands.
+	// The GIL is released while scanning.
+	const char *seq_str;
+	unsigned char *seq;
+	Py_ssize_t seq_len;
+	Py_buffer fwd_o, rev_o;
+	double cutoff;
+	int n_report;
+	int scan_rc;
+	int return_all = 0;
+	int pwm_len;
+	int ret = 0;
+	Py_ssize_t j, j_max;
+	const double *fwd, *rev;
+	double *maxScores, *scores;
+	int *maxPos, *maxStrand;
+	matches_t matches;
+	PyObject *return_list = NULL;
+
+	if (!PyArg_ParseTuple(args, "s#y*y*dii|i", &seq_str, &seq_len, &fwd_o, &rev_o, &cutoff, &n_report, &scan_rc, &return_all))
+		return NULL;
+
+	if ((fwd_o.len != rev_o.len) || (fwd_o.len % (4 * sizeof(double)) != 0)) {
+		PyBuffer_Release(&fwd_o);
+		PyBuffer_Release(&rev_o);
+		PyErr_SetString( PyExc_ValueError, "Error: incorrect size of log-odds matrix");
+		return NULL;
+	}
+	pwm_len = fwd_o.len / (4 * sizeof(double));
+	fwd = (const double *) fwd_o.buf;
+	rev = (const double *) rev_o.buf;
+	
+	seq = encode_seq(seq_str, seq_len);
+	if (seq == NULL) {
+		PyBuffer_Release(&fwd_o);
+		PyBuffer_Release(&rev_o);
+		return PyErr_NoMemory();
+	}
+
+	if (return_all) {
+		j_max = seq_len - pwm_len + 1;
+		if (j_max < 0) { j_max = 0;}
+		scores = malloc((j_max + 1) * sizeof(double));
+		if (scores != NULL) {
+			Py_BEGIN_ALLOW_THREADS
+			for (j = 0; j < j_max; j++) {
+				scores[j] = score_logodds(seq + j, fwd, pwm_len);
+			}
+			Py_END_ALLOW_THREADS
+			return_list = PyList_New(j_max);
+			for (j = 0; (return_list != NULL) && (j < j_max); j++) {
+				PyList_SET_ITEM(return_list, j, PyFloat_FromDouble(scores[j]));
+			}
+			free(scores);
+		}
+		else {
+			PyErr_NoMemory();
+		}
+		free(seq);
+		PyBuffer_Release(&fwd_o);
+		PyBuffer_Release(&rev_o);
+		return return_list;
+	}
+
+	maxScores = malloc((n_report + 1) * sizeof(double));
+	maxPos = malloc((n_report + 1) * sizeof(int));
+	maxStrand = malloc((n_report + 1) * sizeof(int));
+	init_matches(&matches);
+	
+	if ((maxScores == NULL) || (maxPos == NULL) || (maxStrand == NULL)) {
+		ret = -1;
+	}
+	else {
+		Py_BEGIN_ALLOW_THREADS
+		ret = scan_logodds(seq, seq_len, fwd, rev, NULL, NULL, 0, pwm_len, cutoff, n_report, scan_rc, maxScores, maxPos, maxStrand, &matches);
+		Py_END_ALLOW_THREADS
+	}
+	
+	if (ret < 0) {
+		PyErr_NoMemory();
+	}
+	else {
+		return_list = matches_to_list(&matches, 0, matches.n);
+	}
+
+	free_matches(&matches);
+	free(seq);
+	free(maxScores);
+	free(maxPos);
+	free(maxStrand);
+	PyBuffer_Release(&fwd_o);
+	PyBuffer_Release(&rev_o);
+	return return_list;
+}
+
+// Motifs compiled by gimmemotifs.scanner.compile_motifs(), a tuple of buffers:
+//   (forward log-odds, reverse log-odds, lengths (int), cutoffs (double), 
+//    minimum scores (double), forward bound (double), reverse bound (double),
+//    lookahead (int))
+// The log-odds matrices and bounds of all motifs are concatenated. A cutoff 
+// of NaN means that the motif is not scanned. The bounds contain the 
+// maximum score of the remaining positions for every position of a motif.
+// The bounds are used with the cutoff only if lookahead is set for a motif.
+typedef struct {
+	Py_buffer fwd_o, rev_o, len_o, cutoff_o, min_o, fwd_bound_o, rev_bound_o, lookahead_o;
+	const double *fwd, *rev, *cutoffs, *min_scores, *fwd_bound, *rev_bound;
+	const int *lengths, *lookahead;
+	int n;
+} motif_set_t;
+
+void release_motif_set(motif_set_t *motifs) {
+	PyBuffer_Release(&motifs->fwd_o);
+	PyBuffer_Release(&motifs->rev_o);
+	PyBuffer_Release(&motifs->len_o);
+	PyBuffer_Release(&motifs->cutoff_o);
+	PyBuffer_Release(&motifs->min_o);
+	PyBuffer_Release(&motifs->fwd_bound_o);
+	PyBuffer_Release(&motifs->rev_bound_o);
+	PyBuffer_Release(&motifs->lookahead_o);
+}
+
+int parse_motif_set(PyObject *compiled_o, motif_set_t *motifs) {
+	// Parse compiled motifs, returns -1 and sets an exception on error
+	Py_ssize_t total_len = 0;
+	int i;
+
+	if (!PyArg_ParseTuple(compiled_o, "y*y*y*y*y*y*y*y*", &motifs->fwd_o, &motifs->rev_o, &motifs->len_o, &motifs->cutoff_o, &motifs->min_o, &motifs->fwd_bound_o, &motifs->rev_bound_o, &motifs->lookahead_o))
+		return -1;
+	
+	motifs->n = motifs->len_o.len / sizeof(int);
+	motifs->fwd = (const double *) motifs->fwd_o.buf;
+	motifs->rev = (const double *) motifs->rev_o.buf;
+	motifs->lengths = (const int *) motifs->len_o.buf;
+	motifs->cutoffs = (const double *) motifs->cutoff_o.buf;
+	motifs->min_scores = (const double *) motifs->min_o.buf;
+	motifs->fwd_bound = (const double *) motifs->fwd_bound_o.buf;
+	motifs->rev_bound = (const double *) motifs->rev_bound_o.buf;
+	motifs->lookahead = (const int *) motifs->lookahead_o.buf;
+	
+	for (i = 0; i < motifs->n; i++) {
+		total_len += motifs->lengths[i];
+	}
+	
+	if ((motifs->cutoff_o.len != motifs->n * sizeof(double)) || (motifs->min_o.len != motifs->n * sizeof(double))) {
+		PyErr_SetString( PyExc_ValueError, "Error: incorrect number of cutoffs");
+	}
+	else if (motifs->lookahead_o.len != motifs->n * sizeof(int)) {
+		PyErr_SetString( PyExc_ValueError, "Error: incorrect number of lookahead flags");
+	}
+	else if ((total_len * 4 * sizeof(double) != motifs->fwd_o.len) || (motifs->fwd_o.len != motifs->rev_o.len)) {
+		PyErr_SetString( PyExc_ValueError, "Error: incorrect size of log-odds matrix");
+	}
+	else if ((total_len * sizeof(double) != motifs->fwd_bound_o.len) || (motifs->fwd_bound_o.len != motifs->rev_bound_o.len)) {
+		PyErr_SetString( PyExc_ValueError, "Error: incorrect size of bound");
+	}
+	else {
+		return 0;
+	}
+	release_motif_set(motifs);
+	return -1;
+}
+
+static PyObject * c_metrics_pwmscan_multi(PyObject *self, PyObject * args)
+{
+	// Scan an encoded sequence with all motifs of a compiled motif set in 
+	// one call.
+	// Returns a list with a list of [score, pos, strand] for every motif.
+	// If return_arrays is set, the matches of all motifs are returned as 
+	// packed arrays instead, see matches_to_arrays().
+	// The GIL is released while scanning.
+	Py_buffer seq_o;
+	const unsigned char *seq;
+	Py_ssize_t seq_len;
+	PyObject *compiled_o;
+	motif_set_t motifs;
+	int n_report;
+	int scan_rc;
+	int return_arrays = 0;
+	int i, j, ret;
+	Py_ssize_t offset;
+	double *maxScores;
+	int *maxPos, *maxStrand;
+	Py_ssize_t *starts;
+	matches_t matches;
+	PyObject *return_list = NULL, *result;
+
+	if (!PyArg_ParseTuple(args, "y*Oii|i", &seq_o, &compiled_o, &n_report, &scan_rc, &return_arrays))
+		return NULL;
+
+	if (parse_motif_set(compiled_o, &motifs) < 0) {
+		PyBuffer_Release(&seq_o);
+		return NULL;
+	}
+	seq = (const unsigned char *) seq_o.buf;
+	seq_len = seq_o.len;
+	
+	maxScores = malloc((n_report + 1) * sizeof(double));
+	maxPos = malloc((n_report + 1) * sizeof(int));
+	maxStrand = malloc((n_report + 1) * sizeof(int));
+	starts = malloc((motifs.n + 1) * sizeof(Py_ssize_t));
+	init_matches(&matches);
+	
+	if ((maxScores == NULL) || (maxPos == NULL) || (maxStrand == NULL) || (starts == NULL)) {
+		PyErr_NoMemory();
+	}
+	else {
+		ret = 0;
+		Py_BEGIN_ALLOW_THREADS
+		offset = 0;
+		for (i = 0; i < motifs.n; i++) {
+			starts[i] = matches.n;
+			if ((ret == 0) && !isnan(motifs.cutoffs[i])) {
+				ret = scan_logodds(seq, seq_len, motifs.fwd + offset * 4, motifs.rev + offset * 4, motifs.fwd_bound + offset, motifs.rev_bound + offset, motifs.lookahead[i], motifs.lengths[i], motifs.cutoffs[i], n_report, scan_rc, maxScores, maxPos, maxStrand, &matches);
+				if ((matches.n == starts[i]) && (motifs.cutoffs[i] <= motifs.min_scores[i])) {
+					// Always report a match when the cutoff is the minimum score
+					for (j = 0; (ret == 0) && (j < n_report); j++) {
+						ret = add_match(&matches, motifs.min_scores[i], 0, 1);
+					}
+				}
+			}
+			offset += motifs.lengths[i];
+		}
+		starts[motifs.n] = matches.n;
+		Py_END_ALLOW_THREADS
+		
+		if (ret < 0) {
+			PyErr_NoMemory();
+		}
+		else if (return_arrays) {
+			return_list = matches_to_arrays(&matches, starts, motifs.n);
+		}
+		else {
+			return_list = PyList_New(motifs.n);
+			for (i = 0; (return_list != NULL) && (i < motifs.n); i++) {
+				result = matches_to_list(&matches, starts[i], starts[i + 1]);
+				if (result == NULL) {
+					Py_CLEAR(return_list);
+					break;
+				}
+				PyList_SET_ITEM(return_list, i, result);
+			}
+		}
+	}
+
+	free_matches(&matches);
+	free(starts);
+	free(maxScores);
+	free(maxPos);
+	free(maxStrand);
+	release_motif_set(&motifs);
+	PyBuffer_Release(&seq_o);
+	return return_list;
+}
+
+int count_logodds(const unsigned char *seq, Py_ssize_t seq_len, const double *fwd, const double *rev, const double *fwd_bound, const double *rev_bound, int lookahead, int pwm_len, double cutoff, int n_report, int scan_rc) {
+	// Count the matches with a score >= cutoff, on one or both strands.
+	// If n_report > 0, counting stops at n_report matches. 
+	// Gives the same count as the number of matches returned by scan_logodds().
+	// The bounds are only used if lookahead is set.
+	Py_ssize_t j, j_max;
+	int count = 0;
+	int strand;
+	const double *logodds, *bound;
+	double score;
+	double threshold = cutoff;
+
+	if ((n_report > 0) && (threshold < NO_SCORE)) {
+		threshold = NO_SCORE;
+	}
+
+	j_max = seq_len - pwm_len + 1;
+	if (j_max < 0) { j_max = 0;}
+
+	for (strand = 0; strand < (scan_rc ? 2 : 1); strand++) {
+		logodds = strand ? rev : fwd;
+		bound = lookahead ? (strand ? rev_bound : fwd_bound) : NULL;
+		for (j = 0; j < j_max; j++) {
+			score = score_logodds_bound(seq + j, logodds, bound, pwm_len, threshold);
+			if ((score >= cutoff) && ((n_report == 0) || (score > NO_SCORE))) {
+				count++;
+				if (count == n_report) {
+					return count;
+				}
+			}
+		}
+	}
+	return count;
+}
+
+double best_logodds(const unsigned char *seq, Py_ssize_t seq_len, const double *fwd, const double *rev, const double *fwd_bound, const double *rev_bound, int pwm_len, int scan_rc) {
+	// Return the best score on one or both strands, NO_SCORE if there 
+	// is no match with a higher score.
+	// Windows that can not score above the best score so far are 
+	// abandoned early (see score_logodds_bound()). The bounds can be NULL.
+	Py_ssize_t j, j_max;
+	double score, best = NO_SCORE;
+	
+	j_max = seq_len - pwm_len + 1;
+
+	for (j = 0; j < j_max; j++) {
+		score = score_logodds_bound(seq + j, fwd, fwd_bound, pwm_len, best);
+		if (score > best) { best = score; }
+		if (scan_rc) {
+			score = score_logodds_bound(seq + j, rev, rev_bound, pwm_len, best);
+			if (score > best) { best = score; }
+		}
+	}
+	return best;
+}
+
+static PyObject * c_metrics_pwmscan_count(PyObject *self, PyObject * args)
+{
+	// Count the matches of all motifs of a compiled motif set in an 
+	// encoded sequence.
+	// Returns bytes with the counts (int32) of all motifs. The counts are 
+	// identical to the number of matches returned by pwmscan_multi(). 
+	// The GIL is released while scanning.
+	Py_buffer seq_o;
+	const unsigned char *seq;
+	Py_ssize_t seq_len;
+	PyObject *compiled_o;
+	PyObject *counts_o;
+	motif_set_t motifs;
+	int n_report;
+	int scan_rc;
+	int i;
+	Py_ssize_t offset;
+	int32_t *counts;
+
+	if (!PyArg_ParseTuple(args, "y*Oii", &seq_o, &compiled_o, &n_report, &scan_rc))
+		return NULL;
+
+	if (parse_motif_set(compiled_o, &motifs) < 0) {
+		PyBuffer_Release(&seq_o);
+		return NULL;
+	}
+	seq = (const unsigned char *) seq_o.buf;
+	seq_len = seq_o.len;
+
+	counts_o = PyBytes_FromStringAndSize(NULL, motifs.n * sizeof(int32_t));
+	if (counts_o == NULL) {
+		release_motif_set(&motifs);
+		PyBuffer_Release(&seq_o);
+		return NULL;
+	}
+	counts = (int32_t *) PyBytes_AS_STRING(counts_o);
+	
+	Py_BEGIN_ALLOW_THREADS
+	offset = 0;
+	for (i = 0; i < motifs.n; i++) {
+		counts[i] = 0;
+		if (!isnan(motifs.cutoffs[i])) {
+			counts[i] = count_logodds(seq, seq_len, motifs.fwd + offset * 4, motifs.rev + offset * 4, motifs.fwd_bound + offset, motifs.rev_bound + offset, motifs.lookahead[i], motifs.lengths[i], motifs.cutoffs[i], n_report, scan_rc);
+			if ((counts[i] == 0) && (motifs.cutoffs[i] <= motifs.min_scores[i])) {
+				// Same as pwmscan_multi(), which always reports a match 
+				// when the cutoff is the minimum score
+				counts[i] = n_report;
+			}
+		}
+		offset += motifs.lengths[i];
+	}
+	Py_END_ALLOW_THREADS
+	
+	release_motif_set(&motifs);
+	PyBuffer_Release(&seq_o);
+	return counts_o;
+}
+
+static PyObject * c_metrics_pwmscan_best(PyObject *self, PyObject * args)
+{
+	// Return the best score of all motifs of a compiled motif set in an
+	// encoded sequence.
+	// Returns bytes with the scores (double) of all motifs. The cutoffs of 
+	// the motifs are not used. If there is no match, for instance because
+	// the sequence is shorter than the motif, the minimum score is returned.
+	// The GIL is released while scanning.
+	Py_buffer seq_o;
+	const unsigned char *seq;
+	Py_ssize_t seq_len;
+	PyObject *compiled_o;
+	PyObject *scores_o;
+	motif_set_t motifs;
+	int scan_rc;
+	int i;
+	Py_ssize_t offset;
+	double *scores;
+
+	if (!PyArg_ParseTuple(args, "y*Oi", &seq_o, &compiled_o, &scan_rc))
+		return NULL;
+
+	if (parse_motif_set(compiled_o, &motifs) < 0) {
+		PyBuffer_Release(&seq_o);
+		return NULL;
+	}
+	seq = (const unsigned char *) seq_o.buf;
+	seq_len = seq_o.len;
+
+	scores_o = PyBytes_FromStringAndSize(NULL, motifs.n * sizeof(double));
+	if (scores_o == NULL) {
+		release_motif_set(&motifs);
+		PyBuffer_Release(&seq_o);
+		return NULL;
+	}
+	scores = (double *) PyBytes_AS_STRING(scores_o);
+	
+	Py_BEGIN_ALLOW_THREADS
+	offset = 0;
+	for (i = 0; i < motifs.n; i++) {
+		scores[i] = best_logodds(seq, seq_len, motifs.fwd + offset * 4, motifs.rev + offset * 4, motifs.fwd_bound + offset, motifs.rev_bound + offset, motifs.lengths[i], scan_rc);
+		if (!(scores[i] > NO_SCORE)) {
+			scores[i] = motifs.min_scores[i];
+		}
+		offset += motifs.lengths[i];
+	}
+	Py_END_ALLOW_THREADS
+	
+	release_motif_set(&motifs);
+	PyBuffer_Release(&seq_o);
+	return scores_o;
+}
 
 static PyMethodDef CoreMethods[] = {
 	{"score", c_metrics_score, METH_VARARGS,"Test"},
 	{"c_max_subtotal", c_metrics_max_subtotal, METH_VARARGS,"Test"},
 	{"pwmscan", c_metrics_pwmscan, METH_VARARGS,"Test"},
+	{"pwmscan_logodds", c_metrics_pwmscan_logodds, METH_VARARGS,"Scan a sequence with a precomputed log-odds matrix"},
+	{"pwmscan_multi", c_metrics_pwmscan_multi, METH_VARARGS,"Scan a sequence with a set of compiled motifs"},
+	{"pwmscan_count", c_metrics_pwmscan_count, METH_VARARGS,"Count matches of a set of compiled motifs"},
+	{"pwmscan_best", c_metrics_pwmscan_best, METH_VARARGS,"Best score of a set of compiled motifs"},
 	{NULL, NULL, NULL, 0, NULL}
 };
 
@@ -662,6 +1377,7 @@ static PyMethodDef CoreMethods[] = {
 
 static PyObject * moduleinit(void) {
     PyObject *m;
+    fill_nuc_index();
 #if PY_MAJOR_VERSION >= 3
     m = PyModule_Create(&moduledef);
 #else
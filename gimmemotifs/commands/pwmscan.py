@@ -10,10 +10,11 @@ Command line function 'scan'.
 from __future__ import print_function
 import os
 import re
+import sys
 
 from gimmemotifs.motif import pwmfile_to_motifs
 from gimmemotifs.utils import as_fasta 
-from gimmemotifs.scanner import Scanner,scan_it_moods
+from gimmemotifs.scanner import Scanner
 from gimmemotifs.config import GM_VERSION
 
 MAX_CPUS = 16
@@ -53,23 +54,17 @@ def format_line(seq, seq_id, motif, score, pos, strand, bed=False,
             seq[pos: pos + len(motif)]
         )
 
-def scan_table(s, inputfile, fa, motifs, cutoff, bgfile, nreport, scan_rc, pvalue, moods):
+def scan_table(s, fa, motifs, nreport, scan_rc):
     # header
     yield "\t{}".format("\t".join([m.id for m in motifs]))
-    table = True
-    if moods:
-        result_it = scan_it_moods(inputfile, motifs, cutoff, bgfile,  nreport, scan_rc, pvalue, table)
-        for seq_id, counts in result_it:
-            yield "{}\t{}".format(seq_id, "\t".join([str(x) for x in counts]))
-    else:
-        # get iterator
-        result_it = s.count(fa, nreport, scan_rc)
-        # counts table
-        for i, counts in enumerate(result_it):
-            yield "{}\t{}".format(
-                        fa.ids[i], 
-                        "\t".join([str(x) for x in counts])
-                        )
+    # get iterator
+    result_it = s.count(fa, nreport, scan_rc)
+    # counts table
+    for i, counts in enumerate(result_it):
+        yield "{}\t{}".format(
+                    fa.ids[i], 
+                    "\t".join([str(x) for x in counts])
+                    )
 def scan_score_table(s, fa, motifs, scan_rc):
     
     s.set_threshold(threshold=0.0)
@@ -84,59 +79,100 @@ def scan_score_table(s, fa, motifs, scan_rc):
                     "\t".join(["{:4f}".format(x) for x in scores])
                     )
 
-def scan_normal(s, inputfile, fa, motifs, cutoff, bgfile, nreport, scan_rc, pvalue, moods, bed):
+def scan_normal(s, fa, motifs, nreport, scan_rc, bed):
     
-    table = False
-    if moods:
-        result_it = scan_it_moods(inputfile, motifs, cutoff, bgfile, nreport, scan_rc, pvalue, table)
-        for motif, d in result_it:
-            for seq_id,matches in d.items():
-                for pos,score,strand in matches:
-                    yield format_line(fa[seq_id], seq_id, motif,
-                            score, pos, strand, bed=bed)
-    else:
-        result_it = s.scan(fa, nreport, scan_rc)
-        for i, result in enumerate(result_it):
-            seq_id = fa.ids[i]
-            seq = fa[seq_id]
-            for motif, matches in zip(motifs, result):
-                for (score, pos, strand) in matches:
-                    yield format_line(seq, seq_id, motif, 
-                               score, pos, strand, bed=bed)
+    result_it = s.scan(fa, nreport, scan_rc, arrays=True)
+    for i, (matches, offsets) in enumerate(result_it):
+        seq_id = fa.ids[i]
+        seq = fa.seqs[i]
+        for motif, start, end in zip(motifs, offsets[:-1], offsets[1:]):
+            hits = matches[start:end]
+            for score, pos, strand in zip(
+                    hits["score"], hits["pos"], hits["strand"]):
+                # str() gives the shortest representation of the float32
+                yield format_line(seq, seq_id, motif, 
+                           str(score), pos, strand, bed=bed)
 
 
 def command_scan(inputfile, pwmfile, nreport=1, fpr=0.01, cutoff=None, 
         bed=False, scan_rc=True, table=False, score_table=False, moods=False, 
-        pvalue=None, bgfile=None, genome=None, ncpus=None):
+        pvalue=None, bgfile=None, genome=None, ncpus=None, engine="c"):
     motifs = pwmfile_to_motifs(pwmfile)
     
     fa = as_fasta(inputfile, genome)
     
+    # moods is kept for backwards compatibility, same as engine="moods"
+    if moods:
+        engine = "moods"
+    
     # initialize scanner
-    s = Scanner(ncpus=ncpus)
+    s = Scanner(ncpus=ncpus, engine=engine)
         
     s.set_motifs(pwmfile)
     if not score_table:
-        s.set_threshold(fpr=fpr, threshold=cutoff, 
-            genome=genome, length=fa.median_length(), filename=bgfile)
+        if pvalue is not None:
+            s.set_threshold(pvalue=pvalue, genome=genome, filename=bgfile)
+        else:
+            s.set_threshold(fpr=fpr, threshold=cutoff, 
+                genome=genome, length=fa.median_length(), filename=bgfile)
     
     if table:
-        it = scan_table(s, inputfile, fa, motifs, cutoff, bgfile, nreport, scan_rc, pvalue, moods)
+        it = scan_table(s, fa, motifs, nreport, scan_rc)
     elif score_table:
         it = scan_score_table(s, fa, motifs, scan_rc) 
     else:
-        it = scan_normal(s, inputfile, fa, motifs, cutoff, bgfile, nreport, scan_rc, pvalue, moods, bed)
+        it = scan_normal(s, fa, motifs, nreport, scan_rc, bed)
     
     for row in it:
         yield row
 
+def command_scan_genome(genome, pwmfile, fpr=0.01, cutoff=None, 
+        scan_rc=True, pvalue=None, bgfile=None, ncpus=None, engine="c", 
+        outfile=None, build_index=False):
+    """Scan a whole genome, see Scanner.scan_genome().
+
+    The hits are written to outfile as an indexed binary file, or in BED
+    format to stdout if outfile is None. With build_index a hit index is 
+    built instead, see Scanner.build_hit_index().
+    """
+    s = Scanner(ncpus=ncpus, engine=engine)
+    s.set_motifs(pwmfile)
+    if pvalue is not None:
+        s.set_threshold(pvalue=pvalue, genome=genome)
+    elif cutoff is not None:
+        s.set_threshold(threshold=cutoff)
+    elif bgfile:
+        s.set_threshold(fpr=fpr, filename=bgfile)
+    else:
+        s.set_threshold(fpr=fpr, genome=genome)
+    
+    if build_index:
+        fname = s.build_hit_index(genome, scan_rc=scan_rc)
+        print("# Hit index: {}".format(fname))
+    elif outfile:
+        s.scan_genome(genome, outfile, scan_rc=scan_rc)
+    else:
+        s.scan_genome(genome, sys.stdout, scan_rc=scan_rc, bed=True)
+
 def pwmscan(args):
 
-    if args.fpr is None and args.cutoff is None:
+    if args.fpr is None and args.cutoff is None and args.pvalue is None:
         args.fpr = 0.01
 
+    if args.whole_genome:
+        if not args.genome:
+            raise ValueError("Need a genome (-g) with --whole-genome")
+    elif args.inputfile is None:
+        raise ValueError("Need an input file")
+
+    if args.moods:
+        args.engine = "moods"
+
     print("# GimmeMotifs version {}".format(GM_VERSION))
-    print("# Input: {}".format(args.inputfile))
+    if args.whole_genome:
+        print("# Input: {} (whole genome)".format(args.genome))
+    else:
+        print("# Input: {}".format(args.inputfile))
     print("# Motifs: {}".format(args.pwmfile))
     if args.fpr:
         if args.genome:
@@ -145,6 +181,25 @@ def pwmscan(args):
             print("# FPR: {} ({})".format(args.fpr, args.bgfile))
     if args.cutoff:
         print("# Threshold: {}".format(args.cutoff))
+    if args.pvalue:
+        print("# P-value: {}".format(args.pvalue))
+
+    if args.whole_genome:
+        sys.stdout.flush()
+        command_scan_genome(
+            args.genome, 
+            args.pwmfile, 
+            fpr=args.fpr, 
+            cutoff=args.cutoff, 
+            scan_rc=args.scan_rc, 
+            pvalue=args.pvalue,
+            bgfile=args.bgfile,
+            ncpus=args.ncpus,
+            engine=args.engine,
+            outfile=args.outfile,
+            build_index=args.build_index,
+            )
+        return
 
     for line in command_scan(
             args.inputfile, 
@@ -161,5 +216,6 @@ def pwmscan(args):
             bgfile=args.bgfile,
             genome=args.genome,
             ncpus=args.ncpus,
+            engine=args.engine,
             ):
         print(line)
@@ -66,6 +66,9 @@ class MotifConfig(object):
         d = dict(self.config.items("params"))
         for k in ["use_strand", "use_cache"]:
             d[k] = self.config.getboolean("params", k)
+        if self.config.has_option("params", "use_hit_index"):
+            d["use_hit_index"] = self.config.getboolean(
+                    "params", "use_hit_index")
         return d
 
     def get_seqlogo(self):
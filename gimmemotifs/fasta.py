@@ -5,44 +5,109 @@
 # distribution.
 
 """ Module to work with FASTA files """
+import os
 import sys
+import mmap
+import gzip
+import zlib
 import random
 import re
+from bisect import bisect_right
+from collections import OrderedDict
+from struct import pack, unpack
+
 import numpy as np
 
+_invalid_seq_p = re.compile(
+        r'[^abcdefghiklmnpqrstuvwyzxABCDEFGHIKLMNPQRSTUVWXYZ]')
+
+def iter_fasta(fname):
+    """Iterate over the sequences in a FASTA file.
+
+    The file is read line by line, only one sequence is kept in memory.
+
+    Parameters
+    ----------
+    fname : str
+        Name of the FASTA file, gzip or bgzip compressed if the name ends
+        with .gz.
+
+    Yields
+    ------
+    seq_id : str
+        Sequence id, the complete header line without ">".
+    seq : str
+        Sequence.
+    """
+    if fname.endswith(".gz"):
+        f = gzip.open(fname, "rt")
+    else:
+        f = open(fname)
+    with f:
+        line = f.readline()
+        if not line.startswith(">"):
+            raise IOError("Not a valid FASTA file")
+        
+        seq_id = line[1:].rstrip("\r\n")
+        lines = []
+        for line in f:
+            if line.startswith(">"):
+                yield seq_id, _check_seq("".join(lines))
+                seq_id = line[1:].rstrip("\r\n")
+                lines = []
+            else:
+                lines.append(line.rstrip("\r\n"))
+        yield seq_id, _check_seq("".join(lines))
+
+def _check_seq(seq):
+    if _invalid_seq_p.match(seq):
+        raise IOError("Not a valid FASTA file")
+    return seq
+
 class Fasta(object):
 
     def __init__(self, fname=None, split_whitespace=False):
         """ Instantiate fasta object. Optional Fasta-formatted file as argument"""
         self.ids = []
         self.seqs = []
-        p = re.compile(r'[^abcdefghiklmnpqrstuvwyzxABCDEFGHIKLMNPQRSTUVWXYZ]')
+        # Position of every id in self.ids. The index is rebuilt when the 
+        # ids list has been replaced or changed in size without going 
+        # through this class.
+        self._index = {}
+        self._indexed_ids = None
+        self._indexed_len = 0
         if fname:
-            f = open(fname, "r")
-            c = f.read()
-            f.close()
-            if not(c.startswith(">")):
-                raise IOError("Not a valid FASTA file")
-            
-            for seq in c.split(">"):
-                if len(seq) > 1:
-                    lines = seq.split("\n")
-                    seq_name = lines[0]
-                    if split_whitespace:
-                        seq_name = seq_name.split(" ")
-                    self.ids.append(seq_name)
-                    sequence = "".join(lines[1:])
-                    if p.match(sequence):
-                        raise IOError("Not a valid FASTA file")
-                    self.seqs.append(sequence)
+            for seq_name, sequence in iter_fasta(fname):
+                if split_whitespace:
+                    seq_name = seq_name.split(" ")
+                self.ids.append(seq_name)
+                self.seqs.append(sequence)
         
     def hardmask(self):
         """ Mask all lowercase nucleotides with N's """
         p = re.compile("a|c|g|t|n")
-        for seq_id in self.fasta_dict.keys():
-            self.fasta_dict[seq_id] = p.sub("N", self.fasta_dict[seq_id])
+        self.seqs = [p.sub("N", seq) for seq in self.seqs]
         return self
 
+    def _get_index(self):
+        """ Return the id to position dictionary, up-to-date with self.ids """
+        if self._indexed_ids is not self.ids or \
+                self._indexed_len != len(self.ids):
+            index = {}
+            for i, seq_id in enumerate(self.ids):
+                index.setdefault(_key(seq_id), i)
+            self._index = index
+            self._indexed_ids = self.ids
+            self._indexed_len = len(self.ids)
+        return self._index
+
+    def _position(self, seq_id):
+        try:
+            return self._get_index().get(_key(seq_id))
+        except TypeError:
+            # unhashable
+            return None
+
     def get_random(self, n, l=None):
         """ Return n random sequences from this Fasta object """
         random_f = Fasta()
@@ -54,7 +119,7 @@ class Fasta(object):
                 seq_id = ids.pop()
                 if (len(self[seq_id]) >= l):
                     start = random.randint(0, len(self[seq_id]) - l)
-                    random_f["random%s" % (i + 1)] = self[seq_id][start:start+l]
+                    random_f.add("random%s" % (i + 1), self[seq_id][start:start+l])
                     i += 1
             if len(random_f) != n:
                 sys.stderr.write("Not enough sequences of required length")
@@ -64,8 +129,8 @@ class Fasta(object):
 
         else:
             choice = random.sample(self.ids, n)
-            for i in range(n):
-                random_f[choice[i]] = self[choice[i]]
+            for seq_id, seq in zip(choice, self.get_seqs(choice)):
+                random_f.add(seq_id, seq)
         return random_f
 
 
@@ -75,11 +140,34 @@ class Fasta(object):
             f.ids = self.ids[idx][:]
             f.seqs = self.seqs[idx][:]
             return f
-        elif idx in self.ids:
-            return self.seqs[self.ids.index(idx)]
+        i = self._position(idx)
+        if i is not None:
+            return self.seqs[i]
         else:
             return None
 
+    def get_seqs(self, ids):
+        """ Return the sequences of a list of ids.
+
+        Parameters
+        ----------
+        ids : list
+            Sequence ids.
+
+        Returns
+        -------
+        seqs : list
+            Sequences in the order of ids, None for ids that are not 
+            present.
+        """
+        index = self._get_index()
+        seqs = self.seqs
+        result = []
+        for seq_id in ids:
+            i = index.get(_key(seq_id))
+            result.append(seqs[i] if i is not None else None)
+        return result
+
     def __repr__(self):
         return "%s sequences" % len(self.ids)
 
@@ -87,29 +175,40 @@ class Fasta(object):
         return len(self.ids)
 
     def __setitem__(self, key, value):
-        if key in self.ids:
-            self.seqs[self.ids.index(key)] = value
+        i = self._position(key)
+        if i is not None:
+            self.seqs[i] = value
         else:
-            self.ids.append(key)
-            self.seqs.append(value)
+            self.add(key, value)
 
     def __delitem__(self, key):
-        i = self.ids.index(key)
+        i = self._position(key)
+        if i is None:
+            raise ValueError("{} not in Fasta".format(key))
         self.ids.pop(i)
         self.seqs.pop(i)
+        if i == len(self.ids):
+            del self._index[_key(key)]
+            self._indexed_len -= 1
+        else:
+            # positions of the following sequences have changed
+            self._indexed_ids = None
         
     def _format_seq(self, seq):
         return seq
 
     def add(self, seq_id, seq):
+        index = self._get_index()
+        index.setdefault(_key(seq_id), len(self.ids))
         self.ids.append(seq_id)
         self.seqs.append(seq)
+        self._indexed_len += 1
     
     def has_key(self, key):
-        if key in self.ids:
-            return True
-        else:
-            return False
+        return self._position(key) is not None
+
+    def __contains__(self, key):
+        return self.has_key(key)
 
     def __str__(self):
         return "%s sequences" % len(self.ids)
@@ -126,3 +225,324 @@ class Fasta(object):
 
     def median_length(self):
         return np.median([len(seq) for seq in self.seqs])
+
+class IndexedFasta(Fasta):
+    """FASTA file with sequences that are read when they are needed.
+
+    Only the names, lengths and offsets of the sequences are kept in 
+    memory. They are read from a samtools-style FASTA index (fname + 
+    ".fai"), which is created when the sequences are accessed for the 
+    first time if it does not exist or is older than the FASTA file. 
+    Sequences are read from the memory-mapped file, or, for a bgzip 
+    compressed file (.gz), from the compressed blocks (see BgzfFile). All
+    lines of a sequence, except the last one, should have the same length.
+
+    As in the index, the sequence ids are the names up to the first 
+    whitespace. An IndexedFasta can not be changed.
+
+    Parameters
+    ----------
+    fname : str
+        Name of the FASTA file.
+    """
+
+    def __init__(self, fname):
+        if not os.path.exists(fname):
+            raise IOError("File {} does not exist".format(fname))
+        self.fname = fname
+        self.fai_file = fname + ".fai"
+        self._records = None
+        self._ids = None
+        self._data = None
+        self._index = {}
+        self._indexed_ids = None
+        self._indexed_len = 0
+
+    def _load(self):
+        if self._records is not None:
+            return
+        if os.path.exists(self.fai_file) and \
+                os.path.getmtime(self.fai_file) >= os.path.getmtime(self.fname):
+            records = _read_fai(self.fai_file)
+        else:
+            records = [(header.split(None, 1)[0] if header else "", record)
+                    for header, record in fasta_index(self.fname)]
+            try:
+                _write_fai(records, self.fai_file)
+            except (IOError, OSError):
+                # the index is kept in memory only
+                pass
+        self._ids = [name for name, _ in records]
+        self._records = [record for _, record in records]
+
+    @property
+    def ids(self):
+        self._load()
+        return self._ids
+
+    @property
+    def seqs(self):
+        self._load()
+        return _IndexedSeqs(self)
+
+    def _read(self, i):
+        """ Read the i-th sequence from the file """
+        length, offset, linebases, linewidth = self._records[i]
+        if length == 0:
+            return ""
+        if self._data is None:
+            if self.fname.endswith(".gz"):
+                self._data = BgzfFile(self.fname)
+            else:
+                with open(self.fname, "rb") as f:
+                    self._data = mmap.mmap(
+                            f.fileno(), 0, access=mmap.ACCESS_READ)
+        end = offset + (length // linebases) * linewidth + length % linebases
+        data = self._data[offset:end]
+        if linewidth != linebases:
+            data = data.replace(b"\n", b"").replace(b"\r", b"")
+        return data.decode()
+
+    def lengths(self):
+        """ Return the lengths of all sequences """
+        self._load()
+        return [record[0] for record in self._records]
+
+    def median_length(self):
+        return np.median(self.lengths())
+
+    def close(self):
+        """ Close the memory-mapped or compressed file """
+        if self._data is not None:
+            self._data.close()
+            self._data = None
+
+    def _read_only(self, *args):
+        raise TypeError("IndexedFasta can not be changed")
+
+    __setitem__ = __delitem__ = add = hardmask = _read_only
+
+    def __repr__(self):
+        return "{} sequences in {}".format(len(self), self.fname)
+
+    __str__ = __repr__
+
+class _IndexedSeqs(object):
+    """ Read-only list of the sequences of an IndexedFasta """
+
+    def __init__(self, fasta):
+        self._fasta = fasta
+
+    def __len__(self):
+        return len(self._fasta._records)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self._fasta._read(i) for i in range(len(self))[idx]]
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError("sequence index out of range")
+        return self._fasta._read(idx)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self._fasta._read(i)
+
+def fasta_index(fname):
+    """Index the sequences in a FASTA file.
+
+    Parameters
+    ----------
+    fname : str
+        Name of the FASTA file, gzip or bgzip compressed if the name ends
+        with .gz.
+
+    Returns
+    -------
+    records : list
+        List of (header, (length, offset, line bases, line width)) tuples,
+        with the values of a samtools FASTA index. Offsets of compressed 
+        files are positions in the uncompressed data.
+    """
+    records = []
+    name = None
+    pos = 0
+    if fname.endswith(".gz"):
+        f = gzip.open(fname, "rb")
+    else:
+        f = open(fname, "rb")
+    with f:
+        for line in f:
+            if line.startswith(b">"):
+                if name is not None:
+                    records.append((name, (length, offset, linebases or 0, 
+                        linewidth or 0)))
+                name = line[1:].strip().decode()
+                offset = pos + len(line)
+                length = 0
+                linebases = linewidth = None
+                last_line = False
+            elif name is None:
+                raise IOError("Not a valid FASTA file")
+            else:
+                bases = len(line.rstrip(b"\r\n"))
+                if linebases is None:
+                    linebases, linewidth = bases, len(line)
+                elif last_line and bases > 0 or bases > linebases:
+                    raise ValueError(
+                        "Lines of sequence {} in {} have different lengths"
+                        .format(name, fname))
+                if bases < linebases or len(line) == bases:
+                    last_line = True
+                length += bases
+            pos += len(line)
+    if name is None:
+        raise IOError("Not a valid FASTA file")
+    records.append((name, (length, offset, linebases or 0, linewidth or 0)))
+    return records
+
+class BgzfFile(object):
+    """Random access to the uncompressed data of a bgzip compressed file.
+
+    A BGZF file consists of separately compressed blocks of at most 64kb.
+    The blocks are located with the .gzi index of the file, as created by
+    ``bgzip -i``. Without index, the blocks are found by reading the 
+    headers of all blocks and the index is written to fname + ".gzi", if 
+    possible. Slicing returns the uncompressed bytes, as for a 
+    memory-mapped file. The most recently read blocks are cached.
+
+    Parameters
+    ----------
+    fname : str
+        Name of the bgzip compressed file.
+    """
+    cache_size = 16
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.gzi_file = fname + ".gzi"
+        self._f = open(fname, "rb")
+        if not _is_bgzf(self._f.read(18)):
+            self._f.close()
+            raise ValueError(
+                    "{} is not compressed with bgzip".format(fname))
+        
+        if os.path.exists(self.gzi_file) and \
+                os.path.getmtime(self.gzi_file) >= os.path.getmtime(fname):
+            blocks = _read_gzi(self.gzi_file)
+        else:
+            blocks = self._scan_blocks()
+            try:
+                _write_gzi(blocks, self.gzi_file)
+            except (IOError, OSError):
+                pass
+        self._compressed = [c for c, _ in blocks]
+        self._uncompressed = [u for _, u in blocks]
+        self._cache = OrderedDict()
+
+    def _block_header(self, pos):
+        """ Return the size of the block at pos and the size of its header """
+        self._f.seek(pos)
+        head = self._f.read(12)
+        if len(head) < 12:
+            return None, None
+        xlen = unpack("<H", head[10:12])[0]
+        extra = self._f.read(xlen)
+        i = 0
+        while i + 4 <= len(extra):
+            slen = unpack("<H", extra[i + 2:i + 4])[0]
+            if extra[i:i + 2] == b"BC":
+                bsize = unpack("<H", extra[i + 4:i + 6])[0] + 1
+                return bsize, 12 + xlen
+            i += 4 + slen
+        raise ValueError("{} is not compressed with bgzip".format(self.fname))
+
+    def _scan_blocks(self):
+        """ Return the compressed and uncompressed offsets of all blocks """
+        blocks = []
+        pos = upos = 0
+        while True:
+            bsize, _ = self._block_header(pos)
+            if bsize is None:
+                break
+            self._f.seek(pos + bsize - 4)
+            isize = unpack("<I", self._f.read(4))[0]
+            # the empty end-of-file block is not indexed
+            if isize > 0:
+                blocks.append((pos, upos))
+            pos += bsize
+            upos += isize
+        return blocks
+
+    def _block(self, i):
+        data = self._cache.get(i)
+        if data is not None:
+            self._cache.move_to_end(i)
+            return data
+        
+        pos = self._compressed[i]
+        bsize, header_size = self._block_header(pos)
+        self._f.seek(pos + header_size)
+        data = zlib.decompress(
+                self._f.read(bsize - header_size - 8), -zlib.MAX_WBITS)
+        self._cache[i] = data
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return data
+
+    def __getitem__(self, idx):
+        if not isinstance(idx, slice) or idx.step not in (None, 1):
+            raise TypeError("BgzfFile only supports slices")
+        start = idx.start or 0
+        stop = idx.stop
+        i = max(bisect_right(self._uncompressed, start) - 1, 0)
+        chunks = []
+        while i < len(self._compressed) and \
+                (stop is None or self._uncompressed[i] < stop):
+            data = self._block(i)
+            offset = self._uncompressed[i]
+            end = None if stop is None else stop - offset
+            chunks.append(data[max(start - offset, 0):end])
+            i += 1
+        return b"".join(chunks)
+
+    def close(self):
+        self._f.close()
+        self._cache = OrderedDict()
+
+def _is_bgzf(head):
+    """ Check if a file starts with a BGZF block header """
+    return len(head) >= 18 and head[:4] == b"\x1f\x8b\x08\x04" and \
+            b"BC" in head[12:12 + unpack("<H", head[10:12])[0]]
+
+def _read_gzi(fname):
+    with open(fname, "rb") as f:
+        n = unpack("<Q", f.read(8))[0]
+        offsets = np.frombuffer(f.read(16 * n), dtype="<u8").reshape(-1, 2)
+    return [(0, 0)] + [(int(c), int(u)) for c, u in offsets]
+
+def _write_gzi(blocks, fname):
+    # the first block, at offset 0, is not stored
+    with open(fname, "wb") as f:
+        f.write(pack("<Q", max(len(blocks) - 1, 0)))
+        f.write(np.array(blocks[1:], dtype="<u8").tobytes())
+
+def _read_fai(fname):
+    records = []
+    with open(fname) as f:
+        for line in f:
+            vals = line.rstrip("\n").split("\t")
+            records.append((vals[0], tuple(int(x) for x in vals[1:5])))
+    return records
+
+def _write_fai(records, fname):
+    with open(fname, "w") as f:
+        for name, record in records:
+            f.write("\t".join([name] + [str(x) for x in record]) + "\n")
+
+def _key(seq_id):
+    # ids split on whitespace are lists
+    if isinstance(seq_id, list):
+        return tuple(seq_id)
+    return seq_id
@@ -5,8 +5,11 @@
 # distribution.
 """ Module to index genomes for fast retrieval of sequences """
 from __future__ import print_function
-from struct import pack,unpack
+from struct import pack,unpack,calcsize
 from glob import glob
+from functools import partial
+import mmap
+import multiprocessing as mp
 import subprocess as sp
 import random
 import bisect
@@ -22,12 +25,13 @@ import re
 from distutils.spawn import find_executable
 import gzip 
 
+import numpy as np
 import pybedtools
 from genomepy import Genome
 
 from gimmemotifs.shutils import find_by_ext
 from gimmemotifs.config import FASTA_EXT,MotifConfig
-from gimmemotifs.fasta import Fasta
+from gimmemotifs.fasta import Fasta, BgzfFile, fasta_index
 
 try:
     from string import maketrans
@@ -242,6 +246,105 @@ def get_genome(genomebuild, fastadir, indexdir=None):
     g = g.create_index(genome_dir, index_dir)
     create_bedtools_fa(index_dir, genome_dir)
 
+# Size of the blocks in which _index_fasta() reads a FASTA file
+INDEX_BLOCK_SIZE = 64 * 1024 * 1024
+
+def _line_ends(fasta):
+    """Return the positions of the newlines in a memory-mapped file, plus 
+    the end of the file if it does not end with a newline."""
+    ends = []
+    for start in range(0, len(fasta), INDEX_BLOCK_SIZE):
+        block = np.frombuffer(fasta, dtype=np.uint8, 
+                count=min(INDEX_BLOCK_SIZE, len(fasta) - start), 
+                offset=start)
+        ends.append(np.flatnonzero(block == ord("\n")) + start)
+    if len(fasta) > 0 and fasta[-1:] != b"\n":
+        ends.append(np.array([len(fasta)]))
+    if len(ends) == 0:
+        return np.zeros(0, dtype=np.int64)
+    return np.concatenate(ends)
+
+def _file_stamp(fname):
+    """Return the size and modification time of a file as strings."""
+    stat = os.stat(fname)
+    return str(stat.st_size), repr(stat.st_mtime)
+
+def _index_fasta(fasta_file, index_dir, pack_char="L"):
+    """Index all sequences in a FASTA file.
+
+    For every sequence the offsets of all sequence lines are written to 
+    an index file in index_dir.
+
+    Returns
+    -------
+    records : list
+        List of (name, fasta_file, index_file, line_size, total_size) 
+        tuples, one per sequence.
+    """
+    if fasta_file.endswith(".gz"):
+        return _index_compressed_fasta(fasta_file, index_dir, pack_char)
+    
+    with open(fasta_file, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            raise ValueError("{} is empty".format(fasta_file))
+        fasta = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    
+    try:
+        data = np.frombuffer(fasta, dtype=np.uint8)
+        ends = _line_ends(fasta)
+        starts = np.concatenate(([0], ends[:-1] + 1))
+        if data[0] != ord(">"):
+            raise ValueError("{} is not a valid FASTA file, "
+                    "expected > at first line".format(fasta_file))
+        
+        headers = np.flatnonzero(data[np.minimum(starts, len(data) - 1)] 
+                == ord(">"))
+        lengths = ends - starts
+        # do not count carriage returns
+        lengths[(lengths > 0) & (data[np.maximum(ends - 1, 0)] == 
+            ord("\r"))] -= 1
+        
+        records = []
+        for i, header in enumerate(headers):
+            name = fasta[starts[header]:starts[header] + lengths[header]]
+            name = name.decode().strip().replace(">", "")
+            last = headers[i + 1] if i + 1 < len(headers) else len(starts)
+            seq_lengths = lengths[header + 1:last]
+            # ignore empty lines at the end of a sequence
+            while len(seq_lengths) > 0 and seq_lengths[-1] == 0:
+                seq_lengths = seq_lengths[:-1]
+            
+            index_file = os.path.join(index_dir, "%s.index" % name)
+            starts[header + 1:header + 1 + len(seq_lengths)].astype(
+                    np.dtype(pack_char)).tofile(index_file)
+            line_size = int(seq_lengths[0]) if len(seq_lengths) > 0 else 0
+            records.append((name, fasta_file, index_file, line_size, 
+                int(seq_lengths.sum())))
+    finally:
+        del data
+        fasta.close()
+    
+    return records
+
+def _index_compressed_fasta(fasta_file, index_dir, pack_char="L"):
+    """Index all sequences in a bgzip compressed FASTA file.
+
+    The file is decompressed while it is read, the offsets in the index 
+    files are positions in the uncompressed data.
+    """
+    # check this before reading the whole file
+    BgzfFile(fasta_file).close()
+    
+    records = []
+    for name, (length, offset, line_size, line_bytes) in \
+            fasta_index(fasta_file):
+        index_file = os.path.join(index_dir, "%s.index" % name)
+        n_lines = -(-length // line_size) if line_size else 0
+        (offset + np.arange(n_lines, dtype=np.int64) * line_bytes).astype(
+                np.dtype(pack_char)).tofile(index_file)
+        records.append((name, fasta_file, index_file, line_size, length))
+    return records
+
 class GenomeIndex(object):
     """ Index fasta-formatted files for faster retrieval of sequences
         Typical use:
@@ -262,6 +365,8 @@ class GenomeIndex(object):
         """ Initialize GenomeIndex with index_dir as optional argument"""
         self.param_file = "index.params"
         self.size_file = "genome.size"
+        self.files_file = "index.files"
+        self.twobit_file = "genome.2bit"
         self.index_dir = index_dir
         self.fasta_dir = None
         
@@ -270,6 +375,13 @@ class GenomeIndex(object):
         self.index_file = {}
         self.line_size = {}
         self.pack_char = "L"
+        
+        # memory-mapped FASTA files, and per chromosome the file, the 
+        # offset of the sequence and the number of bytes per line
+        self._mmaps = {}
+        self._mapped = {}
+        self._twobit = None
+        self._n_runs = {}
 
         if self.index_dir:
             if os.path.exists(os.path.join(self.index_dir, self.param_file)):
@@ -281,24 +393,12 @@ class GenomeIndex(object):
             print("Directory %s does not exist!" % dirname)
             sys.exit(1)
     
-    def _make_index(self, fasta, index):
-        """ Index a single, one-sequence fasta-file"""
-        out = open(index, "wb")
-        f = open(fasta)
-        # Skip first line of fasta-file
-        line = f.readline()
-        offset = f.tell()
-        line = f.readline()
-        while line:
-            out.write(pack(self.pack_char, offset))
-            offset = f.tell()
-            line = f.readline()
-        f.close()
-        out.close()
-
-    def create_index(self,fasta_dir=None, index_dir=None):
-        """Index all fasta-files in fasta_dir (one sequence per file!) and
-        store the results in index_dir"""
+    def create_index(self,fasta_dir=None, index_dir=None, ncpus=None):
+        """Index all fasta-files in fasta_dir and store the results in 
+        index_dir. The files are indexed in parallel by ncpus processes.
+        
+        If index_dir already contains an index, only new and changed files
+        are indexed."""
         
         # Use default directories if they are not supplied
         if not fasta_dir:
@@ -336,18 +436,55 @@ class GenomeIndex(object):
         self._check_dir(fasta_dir)
         self._check_dir(index_dir)
 
-        # Get all fasta-files 
+        # Get all fasta-files, bgzip compressed files end with .gz
 
         fastafiles = find_by_ext(fasta_dir, FASTA_EXT)
+        fastafiles += [fname for fname in find_by_ext(fasta_dir, [".gz"])
+                if os.path.splitext(fname[:-3])[-1] in FASTA_EXT]
         if not(fastafiles):
             msg = "No fastafiles found in {} with extension in {}".format(
                                         fasta_dir, ",".join(FASTA_EXT))
             raise IOError(msg)
 
         # param_file will hold all the information about the location of the fasta-files, indeces and 
-        # length of the sequences
+        # length of the sequences, files_file the size and modification 
+        # time of the indexed fasta-files
         param_file = os.path.join(index_dir, self.param_file)
         size_file = os.path.join(index_dir, self.size_file)
+        files_file = os.path.join(index_dir, self.files_file)
+        
+        stamps = dict((fname, _file_stamp(fname)) for fname in fastafiles)
+        records = {}
+        if os.path.exists(param_file) and os.path.exists(files_file):
+            with open(files_file) as f:
+                old_stamps = dict((vals[0], tuple(vals[1:])) 
+                        for vals in (line.rstrip("\n").split("\t") 
+                            for line in f))
+            with open(param_file) as f:
+                for line in f:
+                    vals = line.rstrip("\n").split("\t")
+                    if stamps.get(vals[1]) == old_stamps.get(vals[1]):
+                        records.setdefault(vals[1], []).append(vals)
+        
+        changed = [fname for fname in fastafiles if fname not in records]
+        if ncpus is None:
+            ncpus = int(MotifConfig().get_default_params()["ncpus"])
+        # daemonic processes, such as the workers of a Scanner, can not 
+        # start a pool
+        if ncpus > 1 and len(changed) > 1 and not mp.current_process().daemon:
+            try:
+                ctx = mp.get_context('spawn')
+                pool = ctx.Pool(processes=min(ncpus, len(changed)))
+            except AttributeError:
+                pool = mp.Pool(processes=min(ncpus, len(changed)))
+            results = pool.map(partial(_index_fasta, index_dir=index_dir, 
+                pack_char=self.pack_char), changed)
+            pool.close()
+            pool.join()
+        else:
+            results = [_index_fasta(fname, index_dir, self.pack_char) 
+                    for fname in changed]
+        records.update(zip(changed, results))
         
         try:
             out = open(param_file, "w")
@@ -357,48 +494,34 @@ class GenomeIndex(object):
                 sys.exit()
             else:
                 sys.stderr.write(e)
-        s_out = open(size_file, "w")
-
-        for fasta_file in fastafiles:
-            #sys.stderr.write("Indexing %s\n" % fasta_file)
-            f = open(fasta_file)
-            line = f.readline()
-            if not line.startswith(">"):
-                sys.stderr.write("%s is not a valid FASTA file, expected > at first line\n" % fasta_file)
-                sys.exit()
-            
-            seqname = line.strip().replace(">", "")
-            line = f.readline()
-            line_size = len(line.strip())
-
-            total_size = 0 
-            while line:
-                line = line.strip()
-                if line.startswith(">"):
-                    sys.stderr.write("Sorry, can only index genomes with "
-                    "one sequence per FASTA file\n%s contains multiple "
-                    "sequences\n" % fasta_file)
-                    sys.exit()
-                
-                total_size += len(line)
-                line = f.readline()
-
-            index_file = os.path.join(index_dir, "%s.index" % seqname)
-
-            out.write("{}\t{}\t{}\t{}\t{}\n".format(
-                seqname, fasta_file, index_file, line_size, total_size))
-            s_out.write("{}\t{}\n".format(seqname, total_size))
-            
-            self._make_index(fasta_file, index_file)
-            f.close()
-        out.close()
-        s_out.close()
+        with out, open(size_file, "w") as s_out, open(files_file, "w") as f_out:
+            for fasta_file in fastafiles:
+                f_out.write("\t".join([fasta_file] + 
+                    list(stamps[fasta_file])) + "\n")
+                for seqname, _, index_file, line_size, total_size in \
+                        records[fasta_file]:
+                    out.write("{}\t{}\t{}\t{}\t{}\n".format(seqname, 
+                        fasta_file, index_file, line_size, total_size))
+                    s_out.write("{}\t{}\n".format(seqname, total_size))
 
         # Read the index we just made so we can immediately use it
         self._read_index_file()
+        
+        # Update the 2bit file if there is one
+        if changed and self._twobit is not None:
+            self.create_twobit()
     
     def _read_index_file(self):
         """read the param_file, index_dir should already be set """
+        self.close()
+        twobit_file = os.path.join(self.index_dir, self.twobit_file)
+        if os.path.exists(twobit_file):
+            self._twobit = TwoBitFile(twobit_file)
+        self.size = {}
+        self.fasta_file = {}
+        self.index_file = {}
+        self.line_size = {}
+        self._n_runs = {}
         param_file = os.path.join(self.index_dir, self.param_file)
         with open(param_file) as f:
             for line in f.readlines():
@@ -408,19 +531,6 @@ class GenomeIndex(object):
                 self.index_file[name] = index_file
                 self.line_size[name] = int(line_size)
 
-    def _read_seq_from_fasta(self, fasta, offset, nr_lines):
-        """ retrieve a number of lines from a fasta file-object, starting at offset"""
-        fasta.seek(offset)
-        lines = [fasta.readline().strip() for _ in range(nr_lines)]
-        return "".join(lines)
-
-    def _get_offset_from_index(self, index, offset):    
-        size = len(pack(self.pack_char, 0))
-        index.seek(offset)
-        entry = index.read(size)
-        d_offset = unpack(self.pack_char, entry)[0]
-        return d_offset
-        
     def _make_gc_windows(self, fname, fasta, window):
         f = open(fname, "w")
         pc = window / 100.0
@@ -434,29 +544,204 @@ class GenomeIndex(object):
         f.close()
                 
     
-    def _read(self, index, fasta, start, end, line_size):
-        #start = start - 1
-        start_line = start // line_size 
-        size = len(pack(self.pack_char, 0))
-        nr_lines = (end - start) // line_size + 2 
-        i_offset = size * (start_line)
-        #print start
-        #print start_line
-        #print size
-        #print nr_lines
-        #print i_offset
-        
-        d_offset = self._get_offset_from_index(index, i_offset)
-        seq = self._read_seq_from_fasta(fasta, d_offset, nr_lines)
-        #print start, nr_lines, line_size, end
-        #print start - (nr_lines - 2) * line_size, end - start
-        #print seq
-        length = end - start 
-        start = start - start_line  * line_size 
-        seq = seq[start: start + length ]
-        #print seq
-        #print
-        return seq
+    def _open(self, chrom):
+        """Return the memory-mapped FASTA file of a chromosome, the offset 
+        of its sequence and the number of bytes per line, including the 
+        newline. The files stay open until close() is called.
+
+        Compressed FASTA files are read through a BgzfFile instead.
+        """
+        if chrom not in self._mapped:
+            fasta_file = self.fasta_file[chrom]
+            if fasta_file.endswith(".gz"):
+                if fasta_file not in self._mmaps:
+                    self._mmaps[fasta_file] = BgzfFile(fasta_file)
+            elif fasta_file not in self._mmaps:
+                with open(fasta_file, "rb") as f:
+                    self._mmaps[fasta_file] = mmap.mmap(
+                            f.fileno(), 0, access=mmap.ACCESS_READ)
+            
+            # only the offsets of the first two lines are needed, all 
+            # lines except the last one have the same size
+            size = calcsize(self.pack_char)
+            with open(self.index_file[chrom], "rb") as f:
+                entries = f.read(2 * size)
+            offsets = [unpack(self.pack_char, entries[i:i + size])[0] 
+                    for i in range(0, len(entries), size)]
+            offset = offsets[0] if offsets else 0
+            if len(offsets) == 2:
+                line_bytes = offsets[1] - offsets[0]
+            else:
+                line_bytes = self.line_size[chrom] + 1
+            
+            self._mapped[chrom] = (
+                    self._mmaps[fasta_file], offset, line_bytes)
+        
+        return self._mapped[chrom]
+
+    def _read(self, chrom, start, end):
+        """Read the sequence from start to end from the FASTA file."""
+        if end <= start:
+            return ""
+        
+        fasta, offset, line_bytes = self._open(chrom)
+        line_size = self.line_size[chrom]
+        
+        first_line, last_line = start // line_size, (end - 1) // line_size
+        seq = fasta[
+                offset + first_line * line_bytes + start % line_size:
+                offset + last_line * line_bytes + (end - 1) % line_size + 1]
+        if last_line > first_line:
+            seq = seq.replace(b"\n", b"").replace(b"\r", b"")
+        return seq.decode()
+    
+    def close(self):
+        """Close the FASTA and 2bit files."""
+        for fasta in self._mmaps.values():
+            fasta.close()
+        self._mmaps = {}
+        self._mapped = {}
+        if self._twobit is not None:
+            self._twobit.close()
+            self._twobit = None
+    
+    def create_twobit(self):
+        """Store the genome in 2bit format in the index directory.
+
+        The 2bit file (UCSC .2bit format) is 4 times smaller than the FASTA
+        files and is used by get_encoded_sequence(). Masked (lowercase) 
+        regions and runs of N are stored separately, all characters other 
+        than A, C, G and T are stored as N.
+        """
+        if not self.index_dir:
+            raise ValueError("Index dir is not defined!")
+        
+        fname = os.path.join(self.index_dir, self.twobit_file)
+        tmp = fname + ".tmp"
+        write_twobit(tmp, [(chrom, partial(self._read, chrom, 0, size)) 
+            for chrom, size in self.size.items()])
+        self.close()
+        os.rename(tmp, fname)
+        self._twobit = TwoBitFile(fname)
+    
+    def get_encoded_sequence(self, chrom, start, end, strand=None):
+        """Retrieve a sequence in the encoding of the scanner.
+
+        The sequence is read from the 2bit file if it exists (see 
+        create_twobit()), otherwise from the FASTA file.
+
+        Parameters
+        ----------
+        chrom : str
+            Chromosome name.
+
+        start : int
+            Start (0-based).
+
+        end : int
+            End (exclusive).
+
+        strand : str, optional
+            Return the reverse complement if strand is "-".
+
+        Returns
+        -------
+        encoded : numpy.ndarray
+            Array of uint8 with A, C, G and T as 0-3 and all other 
+            characters as 4, as scanner.encode_sequence().
+        """
+        if self._twobit is None:
+            seq = np.frombuffer(
+                    self.get_sequence(chrom, start, end).encode(), 
+                    dtype=np.uint8)
+            encoded = _SCAN_ENCODE[seq]
+        else:
+            total_size = self.size[chrom]
+            if start < 0 or start > total_size or end > total_size:
+                raise ValueError("Invalid coordinates {}:{}-{}".format(
+                    chrom, start, end))
+            encoded = self._twobit.get_encoded(chrom, start, end)
+        
+        if strand and strand == "-":
+            encoded = _SCAN_COMPLEMENT[encoded[::-1]]
+        return encoded
+    
+    def _file_position(self, chrom, start, encoded=False):
+        """Return the file and the offset in the file of a position."""
+        if encoded and self._twobit is not None:
+            return self._twobit.fname, \
+                    self._twobit._record(chrom)[-1] + start // 4
+        _, offset, line_bytes = self._open(chrom)
+        return self.fasta_file[chrom], \
+                offset + (start // self.line_size[chrom]) * line_bytes
+    
+    def get_region_sequences(self, regions, encoded=False):
+        """Retrieve the sequences of many regions.
+
+        The regions can be on any chromosome. They are read in the order 
+        of the files and the offsets in the files, and the sequences of 
+        regions on the - strand are reverse complemented together.
+
+        Parameters
+        ----------
+        regions : list
+            List of (chrom, start, end) or (chrom, start, end, strand) 
+            tuples, strand is "+" or "-".
+
+        encoded : bool, optional
+            Return the sequences in the encoding of the scanner, see 
+            get_encoded_sequence().
+
+        Returns
+        -------
+        seqs : list
+            Sequences (str, or numpy.ndarray if encoded is True), in the 
+            order of the regions.
+        """
+        regions = list(regions)
+        for region in regions:
+            chrom, start, end = region[:3]
+            if chrom not in self.size:
+                raise KeyError("chromosome {} not in index".format(chrom))
+            if start < 0 or start > self.size[chrom] or \
+                    end > self.size[chrom]:
+                raise ValueError("Invalid coordinates {}:{}-{}".format(
+                    chrom, start, end))
+        
+        # within a chromosome the offset increases with the start
+        chroms = set(region[0] for region in regions)
+        chrom_order = dict((chrom, i) for i, chrom in enumerate(sorted(
+            chroms, key=lambda c: self._file_position(c, 0, encoded))))
+        order = np.lexsort((
+            np.array([region[1] for region in regions], dtype=np.int64),
+            np.array([chrom_order[region[0]] for region in regions], 
+                dtype=np.int64)))
+        
+        seqs = [None] * len(regions)
+        for i in order.tolist():
+            chrom, start, end = regions[i][:3]
+            if encoded:
+                seqs[i] = self.get_encoded_sequence(chrom, start, end)
+            else:
+                seqs[i] = self._read(chrom, start, end)
+        
+        minus = [i for i, region in enumerate(regions) 
+                if len(region) > 3 and region[3] in ["-", -1, "-1"]]
+        if minus:
+            # the reverse complement of the concatenated sequences contains 
+            # the reverse complements of all sequences, in reverse order
+            if encoded:
+                rc_seqs = _SCAN_COMPLEMENT[
+                        np.concatenate([seqs[i] for i in minus])[::-1]]
+            else:
+                rc_seqs = rc("".join(seqs[i] for i in minus))
+            pos = 0
+            for i in reversed(minus):
+                length = len(seqs[i])
+                seqs[i] = rc_seqs[pos:pos + length]
+                pos += length
+        
+        return seqs
     
     def get_sequences(self, chr, coords):
         """ Retrieve multiple sequences from same chr (RC not possible yet)"""    
@@ -465,17 +750,11 @@ class GenomeIndex(object):
             print("Index dir is not defined!")
             sys.exit()
 
-        # retrieve all information for this specific sequence
-        fasta_file = self.fasta_file[chr]
-        index_file = self.index_file[chr]
-        line_size = self.line_size[chr]
         total_size = self.size[chr]
-        index = open(index_file, "rb")
-        fasta = open(fasta_file)
         
         seqs = []
         for coordset in coords:
-            seq = ""
+            seq = []
             for (start,end) in coordset: 
                 if start > total_size:
                     raise ValueError("%s: %s, invalid start, greater than sequence length!" % (chr,start))
@@ -486,11 +765,8 @@ class GenomeIndex(object):
                 if end > total_size:
                     raise ValueError("Invalid end, greater than sequence length!")
 
-
-                seq += self._read(index, fasta, start, end, line_size)
-            seqs.append(seq)
-        index.close()
-        fasta.close()
+                seq.append(self._read(chr, start, end))
+            seqs.append("".join(seq))
 
         return seqs
 
@@ -502,13 +778,8 @@ class GenomeIndex(object):
             print("Index dir is not defined!")
             sys.exit()
 
-        # retrieve all information for this specific sequence
-        fasta_file = self.fasta_file[chrom]
-        index_file = self.index_file[chrom]
-        line_size = self.line_size[chrom]
         total_size = self.size[chrom]
 
-        #print fasta_file, index_file, line_size, total_size
         if start > total_size:
             raise ValueError(
                     "Invalid start {0}, greater than sequence length {1} of {2}!".format(start, total_size, chrom))
@@ -520,17 +791,36 @@ class GenomeIndex(object):
             raise ValueError(
                     "Invalid end {0}, greater than sequence length {1} of {2}!".format(end, total_size, chrom))
 
-
-        index = open(index_file, "rb")
-        fasta = open(fasta_file)
-        seq = self._read(index, fasta, start, end, line_size)
-        index.close()
-        fasta.close()
+        seq = self._read(chrom, start, end)
 
         if strand and strand == "-":
             seq = rc(seq)
         return seq
 
+    def get_n_runs(self, chrom):
+        """Return the runs of N of a chromosome.
+
+        The runs are read from the 2bit file if it exists, otherwise they 
+        are determined from the sequence once.
+
+        Returns
+        -------
+        starts : numpy.ndarray
+            Starts of the runs.
+
+        ends : numpy.ndarray
+            Ends of the runs.
+        """
+        if chrom not in self._n_runs:
+            if self._twobit is not None:
+                _, starts, ends, _, _, _ = self._twobit._record(chrom)
+                starts, ends = np.array(starts), np.array(ends)
+            else:
+                starts, ends = find_n_runs(
+                        self._read(chrom, 0, self.size[chrom]))
+            self._n_runs[chrom] = (starts, ends)
+        return self._n_runs[chrom]
+
     def get_chromosomes(self):
         """ Return all sequences in the index """
         return list(self.index_file.keys())
@@ -552,10 +842,11 @@ class GenomeIndex(object):
 
         return total 
 
+_RC_TABLE = maketrans("actgACTG","tgacTGAC")
+
 def rc(seq):
     """ Return reverse complement of sequence """
-    d = maketrans("actgACTG","tgacTGAC")
-    return seq[::-1].translate(d)
+    return seq[::-1].translate(_RC_TABLE)
 
 #def track2fasta(name, bedfile, fastafile, extend_up=0, extend_down=0, use_strand=False, ignore_missing=False):
 #    """ Convert a bedfile to a fastafile, given a certain index """
@@ -645,34 +936,343 @@ def rc(seq):
 #                out.write(">%s:%s-%s\n%s\n" % (chrom, ext_start, ext_end, seq))
 #    out.close()
 
+# Signature of a UCSC .2bit file
+TWOBIT_SIGNATURE = 0x1A412743
+
+# The 2bit encoding of a .2bit file (T, C, A and G as 0-3) and of the 
+# scanner (A, C, G and T as 0-3, N as 4, see scanner.encode_sequence())
+_TWOBIT_BASES = "TCAG"
+_TWOBIT_ENCODE = np.zeros(256, dtype=np.uint8)
+for _i, _n in enumerate(_TWOBIT_BASES):
+    _TWOBIT_ENCODE[ord(_n)] = _i
+    _TWOBIT_ENCODE[ord(_n.lower())] = _i
+_SCAN_CODES = np.array([3, 1, 0, 2], dtype=np.uint8)
+
+# Scanner codes of the 4 bases of every possible byte of packed DNA, as 
+# one 32-bit value per byte
+_TWOBIT_DECODE = np.ascontiguousarray(_SCAN_CODES[
+        (np.arange(256)[:, None] >> np.array([6, 4, 2, 0])) & 3]).view(
+                np.uint32).ravel()
+
+# Bases of the scanner codes, the scanner codes of the complement and of
+# all characters
+_SCAN_BASES = np.frombuffer(b"ACGTN", dtype=np.uint8)
+_SCAN_COMPLEMENT = np.array([3, 2, 1, 0, 4], dtype=np.uint8)
+_SCAN_ENCODE = np.full(256, 4, dtype=np.uint8)
+for _i, _n in enumerate("ACGT"):
+    _SCAN_ENCODE[ord(_n)] = _i
+    _SCAN_ENCODE[ord(_n.lower())] = _i
+
+def _runs(mask):
+    """Return the starts and sizes of all runs of True in a boolean array."""
+    diff = np.diff(np.concatenate(([0], mask.astype(np.int8), [0])))
+    starts = np.nonzero(diff == 1)[0]
+    return starts, np.nonzero(diff == -1)[0] - starts
+
+def find_n_runs(seq):
+    """Return the starts and ends of the runs of N (every character other 
+    than A, C, G or T) in a sequence."""
+    seq = np.frombuffer(seq.encode(), dtype=np.uint8)
+    starts, sizes = _runs(_SCAN_ENCODE[seq] == 4)
+    return starts, starts + sizes
+
+def _in_blocks(starts, ends, start, end):
+    """Return a boolean array of the positions from start to end that are 
+    in one of the sorted, non-overlapping blocks (lists of starts and ends), 
+    or a slice if there is at most one block in the region.
+    """
+    first = bisect.bisect_right(ends, start)
+    last = bisect.bisect_left(starts, end)
+    if last - first <= 1:
+        if last == first:
+            return slice(0, 0)
+        return slice(max(starts[first] - start, 0), ends[first] - start)
+    
+    length = end - start
+    block_starts = np.maximum(np.array(starts[first:last]) - start, 0)
+    block_ends = np.minimum(np.array(ends[first:last]) - start, length)
+    return np.cumsum(np.bincount(block_starts, minlength=length + 1) - 
+            np.bincount(block_ends, minlength=length + 1))[:length] > 0
+
+def write_twobit(fname, seqs):
+    """Write sequences to a file in UCSC .2bit format.
+
+    Non-ACGT characters are stored as N and lowercase characters as masked.
+
+    Parameters
+    ----------
+    fname : str
+        Name of the output file.
+
+    seqs : list
+        List of (name, sequence) tuples, the sequences can also be 
+        functions without arguments that return the sequence.
+    """
+    names = [name.encode() for name, _ in seqs]
+    index_size = sum(len(name) + 5 for name in names)
+    
+    with open(fname, "wb") as f:
+        f.write(pack("<IIII", TWOBIT_SIGNATURE, 0, len(seqs), 0))
+        # offsets are written after the sequences
+        f.seek(16 + index_size)
+        
+        offsets = []
+        for _, seq in seqs:
+            if callable(seq):
+                seq = seq()
+            seq = np.frombuffer(seq.encode(), dtype=np.uint8)
+            upper = seq & 0xDF
+            is_base = np.zeros(len(seq), dtype=bool)
+            for n in _TWOBIT_BASES:
+                is_base |= upper == ord(n)
+            n_starts, n_sizes = _runs(~is_base)
+            mask_starts, mask_sizes = _runs(seq != upper)
+            
+            codes = _TWOBIT_ENCODE[seq]
+            codes = np.concatenate((codes, 
+                np.zeros(-len(codes) % 4, dtype=np.uint8))).reshape(-1, 4)
+            packed = (codes[:, 0] << 6) | (codes[:, 1] << 4) | \
+                    (codes[:, 2] << 2) | codes[:, 3]
+            
+            offsets.append(f.tell())
+            f.write(pack("<II", len(seq), len(n_starts)))
+            f.write(n_starts.astype("<u4").tobytes())
+            f.write(n_sizes.astype("<u4").tobytes())
+            f.write(pack("<I", len(mask_starts)))
+            f.write(mask_starts.astype("<u4").tobytes())
+            f.write(mask_sizes.astype("<u4").tobytes())
+            f.write(pack("<I", 0))
+            f.write(packed.astype(np.uint8).tobytes())
+        
+        if offsets and offsets[-1] > 0xFFFFFFFF:
+            raise ValueError("genome too large for .2bit format")
+        f.seek(16)
+        for name, offset in zip(names, offsets):
+            f.write(pack("<B", len(name)) + name + pack("<I", offset))
+
+class TwoBitFile(object):
+    """
+    Random access to the sequences in a UCSC .2bit file.
+
+    The file is memory-mapped. Sequences can be retrieved as text or 
+    directly in the encoding of the scanner (see get_encoded()).
+
+    Parameters
+    ----------
+    fname : str
+        Name of the .2bit file.
+    """
+    def __init__(self, fname):
+        self.fname = fname
+        with open(fname, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        
+        signature = unpack("<I", self._mmap[:4])[0]
+        if signature == TWOBIT_SIGNATURE:
+            self._endian = "<"
+        elif signature == unpack(">I", pack("<I", TWOBIT_SIGNATURE))[0]:
+            self._endian = ">"
+        else:
+            raise ValueError("{} is not a .2bit file".format(fname))
+        version, count = unpack(self._endian + "II", self._mmap[4:12])
+        offset_char = "Q" if version == 1 else "I"
+        
+        self._offsets = {}
+        self.names = []
+        pos = 16
+        for _ in range(count):
+            size = self._mmap[pos]
+            name = self._mmap[pos + 1:pos + 1 + size].decode()
+            pos += 1 + size
+            self._offsets[name] = unpack(self._endian + offset_char, 
+                    self._mmap[pos:pos + calcsize(offset_char)])[0]
+            pos += calcsize(offset_char)
+            self.names.append(name)
+        
+        self._records = {}
+
+    def _blocks(self, pos):
+        count = unpack(self._endian + "I", self._mmap[pos:pos + 4])[0]
+        blocks = np.frombuffer(self._mmap, dtype=self._endian + "u4", 
+                count=2 * count, offset=pos + 4).astype(np.int64)
+        return blocks[:count].tolist(), \
+                (blocks[:count] + blocks[count:]).tolist(), pos + 4 + 8 * count
+
+    def _record(self, name):
+        """Return the size, N blocks, mask blocks and offset of the packed 
+        DNA of a sequence."""
+        if name not in self._records:
+            pos = self._offsets[name]
+            size = unpack(self._endian + "I", self._mmap[pos:pos + 4])[0]
+            n_starts, n_ends, pos = self._blocks(pos + 4)
+            mask_starts, mask_ends, pos = self._blocks(pos)
+            self._records[name] = (
+                    size, n_starts, n_ends, mask_starts, mask_ends, pos + 4)
+        return self._records[name]
+
+    def size(self, name):
+        """Return the size of a sequence."""
+        return self._record(name)[0]
+
+    def get_encoded(self, name, start, end):
+        """Return a region of a sequence in the encoding of the scanner.
+
+        Parameters
+        ----------
+        name : str
+            Sequence name.
+
+        start : int
+            Start (0-based).
+
+        end : int
+            End (exclusive).
+
+        Returns
+        -------
+        encoded : numpy.ndarray
+            Array of uint8 with A, C, G and T as 0-3 and N as 4.
+        """
+        size, n_starts, n_ends, _, _, pos = self._record(name)
+        start, end = max(start, 0), min(end, size)
+        if end <= start:
+            return np.zeros(0, dtype=np.uint8)
+        
+        packed = np.frombuffer(self._mmap, dtype=np.uint8, 
+                count=(end - 1) // 4 - start // 4 + 1, offset=pos + start // 4)
+        offset = start % 4
+        encoded = _TWOBIT_DECODE[packed].view(np.uint8)[
+                offset:offset + end - start]
+        
+        encoded[_in_blocks(n_starts, n_ends, start, end)] = 4
+        return encoded
+
+    def get_sequence(self, name, start, end):
+        """Return a region of a sequence, masked regions in lowercase."""
+        seq = _SCAN_BASES[self.get_encoded(name, start, end)]
+        
+        _, _, _, mask_starts, mask_ends, _ = self._record(name)
+        seq[_in_blocks(mask_starts, mask_ends, start, end)] |= 0x20
+        return seq.tobytes().decode()
+
+    def close(self):
+        self._mmap.close()
+
 def _weighted_selection(l, n):
     """
         Selects  n random elements from a list of (weight, item) tuples.
-        Based on code snippet by Nick Johnson
     """
-    cuml = []
-    items = []
-    total_weight = 0.0
-    for weight, item in l:
-        total_weight += weight
-        cuml.append(total_weight)
-        items.append(item)
-    
-    return [items[bisect.bisect(cuml, random.random()*total_weight)] for _ in range(n)]
+    weights = np.array([weight for weight, _ in l], dtype=np.float64)
+    cuml = np.cumsum(weights)
+    idx = np.searchsorted(cuml, np.random.random(n) * cuml[-1], side="right")
+    return [l[i][1] for i in idx]
+
+def _n_before(pos, n_starts, n_ends, n_cuml):
+    """Return the number of N before every position in an array, given 
+    sorted, non-overlapping runs of N and the cumulative size of the runs,
+    starting with 0."""
+    i = np.searchsorted(n_ends, pos, side="right")
+    count = n_cuml[i]
+    inside = np.flatnonzero(i < len(n_starts))
+    inside = inside[n_starts[i[inside]] < pos[inside]]
+    count[inside] += pos[inside] - n_starts[i[inside]]
+    return count
+
+def sample_regions(sizes, n, length, n_runs=None, max_n=None):
+    """Sample random regions from a genome.
+
+    The chromosomes are sampled proportional to their size, the positions
+    uniformly. All regions are sampled at once. Regions with more than 
+    max_n N (as a fraction of the length) are rejected based on the runs of
+    N, without reading their sequence, and are sampled again.
 
-def get_random_sequences(index_dir, n=10, length=200, chroms=None):
-    g = GenomeIndex(index_dir)
-    if not chroms:
-        chroms = g.get_chromosomes()
+    Parameters
+    ----------
+    sizes : dict
+        Chromosome sizes.
 
-    sizes = dict([(x, g.get_size(x)) for x in g.get_chromosomes()])
+    n : int
+        Number of regions.
 
+    length : int
+        Length of the regions.
 
-    l = [(sizes[x], x) for x in g.get_chromosomes() if sizes[x] > length and x in chroms]
+    n_runs : dict, optional
+        Sorted, non-overlapping runs of N per chromosome, as a tuple of an 
+        array of starts and an array of ends.
+
+    max_n : float, optional
+        Maximum fraction of N in a region, requires n_runs.
+
+    Returns
+    -------
+    regions : list
+        List of (chrom, start, end) tuples.
+    """
+    chroms = [chrom for chrom in sizes if sizes[chrom] > length]
+    if len(chroms) == 0:
+        raise ValueError("no chromosomes longer than {}".format(length))
+    chrom_sizes = np.array([sizes[chrom] for chrom in chroms], dtype=np.int64)
     
-    chroms = _weighted_selection(l, n)
-    coords = [(x, int(random.random() * (sizes[x] - length))) for x in chroms]
-    return [(x[0], x[1], x[1] + length) for x in coords]
+    # all chromosomes after each other, with the runs of N of all 
+    # chromosomes on the same coordinates
+    offsets = np.concatenate(([0], np.cumsum(chrom_sizes)[:-1]))
+    if max_n is not None and n_runs is not None:
+        starts, ends = [], []
+        for chrom, offset in zip(chroms, offsets):
+            chrom_starts, chrom_ends = n_runs.get(chrom, ([], []))
+            starts.append(np.asarray(chrom_starts, dtype=np.int64) + offset)
+            ends.append(np.asarray(chrom_ends, dtype=np.int64) + offset)
+        n_starts, n_ends = np.concatenate(starts), np.concatenate(ends)
+        n_cuml = np.concatenate(([0], np.cumsum(n_ends - n_starts)))
+    else:
+        max_n = None
+    
+    cuml = np.cumsum(chrom_sizes)
+    chrom_idx = np.zeros(0, dtype=np.int64)
+    pos = np.zeros(0, dtype=np.int64)
+    for _ in range(100):
+        todo = n - len(pos)
+        if todo <= 0:
+            break
+        # sample more when regions are rejected
+        sample_n = todo if max_n is None else int(todo * 1.1) + 10
+        idx = np.searchsorted(cuml, 
+                np.random.random(sample_n) * cuml[-1], side="right")
+        new_pos = (np.random.random(sample_n) * 
+                (chrom_sizes[idx] - length)).astype(np.int64)
+        if max_n is not None:
+            n_count = _n_before(offsets[idx] + new_pos + length, 
+                    n_starts, n_ends, n_cuml) - \
+                    _n_before(offsets[idx] + new_pos, n_starts, n_ends, n_cuml)
+            keep = n_count <= max_n * length
+            idx, new_pos = idx[keep], new_pos[keep]
+        chrom_idx = np.concatenate((chrom_idx, idx[:todo]))
+        pos = np.concatenate((pos, new_pos[:todo]))
+    
+    if len(pos) < n:
+        raise ValueError("could not sample {} regions with at most {} N"
+                .format(n, max_n))
+    return [(chroms[i], p, p + length) 
+            for i, p in zip(chrom_idx.tolist(), pos.tolist())]
+
+def get_random_sequences(index_dir, n=10, length=200, chroms=None, 
+        max_n=None):
+    """Return n random regions of the genome in index_dir, as (chrom, start, 
+    end) tuples. With max_n regions with more than this fraction of N are 
+    rejected."""
+    g = GenomeIndex(index_dir)
+    if not chroms:
+        chroms = g.get_chromosomes()
+
+    sizes = dict((x, g.get_size(x)) for x in g.get_chromosomes() 
+            if x in chroms)
+    n_runs = None
+    if max_n is not None:
+        n_runs = dict((x, g.get_n_runs(x)) for x in sizes)
+    regions = sample_regions(sizes, n, length, n_runs, max_n)
+    g.close()
+    return regions
 
 if __name__ == "__main__":
     # If run directly this script will index a directory of fasta-files
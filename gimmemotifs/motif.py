@@ -17,7 +17,7 @@ import six
 
 from gimmemotifs import mytmpdir
 from gimmemotifs.config import MotifConfig
-from gimmemotifs.c_metrics import pwmscan
+from gimmemotifs.c_metrics import pwmscan_logodds
 
 # External imports
 try:
@@ -69,6 +69,7 @@ class Motif(object):
         self.consensus = ""
         self.min_score = None
         self.max_score = None
+        self.logodds = None
         
         self.id = ""
         self.config = MotifConfig()
@@ -198,7 +199,31 @@ class Motif(object):
             self.max_score = score
         
         return self.max_score
-    
+   
+    def pwm_logodds(self):
+        """
+        Return the log-odds matrices of the PWM, as used for scanning.
+
+        The matrices are computed once and cached. The forward matrix
+        is followed by the matrix of the reverse complement.
+
+        Returns
+        -------
+        logodds : tuple
+            Forward and reverse complement log-odds matrix, both packed as 
+            bytes of doubles (A, C, G, T for every position).
+        """
+        if self.logodds is None:
+            logodds = np.array(
+                    [[log(p / 0.25 + 0.01) for p in row] for row in self.pwm],
+                    dtype=np.float64)
+            self.logodds = (
+                    logodds.tobytes(), 
+                    np.ascontiguousarray(logodds[::-1, ::-1]).tobytes()
+                    )
+        
+        return self.logodds
+
     def score_kmer(self, kmer):
         if len(kmer) != len(self.pwm):
             raise Exception("incorrect k-mer length")
@@ -288,6 +313,7 @@ class Motif(object):
         self.consensus = None 
         self.min_score = None
         self.max_score = None
+        self.logodds = None
         
         return self
 
@@ -304,33 +330,33 @@ class Motif(object):
 
     def pwm_scan(self, fa, cutoff=0.9, nreport=50, scan_rc=True):
         c = self.pwm_min_score() + (self.pwm_max_score() - self.pwm_min_score()) * cutoff        
-        pwm = self.pwm
+        fwd, rev = self.pwm_logodds()
         matches = {}
         for name, seq in fa.items():
             matches[name] = [] 
-            result = pwmscan(seq.upper(), pwm, c, nreport, scan_rc)
+            result = pwmscan_logodds(seq.upper(), fwd, rev, c, nreport, scan_rc)
             for _,pos,_ in result:
                 matches[name].append(pos)
         return matches
     
     def pwm_scan_all(self, fa, cutoff=0.9, nreport=50, scan_rc=True):
         c = self.pwm_min_score() + (self.pwm_max_score() - self.pwm_min_score()) * cutoff        
-        pwm = self.pwm
+        fwd, rev = self.pwm_logodds()
         matches = {}
         for name, seq in fa.items():
             matches[name] = [] 
-            result = pwmscan(seq.upper(), pwm, c, nreport, scan_rc)
+            result = pwmscan_logodds(seq.upper(), fwd, rev, c, nreport, scan_rc)
             for score,pos,strand in result:
                 matches[name].append((pos,score,strand))
         return matches
 
     def pwm_scan_score(self, fa, cutoff=0, nreport=1, scan_rc=True):
         c = self.pwm_min_score() + (self.pwm_max_score() - self.pwm_min_score()) * cutoff        
-        pwm = self.pwm
+        fwd, rev = self.pwm_logodds()
         matches = {}
         for name, seq in fa.items():
             matches[name] = [] 
-            result = pwmscan(seq.upper(), pwm, c, nreport, scan_rc)
+            result = pwmscan_logodds(seq.upper(), fwd, rev, c, nreport, scan_rc)
             for score,_,_ in result:
                 matches[name].append(score)
         return matches
@@ -343,12 +369,13 @@ class Motif(object):
 
         c = self.pwm_min_score() + (self.pwm_max_score() - self.pwm_min_score()) * cutoff        
         pwm = self.pwm
+        fwd, rev = self.pwm_logodds()
 
         strandmap = {-1:"-","-1":"-","-":"-","1":"+",1:"+","+":"+"}
         gff_line = ("{}\tpwmscan\tmisc_feature\t{}\t{}\t{:.3f}\t{}\t.\t"
                     "motif_name \"{}\" ; motif_instance \"{}\"\n")
         for name, seq in fa.items():
-            result = pwmscan(seq.upper(), pwm, c, nreport, scan_rc)
+            result = pwmscan_logodds(seq.upper(), fwd, rev, c, nreport, scan_rc)
             for score, pos, strand in result:
                 out.write(gff_line.format( 
                     name, 
@@ -1,32 +1,41 @@
 import os
-import re
 import sys
 import gc
+import json
+import pickle
+import zlib
+from math import erfc
+from collections import namedtuple, deque
 from functools import partial
-from tempfile import mkdtemp,NamedTemporaryFile
+from glob import glob
+from tempfile import NamedTemporaryFile
 import logging
 import multiprocessing as mp
+from multiprocessing.pool import ThreadPool
 import six
 
-# "hidden" features, in development
+# optional, used by the moods scanning engine
 try:
     import MOODS.tools
     import MOODS.parsers
     import MOODS.scan
 except ImportError:
-    pass
+    MOODS = None
 
 from genomepy import Genome
 from diskcache import Cache
 import numpy as np
-from scipy.stats import scoreatpercentile
+import xxhash
+import pandas as pd
 
 from gimmemotifs.background import RandomGenomicFasta
 from gimmemotifs.config import MotifConfig,CACHE_DIR
-from gimmemotifs.fasta import Fasta
-from gimmemotifs.c_metrics import pwmscan
+from gimmemotifs.fasta import iter_fasta
+from gimmemotifs.genome_index import GenomeIndex
+from gimmemotifs.c_metrics import pwmscan_multi, pwmscan_count, pwmscan_best
 from gimmemotifs.motif import read_motifs
-from gimmemotifs.utils import parse_cutoff,as_fasta,file_checksum
+from gimmemotifs.utils import (parse_cutoff, as_fasta, file_checksum, 
+        get_seqs_type, iter_regions, region_sequences, ChunkedGenome)
 
 try:
     import copy_reg
@@ -41,14 +50,6 @@ try:
 except:
     pass
 
-# only used when using cache, should not be a requirement
-try:
-    from dogpile.cache import make_region
-    from dogpile.cache.api import NO_VALUE
-    import xxhash
-except ImportError:
-    pass 
-
 logger = logging.getLogger("gimme.scanner")
 config = MotifConfig()
 
@@ -105,191 +106,1177 @@ def parse_threshold_values(motif_file, cutoff):
         threshold[m.id] = c
     return threshold
 
-def scan_sequence(seq, motifs, nreport, scan_rc):
-    
-    ret = []
-    # scan for motifs
+# Table to encode sequences for the scanning kernels: A, C, G and T are
+# encoded as 0-3, every other character (N) as 4 
+_ENCODE_TABLE = bytearray([4] * 256)
+for _i, _n in enumerate("ACGT"):
+    _ENCODE_TABLE[ord(_n)] = _i
+    _ENCODE_TABLE[ord(_n.lower())] = _i
+_ENCODE_TABLE = bytes(_ENCODE_TABLE)
+
+def encode_sequence(seq):
+    """Encode a sequence for scanning.
+
+    The encoded sequence can be scanned with all motifs on both strands, 
+    without any conversion of the sequence by the scanning kernels. It is 
+    case-insensitive, so it can also be used as cache key.
+
+    Parameters
+    ----------
+    seq : str
+        Sequence.
+
+    Returns
+    -------
+    encoded : bytes
+        Sequence with A, C, G and T encoded as 0-3 and all other 
+        characters as 4.
+    """
+    return seq.encode("ascii", "replace").translate(_ENCODE_TABLE)
+
+# Data type of the matches when scanning with arrays=True
+MATCH_DTYPE = np.dtype([
+    ("score", np.float32), 
+    ("pos", np.int32), 
+    ("strand", np.int8),
+    ])
+
+CompiledMotifs = namedtuple(
+        "CompiledMotifs", 
+        ["fwd", "rev", "lengths", "cutoffs", "min_scores", 
+            "fwd_bound", "rev_bound", "lookahead"]
+        )
+
+# The lookahead is only used with a fixed cutoff if the estimated fraction 
+# of windows that remain after scoring half of a motif is lower than this. 
+# Otherwise checking the bound costs more time than it saves.
+LOOKAHEAD_MAX_FRACTION = 0.2
+
+def _lookahead_bound(logodds):
+    """Return the best possible score of the remaining positions of a motif.
+
+    Used to abandon the scoring of a window halfway if the score can not 
+    reach the cutoff, or the score of the n-th best match so far, anymore.
+
+    Parameters
+    ----------
+    logodds : bytes
+        Log-odds matrix, as returned by Motif.pwm_logodds().
+
+    Returns
+    -------
+    bound : bytes
+        Array (float64) with for every position of the motif the sum of 
+        the maximum scores of all positions after it.
+    """
+    matrix = np.frombuffer(logodds, dtype=np.float64).reshape(-1, 4)
+    # An N does not contribute to the score, so the score at a position 
+    # is at least 0
+    best = np.maximum(matrix.max(axis=1), 0)
+    bound = np.zeros(len(best))
+    bound[:-1] = np.cumsum(best[::-1])[::-1][1:]
+    return bound.tobytes()
+
+def _lookahead_fraction(logodds, cutoff):
+    """Estimate the fraction of random windows that can still reach the 
+    cutoff after scoring half of a motif, using a normal approximation.
+    """
+    matrix = np.frombuffer(logodds, dtype=np.float64).reshape(-1, 4)
+    bound = np.frombuffer(_lookahead_bound(logodds), dtype=np.float64)
+    half = len(matrix) // 2
+    if half == 0 or cutoff is None:
+        return 1.0
+    mean = matrix[:half].mean(axis=1).sum()
+    sd = np.sqrt(matrix[:half].var(axis=1).sum())
+    if sd == 0:
+        return 1.0
+    z = (cutoff - bound[half - 1] - mean) / (sd * np.sqrt(2))
+    return 0.5 * erfc(z)
+
+def compile_motifs(motifs):
+    """Compile motifs for scanning with pwmscan_multi().
+
+    The log-odds matrices, lengths and cutoffs of all motifs are packed in 
+    contiguous buffers, so that a sequence can be scanned with all motifs 
+    in one call. For every motif the maximum score of the remaining 
+    positions is precomputed, which is used to stop scoring windows that 
+    can not reach the cutoff (see _lookahead_bound()). With a fixed cutoff 
+    the bound is only used if the cutoff is expected to reject most windows
+    (lookahead). When only the best matches are reported (nreport > 0) or
+    the best score is determined, the bound is always used with the score 
+    of the n-th best match so far.
+
+    Parameters
+    ----------
+    motifs : list
+        List of (motif, cutoff) tuples. Motifs with a cutoff of None 
+        will not be scanned.
+
+    Returns
+    -------
+    compiled : CompiledMotifs
+        Compiled motifs.
+    """
+    fwd = []
+    rev = []
+    lengths = []
+    cutoffs = []
+    min_scores = []
+    fwd_bound = []
+    rev_bound = []
+    lookahead = []
     for motif, cutoff in motifs:
+        m_fwd, m_rev = motif.pwm_logodds()
+        fwd.append(m_fwd)
+        rev.append(m_rev)
+        fwd_bound.append(_lookahead_bound(m_fwd))
+        rev_bound.append(_lookahead_bound(m_rev))
+        lookahead.append(
+                _lookahead_fraction(m_fwd, cutoff) <= LOOKAHEAD_MAX_FRACTION 
+                and 
+                _lookahead_fraction(m_rev, cutoff) <= LOOKAHEAD_MAX_FRACTION)
+        lengths.append(len(motif.pwm))
         if cutoff is None:
-            ret.append([])
+            cutoffs.append(np.nan)
         else:
-            result = pwmscan(seq, motif.pwm, cutoff, nreport, scan_rc)
-            if cutoff <= motif.pwm_min_score() and len(result) == 0:
-                result = [[motif.pwm_min_score(), 0, 1]] * nreport
-            ret.append(result)
+            cutoffs.append(cutoff)
+        min_scores.append(motif.pwm_min_score())
+
+    return CompiledMotifs(
+            b"".join(fwd),
+            b"".join(rev),
+            np.array(lengths, dtype=np.intc).tobytes(),
+            np.array(cutoffs, dtype=np.float64).tobytes(),
+            np.array(min_scores, dtype=np.float64).tobytes(),
+            b"".join(fwd_bound),
+            b"".join(rev_bound),
+            np.array(lookahead, dtype=np.intc).tobytes(),
+            )
 
-    # return results
-    return ret
+def scan_sequence(seq, motifs, nreport, scan_rc, arrays=False):
+    """Scan a sequence with motifs.
+
+    Parameters
+    ----------
+    seq : str or bytes-like
+        Sequence, or sequence encoded with encode_sequence(). Any 
+        bytes-like object with an encoded sequence can be used, for 
+        instance a shared memory buffer.
+
+    motifs : list or CompiledMotifs
+        List of (motif, cutoff) tuples or motifs compiled by compile_motifs().
 
-def scan_region(region, genome, motifs, nreport, scan_rc):
+    nreport : int
+        Maximum number of matches to report per motif.
+
+    scan_rc : bool
+        Scan the reverse complement.
     
-    # retrieve sequence
-    chrom,start,end = re.split(r'[:-]', region)
-    seq = genome[chrom][int(start): int(end)].seq.upper()
+    arrays : bool, optional
+        Return the matches as NumPy arrays instead of lists.
+
+    Returns
+    -------
+    result : list or tuple
+        List with a list of [score, pos, strand] for every motif. If arrays
+        is True, a tuple of a structured array of all matches (with 
+        MATCH_DTYPE) and an array with offsets. The matches of motif i are
+        matches[offsets[i]:offsets[i + 1]].
+    """
+    if isinstance(seq, str):
+        seq = encode_sequence(seq)
+    if not isinstance(motifs, CompiledMotifs):
+        motifs = compile_motifs(motifs)
     
-    return scan_sequence(seq, motifs, nreport, scan_rc)
+    if arrays:
+        matches, offsets = pwmscan_multi(seq, motifs, nreport, scan_rc, True)
+        return (
+                np.frombuffer(matches, dtype=MATCH_DTYPE), 
+                np.frombuffer(offsets, dtype=np.int64)
+                )
 
-def scan_seq_mult(seqs, motifs, nreport, scan_rc):
-    ret = []
-    for seq in seqs:
-        result = scan_sequence(seq.upper(), motifs, nreport, scan_rc)
-        ret.append(result)
-    return ret
+    return pwmscan_multi(seq, motifs, nreport, scan_rc)
 
-def scan_region_mult(regions, genome, motifs, nreport, scan_rc):
-    ret = []
-    for region in regions:
-        result = scan_region(region, genome, motifs, nreport, scan_rc)
-        ret.append(result)
-    return ret
+def count_sequence(seq, motifs, nreport, scan_rc):
+    """Count the matches of motifs in a sequence.
 
+    The counts are identical to the number of matches returned by 
+    scan_sequence(), but the matches themselves are not stored.
 
-def scan_fa_with_motif_moods(fo, motifs, matrices, bg, thresholds, nreport, scan_rc=True):
+    Parameters
+    ----------
+    seq : str or bytes-like
+        Sequence, or sequence encoded with encode_sequence(). Any 
+        bytes-like object with an encoded sequence can be used, for 
+        instance a shared memory buffer.
 
-    scanner = MOODS.scan.Scanner(7)
-    scanner.set_motifs(matrices, bg, thresholds)
+    motifs : list or CompiledMotifs
+        List of (motif, cutoff) tuples or motifs compiled by compile_motifs().
 
-    ret = []
-    for name, seq in fo.items():
-        l = len(seq)
-
-        scan_seq = seq.upper()
-        if scan_rc:
-            scan_seq = "".join((scan_seq, "N"*50, rc(scan_seq)))
-        results = scanner.scan_max_hits(scan_seq, nreport)
-        for motif,result in zip(motifs, results):
-            matches = []
-            for match in result:
-                strand = 1
-                pos = match.pos
-                if scan_rc:
-                    if pos > l:
-                        pos = l - (pos - l - 50) - len(motif)
-                        strand = -1
-                matches.append((pos, match.score, strand))
-            ret.append((motif, {name: matches}))
+    nreport : int
+        Maximum number of matches to count per motif.
 
-    return ret
+    scan_rc : bool
+        Scan the reverse complement.
+    
+    Returns
+    -------
+    counts : numpy.ndarray
+        Array with the number of matches of every motif.
+    """
+    if isinstance(seq, str):
+        seq = encode_sequence(seq)
+    if not isinstance(motifs, CompiledMotifs):
+        motifs = compile_motifs(motifs)
+    
+    return np.frombuffer(
+            pwmscan_count(seq, motifs, nreport, scan_rc), dtype=np.int32)
 
-def scan_fa_with_motif_moods_count(fo, motifs, matrices, bg, thresholds, nreport, scan_rc=True):
-    scanner = MOODS.scan.Scanner(7)
-    scanner.set_motifs(matrices, bg, thresholds)
+def best_score_sequence(seq, motifs, scan_rc):
+    """Return the best score of motifs in a sequence.
 
-    ret = []
-    for name, seq in fo.items():
-        l = len(seq)
+    The cutoffs of the motifs are not used.
+
+    Parameters
+    ----------
+    seq : str or bytes-like
+        Sequence, or sequence encoded with encode_sequence(). Any 
+        bytes-like object with an encoded sequence can be used, for 
+        instance a shared memory buffer.
+
+    motifs : list or CompiledMotifs
+        List of (motif, cutoff) tuples or motifs compiled by compile_motifs().
+
+    scan_rc : bool
+        Scan the reverse complement.
+    
+    Returns
+    -------
+    scores : numpy.ndarray
+        Array with the best score of every motif.
+    """
+    if isinstance(seq, str):
+        seq = encode_sequence(seq)
+    if not isinstance(motifs, CompiledMotifs):
+        motifs = compile_motifs(motifs)
+    
+    return np.frombuffer(
+            pwmscan_best(seq, motifs, scan_rc), dtype=np.float64)
+
+def _scan_sequence_mode(seq, motifs, nreport, scan_rc, mode):
+    if mode == "count":
+        return count_sequence(seq, motifs, nreport, scan_rc)
+    elif mode == "best_score":
+        return best_score_sequence(seq, motifs, scan_rc)
+    elif mode == "arrays":
+        return scan_sequence(seq, motifs, nreport, scan_rc, arrays=True)
+    elif mode == "matches":
+        return scan_sequence(seq, motifs, nreport, scan_rc)
+    
+    raise ValueError("Unknown scan mode {}".format(mode))
+
+class ScanEngine(object):
+    """Base class of the scanning engines.
+
+    An engine scans batches of encoded sequences (see encode_sequence())
+    with motifs compiled by compile(). All engines should give results 
+    that are identical to those of scan_sequence(), count_sequence() and
+    best_score_sequence(). Engines are sent to the worker processes 
+    together with the sequences, so they should be picklable.
+
+    To add an engine, subclass ScanEngine and add it to SCAN_ENGINES.
+    """
+    
+    name = None
+
+    def compile(self, motifs):
+        """Compile motifs for scanning.
+
+        Parameters
+        ----------
+        motifs : list
+            List of (motif, cutoff) tuples. Motifs with a cutoff of None 
+            will not be scanned.
+
+        Returns
+        -------
+        compiled : CompiledMotifs
+            Compiled motifs, which are also used for the cache keys.
+        """
+        return compile_motifs(motifs)
 
-        scan_seq = seq.upper()
-        if scan_rc:
-            scan_seq = "".join((scan_seq, "N"*50, rc(scan_seq)))
-        results = scanner.counts_max_hits(scan_seq, nreport)
-        ret.append((name, results))
+    def scan(self, seqs, motifs, nreport, scan_rc, arrays=False):
+        """Return the matches of motifs in a batch of encoded sequences.
 
+        Returns a list with the result of scan_sequence() for every 
+        sequence.
+        """
+        raise NotImplementedError()
+
+    def count(self, seqs, motifs, nreport, scan_rc):
+        """Return the number of matches of motifs in a batch of encoded 
+        sequences.
+
+        Returns a list with the result of count_sequence() for every 
+        sequence.
+        """
+        raise NotImplementedError()
+
+    def best_score(self, seqs, motifs, scan_rc):
+        """Return the best score of motifs in a batch of encoded sequences.
+
+        Returns a list with the result of best_score_sequence() for every 
+        sequence.
+        """
+        raise NotImplementedError()
+
+class CScanEngine(ScanEngine):
+    """Scan with the C kernels of gimmemotifs.c_metrics (default)."""
+    
+    name = "c"
+
+    def scan(self, seqs, motifs, nreport, scan_rc, arrays=False):
+        return [scan_sequence(seq, motifs, nreport, scan_rc, arrays) 
+                for seq in seqs]
+
+    def count(self, seqs, motifs, nreport, scan_rc):
+        return [count_sequence(seq, motifs, nreport, scan_rc) 
+                for seq in seqs]
+
+    def best_score(self, seqs, motifs, scan_rc):
+        return [best_score_sequence(seq, motifs, scan_rc) for seq in seqs]
+
+# Matches with a score <= NO_SCORE are not reported when only the best 
+# matches are reported, as in the C kernels
+NO_SCORE = -100
+
+# Encoded nucleotides back to the sequence that is scanned by MOODS
+_DECODE_TABLE = bytes.maketrans(bytes(bytearray(range(5))), b"ACGTN")
+
+def _compiled_matrices(motifs):
+    """Yield the forward and reverse log-odds matrix, the cutoff and the 
+    minimum score of compiled motifs. The matrices are arrays with a row
+    per position, and a fifth column of zeros for N.
+    """
+    lengths = np.frombuffer(motifs.lengths, dtype=np.intc)
+    fwd = np.frombuffer(motifs.fwd, dtype=np.float64).reshape(-1, 4)
+    rev = np.frombuffer(motifs.rev, dtype=np.float64).reshape(-1, 4)
+    fwd = np.hstack((fwd, np.zeros((len(fwd), 1))))
+    rev = np.hstack((rev, np.zeros((len(rev), 1))))
+    cutoffs = np.frombuffer(motifs.cutoffs, dtype=np.float64)
+    min_scores = np.frombuffer(motifs.min_scores, dtype=np.float64)
+    start = 0
+    for i, length in enumerate(lengths):
+        yield (fwd[start:start + length], rev[start:start + length], 
+                cutoffs[i], min_scores[i])
+        start += length
+
+def _window_scores(seq, logodds, positions):
+    """Return the scores of the windows starting at positions.
+
+    The log-odds matrix has a fifth column of zeros for N (see 
+    _compiled_matrices()). The positions of a window are added in the same
+    order as in the C kernels (cumsum() is sequential), so the scores are 
+    identical.
+    """
+    if len(positions) == 0:
+        return np.zeros(0)
+    length = len(logodds)
+    windows = seq[positions[:, np.newaxis] + np.arange(length)]
+    return np.cumsum(logodds[np.arange(length), windows], axis=1)[:, -1]
+
+class MoodsScanEngine(ScanEngine):
+    """Scan with MOODS.
+
+    MOODS finds the candidate matches with its lookahead filtering 
+    algorithm, with a cutoff that is slightly lower to allow for rounding
+    differences. The candidates, and the windows with an N that MOODS 
+    skips, are scored in the same way as the C kernels, which gives 
+    identical results. The MOODS scanner is set up for every batch, as it
+    can not be sent to other processes. The best score is not a cutoff 
+    based search and is calculated for all windows.
+
+    Parameters
+    ----------
+    window_size : int, optional
+        Window size of the MOODS lookahead filter.
+    """
+    
+    name = "moods"
+
+    # Lower MOODS cutoff, same as the tolerance of the C lookahead
+    TOLERANCE = 1e-6
+
+    def __init__(self, window_size=7):
+        if MOODS is None:
+            raise ImportError(
+                    "The moods engine needs MOODS (pip install MOODS-python)")
+        self.window_size = window_size
+
+    def _matches(self, seqs, motifs, nreport, scan_rc):
+        """Yield the positions, scores and strands of the matches of every
+        motif for every sequence.
+        """
+        matrices = list(_compiled_matrices(motifs))
+        scanned = [i for i, m in enumerate(matrices) if not np.isnan(m[2])]
+        
+        # MOODS misses the last window of a sequence when the window size
+        # is larger than the motif, so shorter motifs are scanned with a 
+        # smaller window
+        groups = {}
+        for i in scanned:
+            window_size = min(self.window_size, len(matrices[i][0]))
+            groups.setdefault(window_size, []).append(i)
+        
+        scanners = []
+        for window_size, group in sorted(groups.items()):
+            moods_matrices = []
+            thresholds = []
+            for i in group:
+                fwd, rev, cutoff, _ = matrices[i]
+                for logodds in [fwd, rev][:scan_rc + 1]:
+                    moods_matrices.append(logodds[:, :4].transpose().tolist())
+                    thresholds.append(cutoff - self.TOLERANCE)
+            scanner = MOODS.scan.Scanner(window_size)
+            scanner.set_motifs(moods_matrices, [0.25] * 4, thresholds)
+            scanners.append((scanner, group))
+
+        for seq in seqs:
+            if isinstance(seq, str):
+                seq = encode_sequence(seq)
+            seq = bytes(seq)
+            
+            # hits of every scanned motif, forward strand first
+            hits = {}
+            moods_seq = seq.translate(_DECODE_TABLE).decode("ascii")
+            for scanner, group in scanners:
+                results = iter(scanner.scan(moods_seq))
+                for i in group:
+                    hits[i] = [next(results) for _ in range(scan_rc + 1)]
+            
+            seq = np.frombuffer(seq, dtype=np.uint8)
+            # number of N before every position, MOODS skips windows with N
+            n_before = np.concatenate(([0], np.cumsum(seq > 3)))
+            
+            ret = [(np.zeros(0, int), np.zeros(0), np.zeros(0, int))] * len(
+                    matrices)
+            for i in scanned:
+                fwd, rev, cutoff, min_score = matrices[i]
+                length = len(fwd)
+                with_n = np.nonzero(
+                        n_before[length:] - n_before[:-length] > 0)[0]
+                
+                pos = []
+                scores = []
+                strands = []
+                for strand, logodds, strand_hits in zip(
+                        [1, -1], [fwd, rev], hits[i]):
+                    candidates = np.sort(np.fromiter(
+                        (hit.pos for hit in strand_hits), dtype=int))
+                    if len(with_n) > 0:
+                        candidates = np.union1d(candidates, with_n)
+                    s = _window_scores(seq, logodds, candidates)
+                    match = s >= cutoff
+                    if nreport > 0:
+                        match &= s > NO_SCORE
+                    pos.append(candidates[match])
+                    scores.append(s[match])
+                    strands.append(np.full(match.sum(), strand, dtype=int))
+                
+                pos = np.concatenate(pos)
+                scores = np.concatenate(scores)
+                strands = np.concatenate(strands)
+                if nreport > 0:
+                    # best matches first, ties in the order they were found
+                    best = np.argsort(-scores, kind="mergesort")[:nreport]
+                    pos, scores, strands = pos[best], scores[best], strands[best]
+                
+                if len(pos) == 0 and cutoff <= min_score:
+                    # always report a match when the cutoff is the minimum 
+                    # score
+                    pos = np.zeros(nreport, dtype=int)
+                    scores = np.full(nreport, min_score)
+                    strands = np.ones(nreport, dtype=int)
+                
+                ret[i] = (pos, scores, strands)
+            yield ret
+
+    def scan(self, seqs, motifs, nreport, scan_rc, arrays=False):
+        result = []
+        for ret in self._matches(seqs, motifs, nreport, scan_rc):
+            if arrays:
+                matches = np.zeros(
+                        sum(len(pos) for pos, _, _ in ret), dtype=MATCH_DTYPE)
+                offsets = np.zeros(len(ret) + 1, dtype=np.int64)
+                for i, (pos, scores, strands) in enumerate(ret):
+                    offsets[i + 1] = offsets[i] + len(pos)
+                    matches[offsets[i]:offsets[i + 1]] = list(
+                            zip(scores, pos, strands))
+                result.append((matches, offsets))
+            else:
+                result.append([
+                    [[float(score), int(p), int(strand)] 
+                        for p, score, strand in zip(pos, scores, strands)]
+                    for pos, scores, strands in ret])
+        return result
+
+    def count(self, seqs, motifs, nreport, scan_rc):
+        return [np.array([len(pos) for pos, _, _ in ret], dtype=np.int32) 
+                for ret in self._matches(seqs, motifs, nreport, scan_rc)]
+
+    def best_score(self, seqs, motifs, scan_rc):
+        matrices = list(_compiled_matrices(motifs))
+        result = []
+        for seq in seqs:
+            if isinstance(seq, str):
+                seq = encode_sequence(seq)
+            seq = np.frombuffer(bytes(seq), dtype=np.uint8)
+            
+            scores = np.zeros(len(matrices))
+            for i, (fwd, rev, _, min_score) in enumerate(matrices):
+                positions = np.arange(max(len(seq) - len(fwd) + 1, 0))
+                best = NO_SCORE
+                for logodds in [fwd, rev][:scan_rc + 1]:
+                    s = _window_scores(seq, logodds, positions)
+                    if len(s) > 0:
+                        best = max(best, s.max())
+                if not best > NO_SCORE:
+                    best = min_score
+                scores[i] = best
+            result.append(scores)
+        return result
+
+# Scanning engines that can be used by name, see Scanner
+SCAN_ENGINES = {
+        CScanEngine.name: CScanEngine,
+        MoodsScanEngine.name: MoodsScanEngine,
+        }
+
+def _scan_batch(seqs, motifs, nreport, scan_rc, mode, engine=None):
+    if engine is None:
+        engine = CScanEngine()
+    if mode == "count":
+        return engine.count(seqs, motifs, nreport, scan_rc)
+    elif mode == "best_score":
+        return engine.best_score(seqs, motifs, scan_rc)
+    elif mode == "arrays":
+        return engine.scan(seqs, motifs, nreport, scan_rc, arrays=True)
+    elif mode == "matches":
+        return engine.scan(seqs, motifs, nreport, scan_rc)
+    
+    raise ValueError("Unknown scan mode {}".format(mode))
+
+def scan_seq_mult(seqs, motifs, nreport, scan_rc, mode="matches", 
+        engine=None):
+    """Scan multiple sequences.
+
+    The result per sequence depends on the mode: "matches" and "arrays" 
+    return the result of scan_sequence() (as lists or arrays), "count" and
+    "best_score" the result of count_sequence() and best_score_sequence().
+    The sequences are scanned by engine, a ScanEngine instance, by default
+    with the C kernels.
+    """
+    return _scan_batch(seqs, motifs, nreport, scan_rc, mode, engine)
+
+# Target amount of scanning work per chunk of sequences that is sent to a
+# worker, as the number of sequence positions times the number of motif
+# positions. Large enough to make the overhead of sending a chunk small, 
+# small enough to keep all workers busy.
+CHUNK_WORK = 2e7
+
+# Maximum number of sequences per chunk
+MAX_CHUNK_SIZE = 1000
+
+def _motif_length(motifs):
+    """Return the total length of compiled motifs."""
+    return int(np.frombuffer(motifs.lengths, dtype=np.intc).sum())
+
+# Size of the tiles a genome is split in by Scanner.scan_genome()
+TILE_SIZE = 1000000
+
+# Hits of a genome scan: position on the chromosome, index of the motif, 
+# score and strand
+GENOME_HIT_DTYPE = np.dtype([
+    ("pos", np.int32), 
+    ("motif", np.int32), 
+    ("score", np.float64), 
+    ("strand", np.int8),
+    ])
+
+# The index of a genome scan has the offset of the first hit of every 
+# HIT_BIN_SIZE nucleotides of every chromosome
+HIT_BIN_SIZE = 100000
+
+def genome_tiles(genome, tile_size=TILE_SIZE, overlap=0):
+    """Split the chromosomes of a genome in overlapping tiles.
+
+    Parameters
+    ----------
+    genome : Genome instance
+        Genome.
+
+    tile_size : int, optional
+        Size of the tiles, without the overlap.
+
+    overlap : int, optional
+        Number of nucleotides every tile overlaps with the next tile.
+
+    Yields
+    ------
+    tile : tuple
+        Chromosome, start and end of the tile, and the end of the part of 
+        the tile that does not overlap with the next tile. Only hits that 
+        start before this position belong to the tile.
+    """
+    for chrom in genome.keys():
+        size = len(genome[chrom])
+        for start in range(0, size, tile_size):
+            core_end = min(start + tile_size, size)
+            yield chrom, start, min(core_end + overlap, size), core_end
+
+def _tile_length(tile):
+    """Return the length of a tile from genome_tiles()."""
+    return tile[2] - tile[1]
+
+def scan_tile_mult(tiles, genome, motifs, scan_rc, engine=None):
+    """Scan genome tiles and return all hits above the cutoffs.
+
+    Returns a GENOME_HIT_DTYPE array for every tile, with the hits that 
+    start before the end of the part of the tile that does not overlap, 
+    sorted by position, motif and strand. The genome is a genome name or
+    FASTA file, which is opened by every worker.
+    """
+    genome = Genome(genome)
+    seqs = []
+    for chrom, start, end, _ in tiles:
+        seqs.append(encode_sequence(genome[chrom][start:end].seq))
+    
+    matrices = list(_compiled_matrices(motifs))
+    ret = []
+    results = _scan_batch(seqs, motifs, 0, scan_rc, "arrays", engine)
+    for seq, (_, start, _, core_end), (matches, offsets) in zip(
+            seqs, tiles, results):
+        hits = np.zeros(len(matches), dtype=GENOME_HIT_DTYPE)
+        hits["pos"] = matches["pos"] + start
+        hits["motif"] = np.repeat(
+                np.arange(len(offsets) - 1), np.diff(offsets))
+        hits["strand"] = matches["strand"]
+        # the scores of the matches are float32, the hits get the same 
+        # scores as scanning a sequence
+        seq = np.frombuffer(seq, dtype=np.uint8)
+        for i, (fwd, rev, _, _) in enumerate(matrices):
+            m = matches[offsets[i]:offsets[i + 1]]
+            scores = np.zeros(len(m))
+            for strand, logodds in [(1, fwd), (-1, rev)]:
+                idx = np.nonzero(m["strand"] == strand)[0]
+                scores[idx] = _window_scores(
+                        seq, logodds, m["pos"][idx].astype(np.int64))
+            hits["score"][offsets[i]:offsets[i + 1]] = scores
+        hits = hits[hits["pos"] < core_end]
+        ret.append(hits[np.lexsort(
+            (-hits["strand"], hits["motif"], hits["pos"]))])
     return ret
 
-def calc_threshold_moods(m, c):
-    m_min = MOODS.tools.min_score(m)
-    m_max = MOODS.tools.max_score(m)
+def read_genome_hits(fname):
+    """Read the hits of a genome scan written by Scanner.scan_genome().
+
+    Parameters
+    ----------
+    fname : str
+        Name of the binary hit file.
 
-    return m_min + (m_max - m_min) * c
+    Returns
+    -------
+    index : dict
+        Index of the hits, with the motifs and the genome. For every 
+        chromosome in "chroms", the offsets of the first and last hit 
+        ("start" and "end") and of the first hit in every bin of bin_size 
+        nucleotides ("bins").
+
+    hits : numpy.memmap
+        Memory-mapped GENOME_HIT_DTYPE array of all hits.
+    """
+    with open(fname + ".json") as f:
+        index = json.load(f)
+    if index["end"] == 0:
+        return index, np.zeros(0, dtype=GENOME_HIT_DTYPE)
+    return index, np.memmap(fname, dtype=GENOME_HIT_DTYPE, mode="r")
+
+# Directory of the genome-wide hit indexes, see Scanner.build_hit_index()
+HIT_INDEX_DIR = os.path.join(CACHE_DIR, "hits")
+
+def _hit_index_prefix(motifs, genome, scan_rc):
+    """Return the first part of the name of the hit indexes of compiled 
+    motifs in a genome, which does not depend on the cutoffs. The genome 
+    is identified by its file name, size and modification time.
+    """
+    h = xxhash.xxh64()
+    for buf in (motifs.fwd, motifs.rev, motifs.lengths):
+        h.update(buf)
+    stat = os.stat(genome.filename)
+    h.update(str((genome.filename, stat.st_size, stat.st_mtime, 
+        bool(scan_rc))).encode())
+    return h.hexdigest()
+
+class HitIndex(object):
+    """
+    Genome-wide hits of motifs, as written by Scanner.scan_genome(), for 
+    region queries.
 
-def scan_it_moods(infile, motifs, cutoff, bgfile, nreport=1, scan_rc=True, pvalue=None, count=False):
-    tmpdir = mkdtemp()
-    matrices = []
-    pseudocount = 1e-3
-    #sys.stderr.write("bgfile: {}\n".format(bgfile))
-    bg = MOODS.tools.bg_from_sequence_dna("".join(Fasta(bgfile).seqs), 1)
+    The hits are memory-mapped. The hits in a region are found with the
+    bins of the index and a binary search on the positions.
 
-    for motif in motifs:
-        pfmname = os.path.join(tmpdir, "{}.pfm".format(motif.id))
-        with open(pfmname, "w") as f:
-            matrix = np.array(motif.pwm).transpose()
-            for line in [" ".join([str(x) for x in row]) for row in matrix]:
-                f.write("{}\n".format(line))
+    Parameters
+    ----------
+    fname : str
+        Name of the binary hit file.
+    """
+    
+    def __init__(self, fname):
+        self.fname = fname
+        index, self.hits = read_genome_hits(fname)
+        self.motif_ids = index["motifs"]
+        self.lengths = np.array(index["motif_lengths"], dtype=np.int64)
+        self.thresholds = index["thresholds"]
+        self.bin_size = index["bin_size"]
+        self.chroms = {}
+        for c in index["chroms"]:
+            self.chroms[c["name"]] = (
+                    c["start"], c["end"], np.array(c["bins"], dtype=np.int64))
+
+    def region_hits(self, chrom, start, end):
+        """Return the hits that are completely within a region.
+
+        Parameters
+        ----------
+        chrom : str
+            Chromosome.
+
+        start : int
+            Start of the region (0-based).
+
+        end : int
+            End of the region.
+
+        Returns
+        -------
+        hits : numpy.ndarray
+            GENOME_HIT_DTYPE array of the hits, sorted by position, motif 
+            and strand.
+        """
+        if chrom not in self.chroms or end <= start:
+            return np.zeros(0, dtype=GENOME_HIT_DTYPE)
+        
+        c_start, c_end, bins = self.chroms[chrom]
+        lo = c_end
+        if start // self.bin_size < len(bins):
+            lo = bins[start // self.bin_size]
+        hi = c_end
+        if end // self.bin_size + 1 < len(bins):
+            hi = bins[end // self.bin_size + 1]
+        
+        pos = self.hits["pos"][lo:hi]
+        i = lo + np.searchsorted(pos, start)
+        j = lo + np.searchsorted(pos, end)
+        hits = np.array(self.hits[i:j])
+        return hits[hits["pos"] + self.lengths[hits["motif"]] <= end]
 
-        matrices.append(MOODS.parsers.pfm_log_odds(pfmname, bg, pseudocount))
+    def covers(self, thresholds):
+        """Return True if the index contains all hits above thresholds.
 
-    thresholds = []
-    if pvalue is not None:
-        thresholds = [MOODS.tools.threshold_from_p(m, bg, float(pvalue)) for m in matrices]
-        #sys.stderr.write("{}\n".format(thresholds))
+        Parameters
+        ----------
+        thresholds : list
+            Threshold of every motif, None for motifs that are not scanned.
+        """
+        for index_threshold, threshold in zip(self.thresholds, thresholds):
+            if threshold is None:
+                continue
+            if index_threshold is None or index_threshold > threshold:
+                return False
+        return True
+
+def _region_matches(hits, start, cutoffs, min_scores, nreport, mode):
+    """Return the matches of motifs in a region from the hits in the region 
+    (see HitIndex.region_hits()), in the same format as scanning the 
+    sequence of the region. Cutoffs is an array with the cutoff of every 
+    motif, NaN for motifs that are not scanned.
+    """
+    n_motifs = len(cutoffs)
+    hits = hits[hits["score"] >= cutoffs[hits["motif"]]]
+    if nreport > 0:
+        hits = hits[hits["score"] > NO_SCORE]
+        # best matches first, forward strand first, as the C kernels
+        hits = hits[np.lexsort((hits["pos"], -hits["strand"], 
+            -hits["score"], hits["motif"]))]
+        first = np.searchsorted(hits["motif"], np.arange(n_motifs))
+        hits = hits[np.arange(len(hits)) - first[hits["motif"]] < nreport]
     else:
-        thresholds = [calc_threshold_moods(m, float(cutoff)) for m in matrices]
-
-    scanner = MOODS.scan.Scanner(7)
-    scanner.set_motifs(matrices, bg, thresholds)
-
-    config = MotifConfig()
-    ncpus =  int(config.get_default_params()['ncpus'])
-    fa = Fasta(infile)
-    chunk = 500
-    if (len(fa) / chunk) < ncpus:
-        chunk = len(fa) / (ncpus + 1)
-
-    jobs = []
-    func = scan_fa_with_motif_moods
-    if count:
-        func = scan_fa_with_motif_moods_count
-
-
-    pool = Pool()
-    for i in range(0, len(fa), chunk):
-        jobs.append(pool.apply_async(
-                                          func,
-                                          (fa[i:i + chunk],
-                                          motifs,
-                                          matrices,
-                                          bg,
-                                          thresholds,
-                                          nreport,
-                                          scan_rc,
-                                          )))
-
-    for job in jobs:
-        for ret in job.get():
-            yield ret
+        hits = hits[np.lexsort((hits["pos"], -hits["strand"], hits["motif"]))]
+    
+    matches = np.zeros(len(hits), dtype=GENOME_HIT_DTYPE)
+    matches["pos"] = hits["pos"] - start
+    matches["motif"] = hits["motif"]
+    matches["score"] = hits["score"]
+    matches["strand"] = hits["strand"]
+    
+    # always report a match when the cutoff is the minimum score
+    counts = np.bincount(matches["motif"], minlength=n_motifs)
+    with np.errstate(invalid="ignore"):
+        no_match = np.nonzero((counts == 0) & (cutoffs <= min_scores))[0]
+    if len(no_match) > 0 and nreport > 0:
+        extra = np.zeros(len(no_match) * nreport, dtype=GENOME_HIT_DTYPE)
+        extra["motif"] = np.repeat(no_match, nreport)
+        extra["score"] = min_scores[extra["motif"]]
+        extra["strand"] = 1
+        matches = np.concatenate((matches, extra))
+        matches = matches[np.argsort(matches["motif"], kind="mergesort")]
+        counts[no_match] = nreport
+    
+    offsets = np.zeros(n_motifs + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(counts)
+    if mode == "count":
+        return counts.astype(np.int32)
+    elif mode == "arrays":
+        result = np.zeros(len(matches), dtype=MATCH_DTYPE)
+        result["score"] = matches["score"]
+        result["pos"] = matches["pos"]
+        result["strand"] = matches["strand"]
+        return result, offsets
+    elif mode == "matches":
+        rows = [list(row) for row in zip(matches["score"].tolist(), 
+            matches["pos"].tolist(), matches["strand"].tolist())]
+        return [rows[offsets[i]:offsets[i + 1]] for i in range(n_motifs)]
+    
+    raise ValueError("Unknown scan mode {}".format(mode))
+
+# Background score distributions contain all scores in the highest 
+# DISTRIBUTION_TAIL fraction, which are used for thresholds at a low FPR,
+# and every DISTRIBUTION_STEP-th score of the other scores.
+DISTRIBUTION_TAIL = 0.05
+DISTRIBUTION_STEP = 10
+
+def score_distribution(scores):
+    """Return a compact distribution of background scores.
+
+    Parameters
+    ----------
+    scores : array_like
+        Scores, for instance the best score of a motif in every background
+        sequence.
+
+    Returns
+    -------
+    distribution : tuple
+        Tuple of the number of scores, the ranks of the stored scores 
+        (in ascending order) and the stored scores.
+    """
+    scores = np.sort(np.asarray(scores, dtype=np.float64))
+    n = len(scores)
+    # first rank that is needed for the thresholds in the tail
+    tail = max(int((1 - DISTRIBUTION_TAIL) * (n - 1)) - 1, 0)
+    ranks = np.union1d(
+            np.arange(0, tail, DISTRIBUTION_STEP), 
+            np.arange(tail, n)
+            ).astype(np.int32)
+    return n, ranks, scores[ranks]
+
+def distribution_threshold(distribution, fpr):
+    """Return the score threshold at a FPR from a background distribution.
+
+    In the tail of the distribution the threshold is identical to the 
+    percentile of all scores, as given by scipy's scoreatpercentile(). 
+    Below the tail it is interpolated.
+
+    Parameters
+    ----------
+    distribution : tuple
+        Distribution as returned by score_distribution().
+
+    fpr : float
+        FPR, between 0.0 and 1.0.
+
+    Returns
+    -------
+    threshold : float
+        Score threshold.
+    """
+    n, ranks, scores = distribution
+    rank = (100 - 100 * fpr) / 100.0 * (n - 1)
+    i = np.searchsorted(ranks, rank, side="right") - 1
+    if rank == ranks[i]:
+        return float(scores[i])
+    # same weighted interpolation as scoreatpercentile()
+    weights = np.array([ranks[i + 1] - rank, rank - ranks[i]], float)
+    return float(np.add.reduce(scores[i:i + 2] * weights) / weights.sum())
+
+def logodds_distribution(logodds, background=None, precision=0.01):
+    """Return the distribution of motif scores in random sequence.
+
+    The scores are rounded to multiples of precision, and the exact
+    distribution of the rounded scores is calculated with dynamic 
+    programming, as in TFM-Pvalue and FIMO.
+
+    Parameters
+    ----------
+    logodds : bytes
+        Log-odds matrix, as returned by Motif.pwm_logodds().
+
+    background : list, optional
+        Frequencies of A, C, G and T in random sequence, 0.25 by default.
+
+    precision : float, optional
+        Precision of the scores.
+
+    Returns
+    -------
+    offset : int
+        Lowest possible rounded score, divided by precision.
+
+    pdf : numpy.ndarray
+        Probability of the rounded scores offset * precision, 
+        (offset + 1) * precision, and so on.
+    """
+    if background is None:
+        background = [0.25] * 4
+    background = np.asarray(background, dtype=np.float64)
+    
+    matrix = np.frombuffer(logodds, dtype=np.float64).reshape(-1, 4)
+    matrix = np.round(matrix / precision).astype(np.int64)
+    row_min = matrix.min(axis=1)
+    matrix = matrix - row_min[:, np.newaxis]
+    
+    pdf = np.zeros(matrix.max(axis=1).sum() + 1)
+    pdf[0] = 1.0
+    size = 1
+    for row in matrix:
+        new_pdf = np.zeros_like(pdf)
+        for n in range(4):
+            new_pdf[row[n]:row[n] + size] += pdf[:size] * background[n]
+        pdf = new_pdf
+        size += row.max()
+    
+    return int(row_min.sum()), pdf[:size]
+
+def pvalue_threshold(motif, pvalue, background=None, precision=0.01):
+    """Return the motif score threshold for a p-value.
+
+    The p-value is the probability that a random sequence of the length of
+    the motif has a score greater than or equal to the threshold. It is 
+    exact, except for the rounding of the scores to precision (see 
+    logodds_distribution()).
+
+    Parameters
+    ----------
+    motif : Motif instance
+        Motif.
+
+    pvalue : float
+        P-value, between 0.0 and 1.0.
+
+    background : list, optional
+        Frequencies of A, C, G and T in random sequence, 0.25 by default.
+
+    precision : float, optional
+        Precision of the scores.
+
+    Returns
+    -------
+    threshold : float
+        Score threshold, None if even the maximum score has a higher 
+        p-value.
+    """
+    fwd, _ = motif.pwm_logodds()
+    offset, pdf = logodds_distribution(fwd, background, precision)
+    # probability of a score >= every possible score
+    sf = np.cumsum(pdf[::-1])[::-1]
+    above = np.nonzero(sf <= pvalue)[0]
+    if len(above) == 0:
+        return None
+    return (offset + above[0]) * precision
+
+def sequence_composition(seqs):
+    """Return the nucleotide composition of sequences on both strands.
+
+    Parameters
+    ----------
+    seqs : list
+        Sequences.
+
+    Returns
+    -------
+    composition : list
+        Frequencies of A, C, G and T, with the frequency of A equal to T 
+        and C equal to G.
+    """
+    counts = np.zeros(4)
+    for seq in seqs:
+        seq = seq.upper()
+        counts += [seq.count(n) for n in "ACGT"]
+    counts = counts + counts[::-1]
+    return [float(x) for x in counts / counts.sum()]
+
+def genome_composition(genome, step=1000000, length=100000):
+    """Return the nucleotide composition of a genome on both strands.
+
+    The composition is based on blocks of length nucleotides at every step 
+    nucleotides of every chromosome. It is cached per genome.
+
+    Parameters
+    ----------
+    genome : str
+        Genome name or FASTA file.
+
+    Returns
+    -------
+    composition : list
+        Frequencies of A, C, G and T, with the frequency of A equal to T 
+        and C equal to G.
+    """
+    g = Genome(genome)
+    key = "{}|{}|{}|composition".format(g.filename, step, length)
+    with Cache(CACHE_DIR) as cache:
+        composition = cache.get(key)
+        if composition is None:
+            composition = sequence_composition(
+                    g[chrom][start:start + length].seq
+                    for chrom in g.keys() 
+                    for start in range(0, len(g[chrom]), step)
+                    )
+            cache.set(key, composition)
+    return composition
+
+# Directory and default maximum size in bytes of the scan result cache
+SCAN_CACHE_DIR = os.path.join(CACHE_DIR, "scan")
+SCAN_CACHE_SIZE = 2 ** 30
+
+def _scan_digest(motifs, nreport, scan_rc, mode, engine="c"):
+    """Return a digest of the compiled motifs (including the cutoffs), the 
+    scan parameters and the engine, which is part of the key of all cached 
+    results.
+    """
+    h = xxhash.xxh64()
+    for buf in (motifs.fwd, motifs.rev, motifs.lengths, motifs.cutoffs, 
+            motifs.min_scores):
+        h.update(buf)
+    h.update(str((nreport, scan_rc, mode, engine)).encode())
+    return h.digest()
+
+def _cache_dumps(result):
+    """Serialize a scan result to a compressed value for the cache."""
+    return zlib.compress(pickle.dumps(result, pickle.HIGHEST_PROTOCOL), 1)
+
+def _cache_loads(value):
+    """Return a scan result from a compressed value in the cache."""
+    return pickle.loads(zlib.decompress(value))
 
 class Scanner(object):
     """
     scan sequences with motifs
+
+    Parameters
+    ----------
+    ncpus : int, optional
+        Number of processes or threads to use for scanning. By default the 
+        ncpus value from the configuration file is used.
+
+    backend : str, optional
+        Either "processes" (default) or "threads". The scanning kernel 
+        releases the GIL, so with "threads" all threads share the compiled
+        motifs and sequences, without the overhead of starting processes 
+        and pickling the data to send to the workers.
+
+    chunk_size : int, optional
+        Number of sequences that are sent to a worker at once. By default 
+        the chunk size depends on the length of the sequences and the 
+        number and length of the motifs.
+
+    chunks_in_flight : int, optional
+        Maximum number of chunks that are scanned or waiting for their 
+        results to be read at the same time. This bounds the memory that is 
+        used, independent of the number of sequences. The default is 4 
+        chunks per process or thread.
+
+    use_cache : bool, optional
+        Cache the scan results on disk, so that scanning the same sequences
+        or regions with the same motifs and thresholds again is not 
+        necessary. The maximum size of the cache is set with the 
+        scan_cache_size configuration parameter (in bytes, 1GB by default),
+        the least recently used results are removed first. By default the 
+        use_cache configuration parameter is used.
+
+    engine : str or ScanEngine, optional
+        Scanning engine, either the name of an engine in SCAN_ENGINES, 
+        "c" (default) or "moods", or a ScanEngine instance. All engines 
+        give identical results.
+
+    use_hit_index : bool, optional
+        Look up regions in a genome-wide hit index of the motifs, if there
+        is one (see build_hit_index()). By default the use_hit_index 
+        configuration parameter is used, which is True if it is not set.
     """
     
-    def __init__(self, ncpus=None):
+    def __init__(self, ncpus=None, backend="processes", chunk_size=None,
+            chunks_in_flight=None, use_cache=None, engine="c", 
+            use_hit_index=None):
         self.config = MotifConfig()
         self.threshold = None
         self.genome = None
+        self._hit_indexes = {}
 
         if ncpus is None:
             self.ncpus = int(MotifConfig().get_default_params()["ncpus"])
         else:
             self.ncpus = ncpus
         
-        if self.ncpus > 1:
-            try:
-                ctx = mp.get_context('spawn')
-                self.pool = ctx.Pool(processes=self.ncpus)
-            except AttributeError:
-                self.pool = mp.Pool(processes=self.ncpus)
+        if backend not in ["processes", "threads"]:
+            raise ValueError("Unknown backend {}, "
+                    "use either 'processes' or 'threads'".format(backend))
+        self.backend = backend
+        
+        if isinstance(engine, ScanEngine):
+            self.engine = engine
+        elif engine in SCAN_ENGINES:
+            self.engine = SCAN_ENGINES[engine]()
+        else:
+            raise ValueError("Unknown engine {}, use one of {}".format(
+                engine, ", ".join(sorted(SCAN_ENGINES))))
+        
+        self.chunk_size = chunk_size
+        if chunks_in_flight is None:
+            chunks_in_flight = 4 * self.ncpus
+        self.chunks_in_flight = chunks_in_flight
 
+        if self.ncpus > 1:
+            if self.backend == "threads":
+                self.pool = ThreadPool(processes=self.ncpus)
+            else:
+                try:
+                    ctx = mp.get_context('spawn')
+                    self.pool = ctx.Pool(processes=self.ncpus)
+                except AttributeError:
+                    self.pool = mp.Pool(processes=self.ncpus)
+
+        if use_hit_index is None:
+            use_hit_index = self.config.get_default_params().get(
+                    "use_hit_index", True)
+        self.use_hit_index = use_hit_index
+
+        if use_cache is None:
+            use_cache = self.config.get_default_params().get("use_cache", False)
         self.use_cache = False
-        if self.config.get_default_params().get("use_cache", False):
+        if use_cache:
             self._init_cache()
             
     def _init_cache(self):
+        size_limit = int(self.config.get_default_params().get(
+            "scan_cache_size", SCAN_CACHE_SIZE))
         try:
-            self.cache = make_region().configure(
-                'dogpile.cache.pylibmc',
-                expiration_time = 3600,
-                arguments = {
-                    'url':["127.0.0.1"],
-                    'binary': True,
-                    }
-                #    'dogpile.cache.dbm',
-                #    expiration_time = 3600,
-                #    arguments = {
-                #        'filename': 'cache.dbm'
-                #    }
-            )
+            self.cache = Cache(
+                    SCAN_CACHE_DIR, 
+                    size_limit=size_limit,
+                    eviction_policy="least-recently-used",
+                    )
             self.use_cache = True
         except Exception as e:
             sys.stderr.write("failed to initialize cache\n")
@@ -310,29 +1297,155 @@ class Scanner(object):
         self.motifs = motif_file
         with open(motif_file) as f:
             self.motif_ids = [m.id for m in read_motifs(f)]
-        self.checksum = {}
-        if self.use_cache:
-            chksum = xxhash.xxh64("\n".join(sorted(self.motif_ids))).digest()
-            self.checksum[self.motif_file] = chksum
+        self._hit_indexes = {}
 
-    def _threshold_from_seqs(self, motifs, seqs, fpr):
-        scan_motifs = [(m, m.pwm_min_score()) for m in motifs]
+    def _distribution_from_seqs(self, motifs, seqs):
+        compiled = self.engine.compile([(m, m.pwm_min_score()) for m in motifs])
         
         table = []
-        for x in self._scan_sequences_with_motif(scan_motifs, seqs, 1, True):
-            table.append([row[0][0] for row in x])
+        for scores in self._scan_sequences_with_motif(
+                compiled, seqs, 1, True, mode="best_score"):
+            table.append(scores)
+        
+        table = np.array(table).reshape(-1, len(motifs))
+        for motif, scores in zip(motifs, table.transpose()):
+            yield motif, score_distribution(scores)
+
+    def background_distributions(self, genome=None, length=200, filename=None):
+        """Return the distribution of motif scores in background sequences.
+
+        For every motif, the best scores in a set of background sequences
+        are summarized by score_distribution(). The distributions are 
+        cached, so background sequences are only scanned for motifs that 
+        have not been used before with the same background.
+
+        Parameters
+        ----------
+        genome : str, optional
+            Genome to use for random background sequences.
+
+        length : int, optional
+            Length of the random background sequences, 200 by default.
+
+        filename : str, optional
+            FASTA file with background sequences.
+
+        Returns
+        -------
+        distributions : dict
+            Score distribution for every motif id.
+        """
+        if genome and filename:
+            raise ValueError("Need either genome or filename.")
+        
+        if not self.motifs:
+            raise ValueError("please run set_motifs() first")
+
+        with open(self.motifs) as f: 
+            motifs = read_motifs(f)
+        
+        if filename:
+            if not os.path.exists(filename):
+                raise IOError(
+                        "File {} does not exist.".format(filename)
+                        )
+            
+            bg_hash = file_checksum(filename)
+        elif genome:
+            bg_hash = "{}\{}".format(genome, int(length))
+        else:
+            raise ValueError("Need genome or filename")
+
+        distributions = {}
+        with Cache(CACHE_DIR) as cache:
+            scan_motifs = []
+            for motif in motifs:
+                k = "{}|{}|distribution".format(motif.hash(), bg_hash)
+                dist = cache.get(k)
+                if dist is None:
+                    scan_motifs.append(motif)
+                else:
+                    distributions[motif.id] = dist
                 
-        for (motif, _), scores in zip(scan_motifs, np.array(table).transpose()):
-            min_score = motif.pwm_min_score()
-            cutoff = 0
-            if len(scores) > 0:
-                opt_score = scoreatpercentile(scores, 100 - (100 * fpr))
-                cutoff = (opt_score - min_score) / (motif.pwm_max_score() - min_score)
-            yield motif, opt_score#cutoff
+            if len(scan_motifs) > 0:
+                if genome:
+                    Genome(genome)    
+                    sys.stderr.write("Determining background score distribution for length {} based on {}\n".format(int(length), genome))
+                    seqs = RandomGenomicFasta(genome, length, 10000).seqs
+                else: 
+                    sys.stderr.write("Determining background score distribution based on {}\n".format(filename))
+                    seqs = (seq for _, seq in iter_fasta(filename))
+                for motif, dist in self._distribution_from_seqs(scan_motifs, seqs):
+                    k = "{}|{}|distribution".format(motif.hash(), bg_hash)
+                    cache.set(k, dist)
+                    distributions[motif.id] = dist
+        
+        return distributions
+
+    def threshold_table(self, fprs, genome=None, length=200, filename=None):
+        """Return motif score thresholds for multiple FPRs.
+
+        All thresholds are based on one set of background sequences, see
+        background_distributions().
 
+        Parameters
+        ----------
+        fprs : list
+            FPR values, between 0.0 and 1.0.
+
+        genome : str, optional
+            Genome to use for random background sequences.
+
+        length : int, optional
+            Length of the random background sequences, 200 by default.
+
+        filename : str, optional
+            FASTA file with background sequences.
+
+        Returns
+        -------
+        table : pandas.DataFrame
+            DataFrame with the score thresholds, with the motifs as rows 
+            and the FPR values as columns.
+        """
+        for fpr in fprs:
+            if not (0.0 < fpr < 1.0):
+                raise ValueError("Parameter fpr should be between 0 and 1")
+
+        distributions = self.background_distributions(
+                genome=genome, length=length, filename=filename)
+        
+        table = [[distribution_threshold(distributions[motif_id], fpr) 
+                    for fpr in fprs] for motif_id in self.motif_ids]
+        return pd.DataFrame(table, index=self.motif_ids, columns=fprs)
+
+    def _pvalue_thresholds(self, pvalue, genome=None, filename=None):
+        background = None
+        bg_str = "uniform"
+        if genome:
+            background = genome_composition(genome)
+        elif filename:
+            background = sequence_composition(
+                    seq for _, seq in iter_fasta(filename))
+        if background is not None:
+            bg_str = ",".join(["{:.4f}".format(f) for f in background])
+        
+        thresholds = {}
+        with open(self.motifs) as f: 
+            motifs = read_motifs(f)
+        with Cache(CACHE_DIR) as cache:
+            for motif in motifs:
+                k = "{}|{}|{}|pvalue".format(motif.hash(), bg_str, pvalue)
+                if k in cache:
+                    threshold = cache.get(k)
+                else:
+                    threshold = pvalue_threshold(motif, pvalue, background)
+                    cache.set(k, threshold)
+                thresholds[motif.id] = threshold
+        return thresholds
 
     def set_threshold(self, fpr=None, threshold=None, genome=None, 
-                        length=200, filename=None):
+                        length=200, filename=None, pvalue=None):
         """Set motif scanning threshold based on background sequences.
 
         Parameters
@@ -346,7 +1459,31 @@ class Scanner(object):
             Should either be a float between 0.0 and 1.0 or a filename
             with thresholds as created by 'gimme threshold'.
 
+        genome : str, optional
+            Genome to use for random background sequences, with fpr.
+
+        length : int, optional
+            Length of the random background sequences, 200 by default.
+
+        filename : str, optional
+            FASTA file with background sequences, with fpr.
+
+        pvalue : float, optional
+            Desired p-value of a match, between 0.0 and 1.0. The threshold
+            is calculated from the exact score distribution of the motif 
+            (see pvalue_threshold()), without scanning. The nucleotide 
+            composition of the genome or of the sequences in filename is
+            used as background, by default the nucleotides are uniformly 
+            distributed.
         """
+        self._hit_indexes = {}
+        if pvalue is not None:
+            if fpr or threshold:
+                raise ValueError("Need either fpr, threshold or pvalue.")
+            pvalue = float(pvalue)
+            if not (0.0 < pvalue < 1.0):
+                raise ValueError("Parameter pvalue should be between 0 and 1")
+
         if threshold:
             if fpr:
                 raise ValueError("Need either fpr or threshold.")
@@ -370,82 +1507,50 @@ class Scanner(object):
         if not self.motifs:
             raise ValueError("please run set_motifs() first")
 
-        thresholds = {}
-        with open(self.motifs) as f: 
-            motifs = read_motifs(f)
-        
         if threshold is not None:
             self.threshold = parse_threshold_values(self.motifs, threshold) 
             return
         
-        if filename:
-            if not os.path.exists(filename):
-                raise IOError(
-                        "File {} does not exist.".format(filename)
-                        )
-            
-            bg_hash = file_checksum(filename)
-            seqs = Fasta(filename).seqs
-        elif genome:
-            bg_hash = "{}\{}".format(genome, int(length))
-        else:
-            raise ValueError("Need genome or filename")
-
-        with Cache(CACHE_DIR) as cache:
-            scan_motifs = []
-            for motif in motifs:
-                k = "{}|{}|{:.4f}".format(motif.hash(), bg_hash, fpr)
-           
-                threshold = cache.get(k)
-                if threshold is None:
-                    scan_motifs.append(motif)
-                else:
-                    if np.isclose(threshold, motif.pwm_max_score()):
-                        thresholds[motif.id] = None
-                    else:
-                        thresholds[motif.id] = threshold
-                
-            if len(scan_motifs) > 0:
-                if genome:
-                    Genome(genome)    
-                    sys.stderr.write("Determining threshold for fpr {} and length {} based on {}\n".format(fpr, int(length), genome))
-                    fa = RandomGenomicFasta(genome, length, 10000)
-                    seqs = fa.seqs
-                else: 
-                    sys.stderr.write("Determining threshold for fpr {} based on {}\n".format(fpr, filename))
-                for motif, threshold in self._threshold_from_seqs(scan_motifs, seqs, fpr):
-                    k = "{}|{}|{:.4f}".format(motif.hash(), bg_hash, fpr)
-                    cache.set(k, threshold)
-                    if np.isclose(threshold, motif.pwm_max_score()):
-                        thresholds[motif.id] = None
-                    else:
-                        thresholds[motif.id] = threshold
+        if pvalue is not None:
+            self.threshold = self._pvalue_thresholds(pvalue, genome, filename)
+            return
+        
+        distributions = self.background_distributions(
+                genome=genome, length=length, filename=filename)
+        
+        thresholds = {}
+        with open(self.motifs) as f: 
+            motifs = read_motifs(f)
+        for motif in motifs:
+            threshold = distribution_threshold(distributions[motif.id], fpr)
+            if np.isclose(threshold, motif.pwm_max_score()):
+                thresholds[motif.id] = None
+            else:
+                thresholds[motif.id] = threshold
         
-        self.threshold_str = "{}_{}_{}_{}_{}".format(fpr, threshold, genome,
-                                        length, filename)
         self.threshold = thresholds
 
     def set_genome(self, genome):
         """
-        set the genome to be used for:
-            - converting regions to sequences
-            - background for MOODS
+        set the genome to be used for converting regions to sequences, 
+        either a genome name, a FASTA file or a GenomeIndex
         """
         if not genome:
             return
         
         # raises error if checks fail
-        Genome(genome)
+        if not isinstance(genome, GenomeIndex):
+            Genome(genome)
 
         self.genome = genome
+        self._hit_indexes = {}
     
     def count(self, seqs, nreport=100, scan_rc=True):
         """
         count the number of matches above the cutoff
-        returns an iterator of lists containing integer counts
+        returns an iterator of arrays containing integer counts
         """
-        for matches in self.scan(seqs, nreport, scan_rc):
-            counts = [len(m) for m in matches]
+        for counts in self._scan(seqs, nreport, scan_rc, "count"):
             yield counts
      
     def total_count(self, seqs, nreport=100, scan_rc=True):
@@ -460,11 +1565,10 @@ class Scanner(object):
     def best_score(self, seqs, scan_rc=True):
         """
         give the score of the best match of each motif in each sequence
-        returns an iterator of lists containing floats
+        returns an iterator of arrays containing floats
         """
         self.set_threshold(threshold=0.0)
-        for matches in self.scan(seqs, 1, scan_rc):
-            scores = [sorted(m, key=lambda x: x[0])[0][0] for m in matches if len(m) > 0]
+        for scores in self._scan(seqs, 1, scan_rc, "best_score"):
             yield scores
  
     def best_match(self, seqs, scan_rc=True):
@@ -475,14 +1579,197 @@ class Scanner(object):
         """
         self.set_threshold(threshold=0.0)
         for matches in self.scan(seqs, 1, scan_rc):
-            top = [sorted(m, key=lambda x: x[0])[0] for m in matches]
+            top = [m[0] for m in matches]
             yield top
    
-    def scan(self, seqs, nreport=100, scan_rc=True):
+    def scan(self, seqs, nreport=100, scan_rc=True, arrays=False):
         """
         scan a set of regions / sequences
+
+        returns an iterator with the matches of every motif for every 
+        sequence, as a list of [score, pos, strand] lists per motif, or 
+        if arrays is True, as a tuple of a structured matches array and an
+        offsets array (see scan_sequence())
+        """
+        mode = "matches"
+        if arrays:
+            mode = "arrays"
+        
+        for result in self._scan(seqs, nreport, scan_rc, mode):
+            yield result
+
+    def _scan(self, seqs, nreport, scan_rc, mode):
         """
+        scan a set of regions / sequences, with a scan mode as used by 
+        scan_seq_mult()
+        """
+        self._check_threshold()
+
+        ftype = get_seqs_type(seqs)
+        if self.genome and ftype in ["regions", "regionfile", "bedfile"]:
+            # regions are looked up in a hit index of the genome, if there 
+            # is one for these motifs and thresholds (see build_hit_index()).
+            # The hits are on the + strand, so regions on the - strand are
+            # always scanned.
+            hit_index = self._get_hit_index(scan_rc, mode == "best_score")
+            if hit_index is not None:
+                regions = list(iter_regions(seqs, bed_fields=True))
+                if all(region[4] != "-" for region in regions):
+                    for result in self._scan_hit_index(hit_index, 
+                            [region[:3] for region in regions], nreport, 
+                            scan_rc, mode):
+                        yield result
+                    return
+            
+            # otherwise the sequences are read from the genome while 
+            # scanning
+            seqs = (seq for _, seq in region_sequences(seqs, self.genome))
+        elif ftype == "fastafile":
+            # FASTA files are read while scanning
+            seqs = (seq for _, seq in iter_fasta(seqs))
+        else:
+            seqs = as_fasta(seqs, genome=self.genome).seqs
+           
+        it = self._scan_sequences(seqs, 
+                    nreport, scan_rc, mode)
+       
+        for result in it:
+            yield result
+
+    def build_hit_index(self, genome=None, scan_rc=True, tile_size=TILE_SIZE):
+        """Build a genome-wide index of the hits of the motifs.
+
+        The whole genome is scanned with the current motifs and thresholds
+        (see scan_genome()) and the hits are stored in HIT_INDEX_DIR. Once 
+        the index exists, count(), scan() and best_score() look up regions 
+        of this genome in the index instead of scanning their sequences. An 
+        index can be used for all thresholds that are equal to or higher
+        than the thresholds it was built with. The results are identical 
+        to scanning the sequences.
+
+        Parameters
+        ----------
+        genome : str, optional
+            Genome name or FASTA file, by default the genome that is set 
+            with set_genome().
+
+        scan_rc : bool, optional
+            Scan the reverse complement.
+
+        tile_size : int, optional
+            Size of the tiles that are scanned.
+
+        Returns
+        -------
+        fname : str
+            Name of the binary hit file of the index.
+        """
+        if genome is None:
+            genome = self.genome
+        if not genome or isinstance(genome, GenomeIndex):
+            raise ValueError("need a genome to build a hit index")
+        self._check_threshold()
+        
+        g = Genome(genome)
+        with open(self.motifs) as f:
+            motifs = compile_motifs(
+                    [(m, self.threshold[m.id]) for m in read_motifs(f)])
+        fname = os.path.join(HIT_INDEX_DIR, "{}.{}.bin".format(
+            _hit_index_prefix(motifs, g, scan_rc),
+            xxhash.xxh64(motifs.cutoffs).hexdigest()))
+        
+        if not os.path.exists(fname):
+            if not os.path.exists(HIT_INDEX_DIR):
+                os.makedirs(HIT_INDEX_DIR)
+            tmp = NamedTemporaryFile(
+                    dir=HIT_INDEX_DIR, suffix=".tmp", delete=False)
+            tmp.close()
+            self.scan_genome(genome, tmp.name, scan_rc=scan_rc, 
+                    tile_size=tile_size)
+            # the index is only found once the hit file exists
+            os.rename(tmp.name + ".json", fname + ".json")
+            os.rename(tmp.name, fname)
+            self._hit_indexes = {}
+        
+        return fname
+
+    def _get_hit_index(self, scan_rc, any_threshold=False):
+        """Return the HitIndex used to scan regions (see _find_hit_index()),
+        or None. The index is looked up once after the motifs, thresholds 
+        or genome are set.
+        """
+        if (not self.use_hit_index or not self.genome or 
+                isinstance(self.genome, GenomeIndex)):
+            return None
+        
+        key = (bool(scan_rc), any_threshold)
+        if key not in self._hit_indexes:
+            hit_index = self._find_hit_index(scan_rc, any_threshold)
+            if hit_index is not None:
+                logger.debug("using hit index %s", hit_index.fname)
+            self._hit_indexes[key] = hit_index
+        return self._hit_indexes[key]
+
+    def _find_hit_index(self, scan_rc, any_threshold=False):
+        """Return a HitIndex that contains all hits above the current 
+        thresholds, or any HitIndex of the motifs if any_threshold is True.
+        Returns None if there is no such index.
+        """
+        g = Genome(self.genome)
+        with open(self.motifs) as f:
+            motifs = read_motifs(f)
+        prefix = _hit_index_prefix(
+                compile_motifs([(m, None) for m in motifs]), g, scan_rc)
+        thresholds = [self.threshold[m.id] for m in motifs]
+        
+        for fname in sorted(glob(
+                os.path.join(HIT_INDEX_DIR, prefix + ".*.bin"))):
+            hit_index = HitIndex(fname)
+            if any_threshold or hit_index.covers(thresholds):
+                return hit_index
+        return None
+
+    def _scan_hit_index(self, hit_index, regions, nreport, scan_rc, mode):
+        """Return the results of scanning regions from a HitIndex."""
+        with open(self.motifs) as f:
+            motifs = read_motifs(f)
+        cutoffs = np.array([self.threshold[m.id] for m in motifs], 
+                dtype=np.float64)
+        min_scores = np.array([m.pwm_min_score() for m in motifs])
+        
+        if mode != "best_score":
+            for chrom, start, end in regions:
+                hits = hit_index.region_hits(chrom, start, end)
+                yield _region_matches(hits, start, cutoffs, min_scores, 
+                        nreport, mode)
+            return
+        
+        # The best score of a motif with a hit in a region is the best 
+        # score of its hits. Regions in which not all motifs have a hit 
+        # are scanned.
+        results = []
+        missing = []
+        for i, (chrom, start, end) in enumerate(regions):
+            hits = hit_index.region_hits(chrom, start, end)
+            scores = np.full(len(motifs), -np.inf)
+            np.maximum.at(scores, hits["motif"], hits["score"])
+            if np.isinf(scores).any():
+                missing.append(i)
+            else:
+                no_score = scores <= NO_SCORE
+                scores[no_score] = min_scores[no_score]
+            results.append(scores)
+        
+        g = ChunkedGenome(self.genome)
+        seqs = (g.get_sequence(*regions[i]) for i in missing)
+        scanned = self._scan_sequences(seqs, 1, scan_rc, "best_score")
+        for i, scores in zip(missing, scanned):
+            results[i] = scores
+        
+        for scores in results:
+            yield scores
 
+    def _check_threshold(self):
         if not self.threshold:
             sys.stderr.write(
                 "Using default threshold of 0.95. "
@@ -490,140 +1777,258 @@ class Scanner(object):
                 )
             self.set_threshold(threshold=0.95)
 
-        seqs = as_fasta(seqs, genome=self.genome)
-           
-        it = self._scan_sequences(seqs.seqs, 
-                    nreport, scan_rc)
-       
-        for result in it:
-            yield result
+    def scan_genome(self, genome, outfile, scan_rc=True, bed=False, 
+            tile_size=TILE_SIZE):
+        """Scan a whole genome and write all hits above the threshold.
 
+        The chromosomes are split in tiles, which overlap by the length of 
+        the longest motif minus one, and the tiles are scanned in parallel.
+        Every hit is reported once, by the tile in which it starts. The 
+        hits are written sorted by chromosome (in the order of the genome),
+        position, motif and strand while scanning, so the memory that is 
+        used does not depend on the size of the genome.
 
-    def _scan_regions(self, regions, nreport, scan_rc):
-        genome = self.genome
-        motif_file = self.motifs
-        motif_digest = self.checksum.get(motif_file, None)
+        Parameters
+        ----------
+        genome : str
+            Genome name or FASTA file.
 
-        # determine which regions are not in the cache 
-        scan_regions = regions
-        if self.use_cache:
-            scan_regions = []
-            for region in regions:
-                key = str((region, genome, motif_digest, nreport, scan_rc))
-                ret = self.cache.get(key)
-                if ret == NO_VALUE:
-                    scan_regions.append(region)
-        
-        # scan the regions that are not in the cache
-        if len(scan_regions) > 0:
-            
-            g = Genome(genome)
-           
-            with open(self.motifs) as f:
-                motifs = [(m, self.threshold[m.id]) for m in read_motifs(f)]
-            scan_func = partial(scan_region_mult,
-                genome=g,
-                motifs=motifs,
-                nreport=nreport,
-                scan_rc=scan_rc)
-    
-            for region, ret in self._scan_jobs(scan_func, scan_regions):
-                # return values or store values in cache
-                if self.use_cache:
-                    # store values in cache    
-                    key = str((region, genome, motif_digest, nreport, scan_rc, self.threshold_str))
-                    self.cache.set(key, ret)
-                else:
-                    #return values
-                    yield ret
-    
-        if self.use_cache: 
-            # return results from cache
-            for region in regions:
-                key = str((region, genome, motif_digest, nreport, scan_rc, self.threshold_str))
-                ret = self.cache.get(key)
-                if ret == NO_VALUE or ret is None:
-                    raise Exception("cache is not big enough to hold all " 
-                                    "results, try increasing the cache size "
-                                    "or disable cache")
-                yield ret
-    
-    def _scan_sequences_with_motif(self, motifs, seqs, nreport, scan_rc):
+        outfile : str or file
+            Name of the binary output file. The hits are written as a 
+            GENOME_HIT_DTYPE array, with an index in outfile + ".json" 
+            (see read_genome_hits()). With bed, outfile can also be a file
+            object.
+
+        scan_rc : bool, optional
+            Scan the reverse complement.
+
+        bed : bool, optional
+            Write the hits in BED format, with the motif id as name and the
+            score.
+
+        tile_size : int, optional
+            Size of the tiles.
+        """
+        self._check_threshold()
+
+        g = Genome(genome)
+        with open(self.motifs) as f:
+            motifs = read_motifs(f)
+        compiled = self.engine.compile(
+                [(m, self.threshold[m.id]) for m in motifs])
+        lengths = [len(m) for m in motifs]
+        
+        scan_func = partial(scan_tile_mult,
+            genome=g.filename,
+            motifs=compiled,
+            scan_rc=scan_rc,
+            engine=self.engine)
+        tiles = genome_tiles(g, tile_size, max(lengths + [1]) - 1)
+        it = self._scan_jobs(scan_func, tiles, 
+                _tile_length, _motif_length(compiled))
+
+        close = False
+        if isinstance(outfile, six.string_types):
+            outfile = open(outfile, "w" if bed else "wb")
+            close = True
+        
+        try:
+            if bed:
+                self._write_genome_bed(it, outfile, motifs)
+            else:
+                index = self._write_genome_hits(it, outfile, g)
+                index.update({
+                    "genome": g.filename,
+                    "motifs": [m.id for m in motifs],
+                    "motif_lengths": lengths,
+                    "thresholds": [self.threshold[m.id] for m in motifs],
+                    "scan_rc": scan_rc,
+                    })
+                with open(outfile.name + ".json", "w") as f:
+                    json.dump(index, f)
+        finally:
+            if close:
+                outfile.close()
+
+    def _write_genome_bed(self, it, outfile, motifs):
+        strandmap = {-1: "-", 1: "+"}
+        for (chrom, _, _, _), hits in it:
+            for pos, motif, score, strand in zip(hits["pos"].tolist(), 
+                    hits["motif"].tolist(), hits["score"].astype(np.float32), 
+                    hits["strand"].tolist()):
+                # str() gives the shortest representation of the float32
+                outfile.write("{}\t{}\t{}\t{}\t{}\t{}\n".format(
+                    chrom, 
+                    pos, 
+                    pos + len(motifs[motif]), 
+                    motifs[motif].id, 
+                    str(score),
+                    strandmap[strand]))
+
+    def _write_genome_hits(self, it, outfile, genome):
+        """Write the hits of genome tiles and return the index."""
+        chroms = []
+        n = 0
+        for (chrom, start, _, core_end), hits in it:
+            if len(chroms) == 0 or chroms[-1]["name"] != chrom:
+                chroms.append({
+                    "name": chrom, 
+                    "size": len(genome[chrom]), 
+                    "start": n, 
+                    "bins": [],
+                    })
+            bins = np.arange(
+                    -(-start // HIT_BIN_SIZE) * HIT_BIN_SIZE, 
+                    core_end, 
+                    HIT_BIN_SIZE)
+            chroms[-1]["bins"].extend(
+                    (n + np.searchsorted(hits["pos"], bins)).tolist())
+            hits.tofile(outfile)
+            n += len(hits)
+            chroms[-1]["end"] = n
+
+        return {"bin_size": HIT_BIN_SIZE, "end": n, "chroms": chroms}
+
+    def _scan_sequences_with_motif(self, motifs, seqs, nreport, scan_rc, 
+            mode="matches"):
         scan_func = partial(scan_seq_mult,
             motifs=motifs,
             nreport=nreport,
-            scan_rc=scan_rc)
+            scan_rc=scan_rc,
+            mode=mode,
+            engine=self.engine)
 
-        for ret in self._scan_jobs(scan_func, seqs):
-            yield ret[1]
+        for _, ret in self._scan_jobs(scan_func, seqs, 
+                len, _motif_length(motifs)):
+            yield ret
 
-    def _scan_sequences(self, seqs, nreport, scan_rc):
+    def _scan_sequences(self, seqs, nreport, scan_rc, mode="matches"):
         
-        motif_file = self.motifs
-        motif_digest = self.checksum.get(motif_file, None)
+        with open(self.motifs) as f:
+            motifs = self.engine.compile(
+                    [(m, self.threshold[m.id]) for m in read_motifs(f)])
+        scan_func = partial(scan_seq_mult,
+            motifs=motifs,
+            nreport=nreport,
+            scan_rc=scan_rc,
+            mode=mode,
+            engine=self.engine)
+        
+        # encode the sequences once, the encoded sequences are scanned 
+        # with all motifs and used as cache key. Without cache, the 
+        # sequences are encoded while scanning.
+        seqs = (encode_sequence(seq) for seq in seqs)
         
-        scan_seqs = seqs
-        if self.use_cache:
-            # determine which sequences are not in the cache 
-            hashes = dict([(s.upper(), xxhash.xxh64(s.upper()).digest()) for s in seqs])
-            scan_seqs = []
-        
-            for seq,seq_hash in hashes.items():
-                key = str((seq_hash, motif_digest, nreport, scan_rc, self.threshold_str))
-                ret = self.cache.get(key)
-                if ret == NO_VALUE or ret is None:
-                    scan_seqs.append(seq.upper())
-        
-        # scan the sequences that are not in the cache
-        if len(scan_seqs) > 0:
-            with open(self.motifs) as f:
-                motifs = [(m, self.threshold[m.id]) for m in read_motifs(f)]
-            scan_func = partial(scan_seq_mult,
-                motifs=motifs,
-                nreport=nreport,
-                scan_rc=scan_rc)
-    
-            for seq, ret in self._scan_jobs(scan_func, scan_seqs):
-                if self.use_cache:
-                    h = hashes[seq]
-                    key = str((h, motif_digest, nreport, scan_rc, self.threshold_str))
-                    self.cache.set(key, ret)
-                else: 
-                    yield ret
-      
         if self.use_cache:
-            # return results from cache
-            for seq in seqs:
-                key = str((hashes[seq.upper()], motif_digest, nreport, scan_rc, self.threshold_str))
-                ret = self.cache.get(key)
-                if ret == NO_VALUE or ret is None:
-                    raise Exception("cache is not big enough to hold all " 
-                                    "results, try increasing the cache size "
-                                    "or disable cache")
-                    
-                yield ret
-            
-    def _scan_jobs(self, scan_func, scan_seqs):
-        batchsize = 1000
-        if self.ncpus > 1:
-            for i in range((len(scan_seqs) - 1) // batchsize + 1):
-                batch = scan_seqs[i * batchsize:( i+ 1) * batchsize]
-                chunksize = len(batch) // self.ncpus + 1
-                jobs = []
-                for j in range((len(batch) - 1) // chunksize + 1):
-                    job = self.pool.apply_async(
-                            scan_func, 
-                            (batch[j * chunksize:(j + 1) * chunksize],)
-                            )
-                    jobs.append(job)
-                
-                for k,job in enumerate(jobs):
-                    for ret in job.get():
-                        region = batch[k]
-                        yield region, ret
+            digest = _scan_digest(motifs, nreport, scan_rc, mode, 
+                    self.engine.name)
+            key_func = lambda seq: digest + xxhash.xxh64(seq).digest()
+            it = self._scan_cached(scan_func, seqs, key_func, 
+                    len, _motif_length(motifs))
         else:
-            for i in range((len(scan_seqs) - 1) // batchsize + 1):
-                for j,ret in enumerate(scan_func(scan_seqs[i * batchsize:( i+ 1) * batchsize])):
-                    yield scan_seqs[i], ret
+            it = (ret for _, ret in self._scan_jobs(scan_func, seqs, 
+                    len, _motif_length(motifs)))
+        
+        for ret in it:
+            yield ret
 
+    def _scan_cached(self, scan_func, items, key_func, item_len, 
+            motif_len):
+        """Scan encoded sequences, using the cache.
 
+        Results that are in the cache are read from the cache, all other 
+        sequences are scanned and their results are stored in the cache. Results are yielded in the order of items. The items 
+        are read in batches of chunks_in_flight chunks, so at most one 
+        batch is kept in memory and items can be a generator.
+        """
+        batch = []
+        n_chunks = 0
+        for chunk in self._chunks(items, item_len, motif_len):
+            batch.extend(chunk)
+            n_chunks += 1
+            if n_chunks >= self.chunks_in_flight:
+                for ret in self._scan_cached_batch(scan_func, batch, 
+                        key_func, item_len, motif_len):
+                    yield ret
+                batch = []
+                n_chunks = 0
+        
+        for ret in self._scan_cached_batch(scan_func, batch, 
+                key_func, item_len, motif_len):
+            yield ret
+
+    def _scan_cached_batch(self, scan_func, items, key_func, item_len, 
+            motif_len):
+        """Scan a batch of encoded sequences, using the cache."""
+        keys = [key_func(item) for item in items]
+        in_cache = [key in self.cache for key in keys]
+        
+        scanned = self._scan_jobs(
+                scan_func, 
+                [item for item, hit in zip(items, in_cache) if not hit],
+                item_len, 
+                motif_len)
+        
+        for item, key, hit in zip(items, keys, in_cache):
+            if hit:
+                value = self.cache.get(key)
+                if value is not None:
+                    ret = _cache_loads(value)
+                else:
+                    # removed from the cache after it was checked
+                    ret = scan_func([item])[0]
+            else:
+                _, ret = next(scanned)
+                self.cache.set(key, _cache_dumps(ret))
+            yield ret
+
+    def _chunks(self, items, item_len, motif_len):
+        """Split sequences or regions in chunks.
+
+        Unless a fixed chunk size is set, every chunk contains sequences 
+        with roughly CHUNK_WORK sequence positions times motif positions.
+        """
+        chunk = []
+        work = 0
+        for item in items:
+            chunk.append(item)
+            if self.chunk_size:
+                full = len(chunk) >= self.chunk_size
+            else:
+                work += item_len(item) * motif_len
+                full = work >= CHUNK_WORK or len(chunk) >= MAX_CHUNK_SIZE
+            if full:
+                yield chunk
+                chunk = []
+                work = 0
+        if len(chunk) > 0:
+            yield chunk
+
+    def _scan_jobs(self, scan_func, scan_seqs, item_len=len, motif_len=1):
+        """Scan sequences or regions in chunks.
+
+        Yields a tuple of the sequence or region and its result, in the 
+        order of scan_seqs. With more than one process or thread, at most 
+        chunks_in_flight chunks are scanned at the same time. The sequences 
+        are read from scan_seqs while scanning, so it can be a generator.
+        """
+        chunks = self._chunks(scan_seqs, item_len, motif_len)
+        
+        if self.ncpus == 1:
+            for chunk in chunks:
+                for item, ret in zip(chunk, scan_func(chunk)):
+                    yield item, ret
+            return
+        
+        jobs = deque()
+        for chunk in chunks:
+            jobs.append((chunk, self.pool.apply_async(scan_func, (chunk,))))
+            if len(jobs) >= self.chunks_in_flight:
+                chunk, job = jobs.popleft()
+                for item, ret in zip(chunk, job.get()):
+                    yield item, ret
+        
+        while len(jobs) > 0:
+            chunk, job = jobs.popleft()
+            for item, ret in zip(chunk, job.get()):
+                yield item, ret
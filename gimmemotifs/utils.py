@@ -12,12 +12,14 @@ import os
 import re
 import sys
 import hashlib
+import gzip
 import mmap
 import random
 import tempfile
+from collections import OrderedDict
+from itertools import islice
 from math import log
 from subprocess import Popen
-from tempfile import NamedTemporaryFile
 
 # External imports
 from scipy import special
@@ -26,7 +28,8 @@ import pybedtools
 from genomepy import Genome
 
 # gimme imports
-from gimmemotifs.fasta import Fasta
+from gimmemotifs.fasta import Fasta, iter_fasta
+from gimmemotifs.genome_index import GenomeIndex, rc
 from gimmemotifs.plot import plot_histogram
 from gimmemotifs.rocmetrics import ks_pvalue
 
@@ -440,8 +443,7 @@ def _treesort(order, nodeorder, nodecounts, tree):
 
 def number_of_seqs_in_file(fname):
     try:
-        fa = Fasta(fname)
-        return len(fa)
+        return sum(1 for _ in iter_fasta(fname))
     except Exception:
         pass
 
@@ -454,15 +456,20 @@ def number_of_seqs_in_file(fname):
     sys.stderr.write("unknown filetype {}\n".format(fname))
     sys.exit(1)
 
+_invalid_seq_p = re.compile(
+        r'[^abcdefghiklmnpqrstuvwyzxABCDEFGHIKLMNPQRSTUVWXYZ]')
+
 def get_seqs_type(seqs):
     """
     automagically determine input type
     the following types are detected:
-        - Fasta object
+        - Fasta or IndexedFasta object
         - FASTA file
         - list of regions
         - region file
         - BED file
+    
+    only the start of a file is read to determine its type
     """
 
     region_p = re.compile(r'^(.+):(\d+)-(\d+)$')
@@ -478,18 +485,26 @@ def get_seqs_type(seqs):
                 raise ValueError("unknown region type")
     elif isinstance(seqs, str) or isinstance(seqs, unicode):
         if os.path.isfile(seqs):
+            if seqs.endswith(".gz"):
+                f = gzip.open(seqs, "rt")
+            else:
+                f = open(seqs)
+            with f:
+                line = f.readline()
+                if line.startswith(">"):
+                    # valid if the first sequence is, as checked by Fasta()
+                    seq_line = f.readline().strip()
+                    if seq_line == "" or seq_line.startswith(">") or \
+                            not _invalid_seq_p.match(seq_line):
+                        return "fastafile"
+                    raise ValueError("unknown type")
+                f.seek(0)
+                line = ""
+                for line in f:
+                    line = line.strip()
+                    if not line.startswith("#"):
+                        break
             try:
-                Fasta(seqs)
-                return "fastafile"
-            except:
-                pass
-            try:
-                with open(seqs) as f:
-                    for line in f.readlines():
-                        line = line.strip()
-                        if not line.startswith("#"):
-                            break
-                
                 if region_p.search(line):
                     return "regionfile"
                 else:
@@ -505,6 +520,172 @@ def get_seqs_type(seqs):
     else:
         raise ValueError("unknown type {}".format(type(seqs).__name__))
 
+def iter_regions(seqs, bed_fields=False):
+    """Iterate over a list of regions, a region file or a BED file.
+
+    Parameters
+    ----------
+    seqs : list or str
+        List of regions in chrom:start-end format, or the name of a region
+        file or a BED file.
+
+    bed_fields : bool, optional
+        Also return the name (column 4) and strand (column 6) of BED 
+        regions.
+
+    Yields
+    ------
+    region : tuple
+        Region as a (chrom, start, end) tuple, or a (chrom, start, end, 
+        name, strand) tuple with bed_fields. The name and strand are None 
+        if they are not specified.
+    """
+    if isinstance(seqs, list):
+        lines = seqs
+    else:
+        if seqs.endswith(".gz"):
+            lines = gzip.open(seqs, "rt")
+        else:
+            lines = open(seqs)
+    
+    try:
+        for line in lines:
+            line = line.strip()
+            if line == "" or line.startswith(("#", "track", "browser")):
+                continue
+            if "\t" in line:
+                vals = line.split("\t")
+            else:
+                vals = re.split(r'[:\-]', line)
+            region = (vals[0], int(vals[1]), int(vals[2]))
+            if bed_fields:
+                name = vals[3] if len(vals) > 3 and vals[3] != "" else None
+                strand = vals[5] if len(vals) > 5 else None
+                region += (name, strand)
+            yield region
+    finally:
+        if not isinstance(seqs, list):
+            lines.close()
+
+# Size of the chunks in which ChunkedGenome reads a genome
+GENOME_CHUNK_SIZE = 65536
+
+# Number of chunks that ChunkedGenome keeps in memory
+GENOME_CHUNK_CACHE = 256
+
+# Number of regions that region_sequences() reads at a time
+REGION_BATCH_SIZE = 10000
+
+class ChunkedGenome(object):
+    """
+    Sequences of a genome, read in chunks of a fixed size.
+
+    The least recently used chunks are kept in memory, so nearby and 
+    overlapping regions are read from disk only once.
+
+    Parameters
+    ----------
+    genome : str or Genome
+        Genome name, FASTA file or Genome instance.
+
+    chunk_size : int, optional
+        Size of the chunks.
+
+    max_chunks : int, optional
+        Maximum number of chunks in memory.
+    """
+    def __init__(self, genome, chunk_size=GENOME_CHUNK_SIZE, 
+            max_chunks=GENOME_CHUNK_CACHE):
+        if not isinstance(genome, Genome):
+            genome = Genome(genome)
+        self.genome = genome
+        self.chunk_size = chunk_size
+        self.max_chunks = max_chunks
+        self.chrom_order = dict((chrom, i) 
+                for i, chrom in enumerate(genome.keys()))
+        self._chunks = OrderedDict()
+
+    def _chunk(self, chrom, i):
+        key = (chrom, i)
+        chunk = self._chunks.pop(key, None)
+        if chunk is None:
+            start = i * self.chunk_size
+            chunk = self.genome[chrom][start:start + self.chunk_size].seq
+            if len(self._chunks) >= self.max_chunks:
+                self._chunks.popitem(last=False)
+        self._chunks[key] = chunk
+        return chunk
+
+    def get_sequence(self, chrom, start, end):
+        """Return the sequence of a region, 0-based and half-open."""
+        if end <= start:
+            return ""
+        first = start // self.chunk_size
+        last = (end - 1) // self.chunk_size
+        if last - first >= self.max_chunks:
+            return self.genome[chrom][start:end].seq
+        
+        offset = start - first * self.chunk_size
+        if first == last:
+            return self._chunk(chrom, first)[offset:offset + end - start]
+        seq = "".join(self._chunk(chrom, i) for i in range(first, last + 1))
+        return seq[offset:offset + end - start]
+
+def region_sequences(seqs, genome, batch_size=REGION_BATCH_SIZE):
+    """Iterate over the sequences of regions.
+
+    The regions are read in batches. Within a batch the sequences are read 
+    in the order of the genome, through a ChunkedGenome or a GenomeIndex, 
+    and returned in the order of the input. The sequences of BED regions 
+    on the - strand are reverse complemented.
+
+    Parameters
+    ----------
+    seqs : list or str
+        List of regions, region file or BED file.
+
+    genome : str, Genome, ChunkedGenome or GenomeIndex
+        Genome name, FASTA file or genome instance.
+
+    batch_size : int, optional
+        Number of regions per batch.
+
+    Yields
+    ------
+    region_id : str
+        Region in chrom:start-end format, followed by the name of a BED 
+        region, if specified, as with Genome.track2fasta().
+
+    seq : str
+        Sequence of the region.
+    """
+    if not isinstance(genome, (ChunkedGenome, GenomeIndex)):
+        genome = ChunkedGenome(genome)
+    
+    regions = iter_regions(seqs, bed_fields=True)
+    while True:
+        batch = list(islice(regions, batch_size))
+        if len(batch) == 0:
+            break
+        
+        if isinstance(genome, GenomeIndex):
+            batch_seqs = genome.get_region_sequences(
+                    [region[:3] for region in batch])
+        else:
+            order = sorted(range(len(batch)), key=lambda i: (
+                genome.chrom_order.get(batch[i][0], -1), batch[i][1]))
+            batch_seqs = [None] * len(batch)
+            for i in order:
+                batch_seqs[i] = genome.get_sequence(*batch[i][:3])
+        
+        for (chrom, start, end, name, strand), seq in zip(batch, batch_seqs):
+            region_id = "{}:{}-{}".format(chrom, start, end)
+            if name is not None:
+                region_id = "{} {}".format(region_id, name)
+            if strand == "-":
+                seq = rc(seq)
+            yield region_id, seq
+
 def as_fasta(seqs, genome=None):
     ftype = get_seqs_type(seqs)
     if ftype == "fasta":
@@ -515,11 +696,11 @@ def as_fasta(seqs, genome=None):
         if genome is None:
             raise ValueError("need genome to convert to FASTA")
 
-        tmpfa = NamedTemporaryFile()
-        if type(genome) == type(""):
-            genome = Genome(genome)
-        genome.track2fasta(seqs, tmpfa.name) 
-        return Fasta(tmpfa.name)
+        fa = Fasta()
+        for region_id, seq in region_sequences(seqs, genome):
+            fa.ids.append(region_id)
+            fa.seqs.append(seq)
+        return fa
 
 def file_checksum(fname):
     """Return md5 checksum of file.
@@ -50,6 +50,8 @@ DEFAULT_PARAMS = {
     "scan_cutoff": "0.9",
     "ncpus": "2",
     "use_cache": "False",
+    "use_hit_index": "True",
+    "scan_cache_size": "1073741824",
 }
 
 MOTIF_CLASSES = ["MDmodule", "Meme", "MemeW", "Weeder", "Gadem", "MotifSampler", "Trawler", "Improbizer",  "BioProspector", "Posmo", "ChIPMunk", "Jaspar", "Amd", "Hms", "Homer", "XXmotif"]
@@ -0,0 +1,142 @@
+import unittest
+import os
+import random
+import multiprocessing as mp
+from shutil import rmtree
+from tempfile import mkdtemp
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from genomepy import Genome
+
+from gimmemotifs.fasta import Fasta
+from gimmemotifs.background import (MarkovFasta, count_kmers, 
+        matched_gc_bedfile, read_gaps, write_gaps)
+from gimmemotifs.genome_index import find_n_runs
+import gimmemotifs.background
+
+def _markov_seqs(fasta_file):
+    return MarkovFasta(Fasta(fasta_file), n=25000, seed=42, ncpus=2).seqs
+
+class TestBackground(unittest.TestCase):
+    """ A test class for the background module """
+
+    def setUp(self):
+        self.fasta_file = "test/data/fasta/test.fa"
+        self.assertTrue(os.path.exists(self.fasta_file))
+        self.fa = Fasta(self.fasta_file)
+
+    def test1_markov(self):
+        """ Markov background """
+        m = MarkovFasta(self.fa, n=100, k=1, seed=1)
+        self.assertEqual(100, len(m))
+        lengths = set(len(seq) for seq in self.fa.seqs)
+        for seq in m.seqs:
+            self.assertIn(len(seq), lengths)
+            self.assertEqual("", seq.strip("ACGT"))
+
+        # seq1 is AAAA: A is always followed by A or C
+        self.assertAlmostEqual(0.75, m.trans["A"]["A"])
+        self.assertAlmostEqual(0.25, m.trans["A"]["C"])
+        for seq in m.seqs:
+            self.assertNotIn("AG", seq)
+            self.assertNotIn("AT", seq)
+
+        m = MarkovFasta(self.fa, n=50, length=25, k=2, seed=1)
+        self.assertEqual([25] * 50, [len(seq) for seq in m.seqs])
+
+    def test2_markov_seed(self):
+        """ Markov background is reproducible """
+        m1 = MarkovFasta(self.fa, n=25000, seed=42, ncpus=1)
+        m2 = MarkovFasta(self.fa, n=25000, seed=42, ncpus=2)
+        self.assertEqual(m1.seqs, m2.seqs)
+        m3 = MarkovFasta(self.fa, n=25000, seed=43, ncpus=1)
+        self.assertNotEqual(m1.seqs, m3.seqs)
+
+        # in a daemonic worker process, such as a Scanner worker
+        pool = mp.get_context("spawn").Pool(1)
+        try:
+            seqs = pool.apply(_markov_seqs, (self.fasta_file,))
+        finally:
+            pool.close()
+            pool.join()
+        self.assertEqual(m1.seqs, seqs)
+
+    def test3_count_kmers(self):
+        """ Count k-mers, skipping N """
+        counts = count_kmers(["ACGTNac", "gT", ""], 2)
+        self.assertEqual(16, len(counts))
+        expected = {"AC": 2, "CG": 1, "GT": 2}
+        for i, kmer in enumerate(
+                [a + b for a in "ACGT" for b in "ACGT"]):
+            self.assertEqual(expected.get(kmer, 0), counts[i])
+
+        self.assertEqual([2, 0, 0, 0], list(count_kmers(["ANA"], 1)))
+
+    def test4_matched_gc_without_gaps(self):
+        """ GC% matched regions, runs of N from genome without gaps file """
+        tmpdir = mkdtemp()
+        random.seed(1)
+        seq = "".join(random.choice("ACGT") for _ in range(1000))
+        genome = os.path.join(tmpdir, "genome.fa")
+        with open(genome, "w") as f:
+            f.write(">chr1\n{}\n>chr2\n{}\n".format(seq, "N" * 1000))
+        matchfile = os.path.join(tmpdir, "match.fa")
+        with open(matchfile, "w") as f:
+            for i in range(10):
+                f.write(">seq{}\n{}\n".format(i, seq[i * 20:i * 20 + 50]))
+        bedfile = os.path.join(tmpdir, "out.bed")
+        gaps_file = os.path.join(tmpdir, "genome.gaps.bed")
+        
+        try:
+            # genomepy writes the gaps file when the genome is opened
+            with mock.patch("genomepy.genome.generate_gap_bed"):
+                with mock.patch.object(gimmemotifs.background, "write_gaps",
+                        wraps=write_gaps) as write:
+                    matched_gc_bedfile(bedfile, matchfile, genome, 10)
+                    self.assertEqual(1, write.call_count)
+                with open(gaps_file) as f:
+                    self.assertEqual(["chr2\t0\t1000\n"], f.readlines())
+                
+                # the second time the saved runs of N are used
+                with mock.patch.object(gimmemotifs.background, "write_gaps",
+                        wraps=write_gaps) as write:
+                    matched_gc_bedfile(bedfile, matchfile, genome, 10)
+                    self.assertEqual(0, write.call_count)
+            
+            with open(bedfile) as f:
+                regions = [line.rstrip("\n").split("\t") for line in f]
+            self.assertEqual(10, len(regions))
+            for chrom, start, end in regions:
+                self.assertEqual("chr1", chrom)
+                self.assertEqual(50, int(end) - int(start))
+                self.assertNotIn("N", seq[int(start):int(end)])
+        finally:
+            rmtree(tmpdir)
+
+    def test5_write_gaps(self):
+        """ Write runs of N, reading the genome in chunks """
+        tmpdir = mkdtemp()
+        seqs = {"chr1": "NNACGTNNNNNNNNNACNTTTTNNNNNNN", "chr2": "ACGTnnA", 
+                "chr3": "ACGT"}
+        genome = os.path.join(tmpdir, "genome.fa")
+        with open(genome, "w") as f:
+            for name in sorted(seqs):
+                f.write(">{}\n{}\n".format(name, seqs[name]))
+        gaps_file = os.path.join(tmpdir, "test.gaps.bed")
+        try:
+            for chunk_size in [1, 3, 7, 100]:
+                write_gaps(Genome(genome), gaps_file, chunk_size)
+                n_runs = read_gaps(gaps_file)
+                self.assertEqual(["chr1", "chr2"], sorted(n_runs))
+                for chrom in n_runs:
+                    starts, ends = find_n_runs(seqs[chrom])
+                    self.assertEqual(list(starts), list(n_runs[chrom][0]))
+                    self.assertEqual(list(ends), list(n_runs[chrom][1]))
+        finally:
+            rmtree(tmpdir)
+
+if __name__ == '__main__':
+    unittest.main()
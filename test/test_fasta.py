@@ -2,6 +2,10 @@ from gimmemotifs.fasta import *
 import tempfile
 import unittest
 import os
+import shutil
+import gzip
+
+import pysam
 
 class TestFasta(unittest.TestCase):
     """ A test class for Fasta """
@@ -31,6 +35,91 @@ class TestFasta(unittest.TestCase):
             with open(tempname) as f_ref:
                 self.assertEqual(f.read().strip(), f_ref.read().strip())
     
+    def test4_modify(self):
+        """ Add, change and delete sequences """
+        f = Fasta()
+        for i in range(1000):
+            f["seq{}".format(i)] = "A" * i
+        f["seq10"] = "ACGT"
+        self.assertEqual(1000, len(f))
+        self.assertEqual("ACGT", f["seq10"])
+        self.assertEqual(["AAA", None, "ACGT"],
+                f.get_seqs(["seq3", "seq1000", "seq10"]))
+
+        del f["seq10"]
+        self.assertFalse(f.has_key("seq10"))
+        self.assertEqual("A" * 11, f["seq11"])
+        self.assertRaises(ValueError, f.__delitem__, "seq10")
+
+        # lists changed outside of the class
+        f.ids.append("extra")
+        f.seqs.append("CCCC")
+        self.assertTrue("extra" in f)
+        f.ids, f.seqs = ["a", "b"], ["GG", "TT"]
+        self.assertEqual("TT", f["b"])
+        self.assertIsNone(f["seq1"])
+
+    def test5_iter_fasta(self):
+        """ Iterate over the sequences of a FASTA file """
+        self.assertEqual(list(self.f.items()),
+                list(iter_fasta(self.fasta_file)))
+
+    def test6_indexed_fasta(self):
+        """ Read sequences from an indexed FASTA file """
+        tmpdir = tempfile.mkdtemp()
+        fname = os.path.join(tmpdir, "test.fa")
+        seqs = [("seq1", "ACGTACGTAC"), ("seq2", ""), ("seq3", "acgtN" * 10)]
+        with open(fname, "w") as f:
+            for name, seq in seqs:
+                f.write(">{} description\n".format(name))
+                for i in range(0, len(seq), 7):
+                    f.write(seq[i:i + 7] + "\n")
+
+        for _ in range(2):
+            fa = IndexedFasta(fname)
+            self.assertEqual(3, len(fa))
+            self.assertTrue(os.path.exists(fname + ".fai"))
+            self.assertEqual([name for name, _ in seqs], fa.ids)
+            self.assertEqual([seq for _, seq in seqs], list(fa.seqs))
+            self.assertEqual("acgtN" * 10, fa["seq3"])
+            self.assertIsNone(fa["seq4"])
+            self.assertRaises(TypeError, fa.__setitem__, "seq1", "A")
+            fa.close()
+
+        shutil.rmtree(tmpdir)
+
+    def test7_compressed(self):
+        """ Read gzip and bgzip compressed FASTA files """
+        tmpdir = tempfile.mkdtemp()
+        fname = os.path.join(tmpdir, "test.fa")
+        seq = "ACGTNacgt" * 20000
+        with open(fname, "w") as f:
+            f.write(">seq1\n")
+            for i in range(0, len(seq), 60):
+                f.write(seq[i:i + 60] + "\n")
+        with open(fname, "rb") as f_in:
+            with gzip.open(fname + ".gz", "wb") as f_out:
+                f_out.write(f_in.read())
+        self.assertEqual("seq1", Fasta(fname + ".gz").ids[0])
+        self.assertRaises(ValueError,
+                IndexedFasta(fname + ".gz").__getitem__, "seq1")
+
+        pysam.tabix_compress(fname, fname + ".gz", force=True)
+        self.assertEqual(seq, Fasta(fname + ".gz")["seq1"])
+        fa = IndexedFasta(fname + ".gz")
+        self.assertEqual(seq, fa["seq1"])
+        self.assertTrue(os.path.exists(fname + ".gz.gzi"))
+        fa.close()
+
+        with open(fname, "rb") as f:
+            data = f.read()
+        bgzf = BgzfFile(fname + ".gz")
+        for start, end in [(0, 10), (65000, 70000), (100, None)]:
+            self.assertEqual(data[start:end], bgzf[start:end])
+        bgzf.close()
+
+        shutil.rmtree(tmpdir)
+
     def tearDown(self):
             pass
 
@@ -2,9 +2,20 @@ import unittest
 import tempfile
 import os
 import glob
+import random
+import re
+import multiprocessing as mp
 from shutil import rmtree
+
+import pysam
+
 from gimmemotifs.genome_index import *
 
+def _create_index(fasta_dir, index_dir):
+    g = GenomeIndex()
+    g.create_index(fasta_dir, index_dir, ncpus=2)
+    return sorted(g.get_chromosomes())
+
 class TestGenomeIndex(unittest.TestCase):
     """ A test class for GenomeIndex class """
 
@@ -114,6 +125,202 @@ class TestGenomeIndex(unittest.TestCase):
 #        for d in fadir, index_dir:
 #            rmtree(d)
 #    
+    def _write_fasta_dir(self, widths=(60, 50, 61, 100)):
+        fasta_dir = tempfile.mkdtemp()
+        random.seed(42)
+        seqs = {}
+        for i, width in enumerate(widths):
+            name = "chr{}".format(i + 1)
+            seq = "".join(random.choice("ACGTNacgt") 
+                    for _ in range(random.randint(1, 2000)))
+            with open(os.path.join(fasta_dir, name + ".fa"), "w") as f:
+                f.write(">{}\n".format(name))
+                for j in range(0, len(seq), width):
+                    f.write(seq[j:j + width] + "\n")
+            seqs[name] = seq
+        return fasta_dir, seqs
+
+    def test_get_sequence_mmap(self):
+        """ get_sequence should retrieve sequences from the mapped files """
+        fasta_dir, seqs = self._write_fasta_dir()
+        self.g.create_index(fasta_dir, self.index_dir)
+        random.seed(1)
+        for _ in range(1000):
+            chrom = random.choice(sorted(seqs))
+            start = random.randint(0, len(seqs[chrom]))
+            end = random.randint(start, len(seqs[chrom]))
+            self.assertEqual(seqs[chrom][start:end], 
+                    self.g.get_sequence(chrom, start, end))
+        
+        self.assertEqual(rc(seqs["chr1"][5:100]), 
+                self.g.get_sequence("chr1", 5, 100, strand="-"))
+        self.assertEqual(
+                [seqs["chr2"][0:3] + seqs["chr2"][50:120], seqs["chr2"][7:9]],
+                self.g.get_sequences("chr2", [[(0, 3), (50, 120)], [(7, 9)]]))
+        self.assertRaises(ValueError, self.g.get_sequence, "chr1", -1, 3)
+        self.assertRaises(ValueError, self.g.get_sequence, 
+                "chr1", 0, len(seqs["chr1"]) + 1)
+        
+        self.g.close()
+        rmtree(fasta_dir)
+
+    def test_create_index_multi_fasta(self):
+        """ index multi-FASTA files, in parallel and incrementally """
+        fasta_dir, seqs = self._write_fasta_dir()
+        with open(os.path.join(fasta_dir, "multi.fa"), "w") as f:
+            for name, seq in [("seq1", "ACGTACGTAC"), ("seq2", "acgt" * 30)]:
+                f.write(">{}\n".format(name))
+                for j in range(0, len(seq), 7):
+                    f.write(seq[j:j + 7] + "\n")
+                seqs[name] = seq
+        
+        self.g.create_index(fasta_dir, self.index_dir, ncpus=2)
+        self.assertEqual(sorted(seqs), sorted(self.g.get_chromosomes()))
+        for name, seq in seqs.items():
+            self.assertEqual(len(seq), self.g.get_size(name))
+            self.assertEqual(seq, self.g.get_sequence(name, 0, len(seq)))
+            self.assertEqual(seq[2:9], self.g.get_sequence(name, 2, 9))
+        
+        # only changed files are indexed again
+        os.unlink(os.path.join(fasta_dir, "chr1.fa"))
+        with open(os.path.join(fasta_dir, "multi.fa"), "w") as f:
+            f.write(">seq3\nGGGG\nCC\n")
+        index_file = os.path.join(self.index_dir, "chr2.index")
+        mtime = os.path.getmtime(index_file)
+        self.g.create_index(fasta_dir, self.index_dir, ncpus=1)
+        self.assertEqual(sorted(["chr2", "chr3", "chr4", "seq3"]), 
+                sorted(self.g.get_chromosomes()))
+        self.assertEqual("GGGGCC", self.g.get_sequence("seq3", 0, 6))
+        self.assertEqual(mtime, os.path.getmtime(index_file))
+        
+        self.g.close()
+        rmtree(fasta_dir)
+
+    def test_create_index_in_daemon(self):
+        """ index in a daemonic worker process, such as a Scanner worker """
+        fasta_dir, seqs = self._write_fasta_dir()
+        pool = mp.get_context("spawn").Pool(1)
+        try:
+            chroms = pool.apply(_create_index, (fasta_dir, self.index_dir))
+        finally:
+            pool.close()
+            pool.join()
+        self.assertEqual(sorted(seqs), chroms)
+        rmtree(fasta_dir)
+
+    def test_get_region_sequences(self):
+        """ retrieve sequences of regions on all chromosomes at once """
+        fasta_dir, seqs = self._write_fasta_dir()
+        self.g.create_index(fasta_dir, self.index_dir)
+        random.seed(1)
+        regions = []
+        for _ in range(500):
+            chrom = random.choice(sorted(seqs))
+            start = random.randint(0, len(seqs[chrom]))
+            end = random.randint(start, len(seqs[chrom]))
+            regions.append((chrom, start, end, random.choice("+-")))
+        expected = [seqs[chrom][start:end] if strand == "+" else 
+                rc(seqs[chrom][start:end]) 
+                for chrom, start, end, strand in regions]
+        
+        self.assertEqual(expected, self.g.get_region_sequences(regions))
+        self.g.create_twobit()
+        encoded = self.g.get_region_sequences(regions, encoded=True)
+        self.assertEqual([self.g.get_encoded_sequence(*region).tolist() 
+            for region in regions], [seq.tolist() for seq in encoded])
+        self.assertRaises(ValueError, self.g.get_region_sequences, 
+                [("chr1", 0, len(seqs["chr1"]) + 1)])
+        
+        self.g.close()
+        rmtree(fasta_dir)
+
+    def test_compressed_fasta(self):
+        """ index and read bgzip compressed FASTA files """
+        fasta_dir, seqs = self._write_fasta_dir()
+        # larger than one BGZF block
+        seqs["chr5"] = "".join(random.choice("ACGTN") for _ in range(150000))
+        with open(os.path.join(fasta_dir, "chr5.fa"), "w") as f:
+            f.write(">chr5\n")
+            for j in range(0, len(seqs["chr5"]), 60):
+                f.write(seqs["chr5"][j:j + 60] + "\n")
+        for name in ("chr1", "chr5"):
+            fname = os.path.join(fasta_dir, name + ".fa")
+            pysam.tabix_compress(fname, fname + ".gz")
+            os.remove(fname)
+
+        self.g.create_index(fasta_dir, self.index_dir)
+        self.assertEqual(sorted(seqs), sorted(self.g.get_chromosomes()))
+        random.seed(1)
+        for _ in range(500):
+            chrom = random.choice(sorted(seqs))
+            start = random.randint(0, len(seqs[chrom]))
+            end = random.randint(start, min(len(seqs[chrom]), start + 5000))
+            self.assertEqual(seqs[chrom][start:end],
+                    self.g.get_sequence(chrom, start, end))
+        self.assertTrue(os.path.exists(
+            os.path.join(fasta_dir, "chr5.fa.gz.gzi")))
+
+        self.g.close()
+        rmtree(fasta_dir)
+
+    def test_twobit(self):
+        """ retrieve sequences from the 2bit file """
+        fasta_dir, seqs = self._write_fasta_dir()
+        self.g.create_index(fasta_dir, self.index_dir)
+        self.g.create_twobit()
+        twobit_file = os.path.join(self.index_dir, self.g.twobit_file)
+        self.assertTrue(os.path.exists(twobit_file))
+        
+        encode = {"A": 0, "C": 1, "G": 2, "T": 3}
+        g = GenomeIndex(self.index_dir)
+        tb = TwoBitFile(twobit_file)
+        self.assertEqual(sorted(seqs), sorted(tb.names))
+        random.seed(1)
+        for _ in range(1000):
+            chrom = random.choice(sorted(seqs))
+            start = random.randint(0, len(seqs[chrom]))
+            end = random.randint(start, len(seqs[chrom]))
+            seq = seqs[chrom][start:end]
+            self.assertEqual(seq, tb.get_sequence(chrom, start, end))
+            self.assertEqual([encode.get(n.upper(), 4) for n in seq],
+                    list(g.get_encoded_sequence(chrom, start, end)))
+            self.assertEqual([encode.get(n.upper(), 4) for n in rc(seq)],
+                    list(g.get_encoded_sequence(chrom, start, end, "-")))
+        
+        tb.close()
+        g.close()
+        self.g.close()
+        rmtree(fasta_dir)
+
+    def test_random_regions(self):
+        """ sample random regions without too many N """
+        fasta_dir, seqs = self._write_fasta_dir()
+        self.g.create_index(fasta_dir, self.index_dir)
+        for twobit in (False, True):
+            if twobit:
+                self.g.create_twobit()
+            g = GenomeIndex(self.index_dir)
+            for chrom, seq in seqs.items():
+                runs = [(m.start(), m.end()) for m in
+                        re.finditer("N+", seq.upper())]
+                starts, ends = g.get_n_runs(chrom)
+                self.assertEqual(runs, list(zip(starts, ends)))
+                starts, ends = find_n_runs(seq)
+                self.assertEqual(runs, list(zip(starts, ends)))
+
+            regions = get_random_sequences(self.index_dir, n=500,
+                    length=20, chroms=["chr1", "chr2"], max_n=0.1)
+            self.assertEqual(500, len(regions))
+            for chrom, start, end in regions:
+                self.assertIn(chrom, ["chr1", "chr2"])
+                self.assertEqual(20, end - start)
+                self.assertLessEqual(end, len(seqs[chrom]))
+                self.assertLessEqual(seqs[chrom][start:end].count("N"), 2)
+            g.close()
+
+        self.g.close()
+        rmtree(fasta_dir)
+
     def tearDown(self):
         for file in os.listdir(self.index_dir):
             os.remove(os.path.join(self.index_dir, file))
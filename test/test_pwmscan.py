@@ -4,6 +4,7 @@ import os
 from gimmemotifs.motif import *
 from gimmemotifs.fasta import Fasta
 from gimmemotifs.utils import gff_enrichment 
+from gimmemotifs.c_metrics import pwmscan, pwmscan_logodds
 from time import sleep
 
 class TestMotifPwm(unittest.TestCase):
@@ -53,6 +54,18 @@ class TestMotifPwm(unittest.TestCase):
             self.assertLess(float(vals[2]), 1e-60)
             self.assertGreater(float(vals[5]), 1.5)
 
+    def test4_pwmscan_logodds(self):
+        """ Scan with precomputed log-odds matrix """
+        fwd, rev = self.motif.pwm_logodds()
+        cutoff = self.motif.pwm_min_score() 
+        for seq in self.prom.seqs[:10]:
+            for nreport in [1, 10]:
+                for scan_rc in [False, True]:
+                    self.assertEqual(
+                        pwmscan(seq, self.motif.pwm, cutoff, nreport, scan_rc),
+                        pwmscan_logodds(seq, fwd, rev, cutoff, nreport, scan_rc)
+                        )
+
     def tearDown(self):
         pass
 
@@ -1,6 +1,9 @@
 import unittest
 import tempfile
 import os
+import shutil
+from functools import partial
+import numpy as np
 from gimmemotifs.scanner import *
 from gimmemotifs.fasta import Fasta
 from gimmemotifs.genome_index import GenomeIndex
@@ -65,6 +68,408 @@ class TestScanner(unittest.TestCase):
         for score,match in zip(scores, result["AP1"]):
             self.assertAlmostEqual(score, match, 5)
 
+    def test4_scan_sequence_compiled(self):
+        """ Scan sequence with compiled motifs """
+        with open(self.motifs) as f:
+            motifs = read_motifs(f)
+        f = Fasta(self.fa)
+        
+        scan_motifs = [(m, m.pwm_min_score()) for m in motifs] 
+        compiled = compile_motifs(scan_motifs + [(motifs[0], None)])
+        for seq in f.seqs:
+            result = scan_sequence(seq, compiled, 1, True)
+            self.assertEqual(len(motifs) + 1, len(result))
+            self.assertEqual(
+                    scan_sequence(seq, scan_motifs, 1, True), 
+                    result[:-1])
+            self.assertEqual([], result[-1])
+
+    def test5_scan_threads(self):
+        """ Scanner with thread backend """
+        f = Fasta(self.fa)
+        
+        s = Scanner(ncpus=1)
+        s.set_motifs(self.motifs)
+        s.set_threshold(threshold=0.99)
+        result = list(s._scan_sequences(f.seqs, 10, True))
+        
+        for ncpus in [1, 2]:
+            s = Scanner(ncpus=ncpus, backend="threads")
+            s.set_motifs(self.motifs)
+            s.set_threshold(threshold=0.99)
+            self.assertEqual(
+                    result, 
+                    list(s._scan_sequences(f.seqs, 10, True))
+                    )
+
+        with self.assertRaises(ValueError):
+            Scanner(backend="unknown")
+
+    def test6_scan_arrays(self):
+        """ Scanner returning arrays """
+        s = Scanner(ncpus=1)
+        s.set_motifs(self.motifs)
+        s.set_threshold(threshold=0.99)
+        
+        result = list(s.scan(self.fa, 10, True))
+        for i, (matches, offsets) in enumerate(s.scan(self.fa, 10, True, arrays=True)):
+            self.assertEqual(MATCH_DTYPE, matches.dtype)
+            self.assertEqual(len(result[i]) + 1, len(offsets))
+            for j, m in enumerate(result[i]):
+                self.assertEqual(len(m), offsets[j + 1] - offsets[j]) 
+                for row, match in zip(m, matches[offsets[j]:offsets[j + 1]]):
+                    self.assertAlmostEqual(row[0], match["score"], 5)
+                    self.assertEqual(row[1], match["pos"])
+                    self.assertEqual(row[2], match["strand"])
+        
+        self.assertEqual([[0], [2], [4]], [list(c) for c in s.count(self.fa, 10)])
+
+    def test7_count_best_score(self):
+        """ Count and best score scanning """
+        with open(self.motifs) as f:
+            motifs = read_motifs(f)
+        f = Fasta(self.fa)
+        for cutoff in [0.0, 5.0, 100.0]:
+            compiled = compile_motifs([(m, cutoff) for m in motifs])
+            for seq in f.seqs:
+                for nreport in [1, 10]:
+                    result = scan_sequence(seq, compiled, nreport, True)
+                    counts = count_sequence(seq, compiled, nreport, True)
+                    self.assertEqual([len(m) for m in result], list(counts))
+
+                result = scan_sequence(seq, compiled, 1, True)
+                scores = best_score_sequence(seq, compiled, True)
+                for m, score in zip(result, scores):
+                    if len(m) > 0:
+                        self.assertAlmostEqual(m[0][0], score)
+
+        s = Scanner(ncpus=1)
+        s.set_motifs(self.motifs)
+        for scores, matches in zip(s.best_score(self.fa), s.best_match(self.fa)):
+            self.assertEqual([m[0] for m in matches], list(scores))
+
+    def test8_lookahead(self):
+        """ Scanning with lookahead gives identical results """
+        with open(self.motifs) as f:
+            motifs = read_motifs(f)
+        f = Fasta(self.fa)
+        seqs = f.seqs + ["".join(np.random.RandomState(1).choice(
+            list("ACGTN"), 5000, p=[0.24, 0.24, 0.24, 0.24, 0.04]))]
+        for frac in [0.0, 0.5, 0.9, 0.99]:
+            compiled = compile_motifs([(m, m.pwm_min_score() +
+                frac * (m.pwm_max_score() - m.pwm_min_score())) for m in motifs])
+            # the bound is used for the n best matches at any cutoff
+            self.assertTrue(np.isfinite(
+                np.frombuffer(compiled.fwd_bound)).all())
+            lookahead = np.ones(len(motifs), dtype=np.intc).tobytes()
+            no_bound = np.full(len(compiled.fwd_bound) // 8, np.inf).tobytes()
+            full = compiled._replace(fwd_bound=no_bound, rev_bound=no_bound)
+            for bounded in [compiled, compiled._replace(lookahead=lookahead)]:
+                for seq in seqs:
+                    for nreport in [0, 1, 10]:
+                        self.assertEqual(
+                            scan_sequence(seq, full, nreport, True),
+                            scan_sequence(seq, bounded, nreport, True))
+                        self.assertEqual(
+                            list(count_sequence(seq, full, nreport, True)),
+                            list(count_sequence(seq, bounded, nreport, True)))
+                    self.assertEqual(
+                        list(best_score_sequence(seq, full, True)),
+                        list(best_score_sequence(seq, bounded, True)))
+
+    def test9_encode_sequence(self):
+        """ Scan encoded sequences """
+        self.assertEqual(
+                bytes([0, 1, 2, 3, 4, 0, 1, 2, 3, 4, 4]),
+                encode_sequence("ACGTNacgtnR")
+                )
+
+        with open(self.motifs) as f:
+            motifs = read_motifs(f)
+        compiled = compile_motifs([(m, 0.0) for m in motifs])
+        f = Fasta(self.fa)
+        for seq in f.seqs:
+            result = scan_sequence(seq, compiled, 10, True)
+            self.assertEqual(result,
+                    scan_sequence(seq.lower(), compiled, 10, True))
+            encoded = encode_sequence(seq)
+            self.assertEqual(result,
+                    scan_sequence(encoded, compiled, 10, True))
+            self.assertEqual(result,
+                    scan_sequence(np.frombuffer(encoded, dtype=np.uint8),
+                        compiled, 10, True))
+
+    def test10_scan_jobs(self):
+        """ Scanner streams results in order """
+        items = list(range(250))
+        for ncpus in [1, 2]:
+            for chunk_size in [None, 1, 7]:
+                s = Scanner(ncpus=ncpus, backend="threads",
+                        chunk_size=chunk_size, chunks_in_flight=2)
+                result = list(s._scan_jobs(
+                    partial(map, lambda x: x * 2), iter(items), 
+                    lambda x: 1e6))
+                self.assertEqual([(x, x * 2) for x in items], result)
+
+        s = Scanner(ncpus=2, backend="threads", chunk_size=1)
+        s.set_motifs(self.motifs)
+        s.set_threshold(threshold=0.99)
+        self.assertEqual([[0], [2], [4]],
+                [list(c) for c in s.count(self.fa, 10)])
+
+    def test11_scan_cache(self):
+        """ Scanner with cache """
+        import gimmemotifs.scanner
+        cache_dir = gimmemotifs.scanner.SCAN_CACHE_DIR
+        gimmemotifs.scanner.SCAN_CACHE_DIR = os.path.join(self.tmpdir, "scan")
+        try:
+            s = Scanner(ncpus=1, use_cache=False)
+            s.set_motifs(self.motifs)
+            s.set_threshold(threshold=0.99)
+            result = list(s.scan(self.fa, 10, True))
+            counts = [list(c) for c in s.count(self.fa, 10)]
+
+            for ncpus in [1, 2]:
+                s = Scanner(ncpus=ncpus, backend="threads", use_cache=True)
+                s.set_motifs(self.motifs)
+                s.set_threshold(threshold=0.99)
+                for _ in range(2):
+                    self.assertEqual(result, list(s.scan(self.fa, 10, True)))
+                    self.assertEqual(counts,
+                            [list(c) for c in s.count(self.fa, 10)])
+                # scan and count results of all sequences 
+                self.assertEqual(6, len(s.cache))
+                
+                # different threshold
+                s.set_threshold(threshold=0.0)
+                self.assertNotEqual(result, list(s.scan(self.fa, 10, True)))
+                self.assertEqual(9, len(s.cache))
+                s.cache.clear()
+        finally:
+            gimmemotifs.scanner.SCAN_CACHE_DIR = cache_dir
+
+    def test11_scan_cache_streams(self):
+        """ Scanner with cache streams results in order """
+        import gimmemotifs.scanner
+        cache_dir = gimmemotifs.scanner.SCAN_CACHE_DIR
+        gimmemotifs.scanner.SCAN_CACHE_DIR = os.path.join(self.tmpdir, "scan")
+
+        read = []
+        def items():
+            for x in range(250):
+                read.append(x)
+                yield x
+
+        scan_func = lambda chunk: [x * 2 for x in chunk]
+        key_func = lambda x: str(x).encode()
+        try:
+            for ncpus in [1, 2]:
+                s = Scanner(ncpus=ncpus, backend="threads", use_cache=True,
+                        chunk_size=7, chunks_in_flight=2)
+                for _ in range(2):
+                    del read[:]
+                    it = s._scan_cached(scan_func, items(), key_func, len, 1)
+                    self.assertEqual(0, next(it))
+                    self.assertLess(len(read), 250)
+                    self.assertEqual([x * 2 for x in range(1, 250)],
+                            list(it))
+                self.assertEqual(250, len(s.cache))
+                s.cache.clear()
+        finally:
+            gimmemotifs.scanner.SCAN_CACHE_DIR = cache_dir
+
+    def test12_threshold_table(self):
+        """ Thresholds for multiple FPRs from one background """
+        scores = np.random.RandomState(1).normal(size=1000)
+        distribution = score_distribution(scores)
+        for fpr in [0.001, 0.01, 0.05]:
+            self.assertAlmostEqual(
+                    np.percentile(scores, 100 - 100 * fpr),
+                    distribution_threshold(distribution, fpr))
+        
+        s = Scanner(ncpus=1)
+        s.set_motifs("test/data/pwms/motifs.pwm")
+        fname = "test/data/scan/scan_test_regions.fa"
+        fprs = [0.01, 0.02, 0.05]
+        table = s.threshold_table(fprs, filename=fname)
+        self.assertEqual(s.motif_ids, list(table.index))
+        self.assertEqual(fprs, list(table.columns))
+        for fpr in fprs:
+            s.set_threshold(fpr=fpr, filename=fname)
+            for motif_id, threshold in s.threshold.items():
+                if threshold is not None:
+                    self.assertEqual(threshold, table.loc[motif_id, fpr])
+
+    def test13_pvalue_threshold(self):
+        """ Thresholds from exact score distributions """
+        from itertools import product
+        with open(self.motifs) as f:
+            motif = read_motifs(f)[0]
+        logodds = np.frombuffer(motif.pwm_logodds()[0], dtype=np.float64)
+        logodds = logodds.reshape(-1, 4)[:6]
+        background = [0.3, 0.2, 0.2, 0.3]
+
+        offset, pdf = logodds_distribution(logodds.tobytes(), background)
+        self.assertAlmostEqual(1.0, pdf.sum())
+        expected = np.zeros(len(pdf))
+        rounded = np.round(logodds / 0.01).astype(int)
+        for kmer in product(range(4), repeat=len(logodds)):
+            score = sum(rounded[i, n] for i, n in enumerate(kmer))
+            expected[score - offset] += np.prod([background[n] for n in kmer])
+        np.testing.assert_allclose(expected, pdf, atol=1e-12)
+
+        s = Scanner(ncpus=1)
+        s.set_motifs(self.motifs)
+        s.set_threshold(pvalue=0.001)
+        self.assertEqual(
+                pvalue_threshold(motif, 0.001), s.threshold[motif.id])
+        self.assertLess(s.threshold[motif.id], motif.pwm_max_score())
+        self.assertIsNone(pvalue_threshold(motif, 1e-30))
+
+        with self.assertRaises(ValueError):
+            s.set_threshold(fpr=0.01, pvalue=0.001)
+
+    def test14_engines(self):
+        """ All scanning engines give identical results """
+        with open(self.motifs) as f:
+            motifs = read_motifs(f)
+        seqs = Fasta(self.fa).seqs + ["ACGTNNTGACTCAGCANTGASTCA", "AC", ""]
+        seqs = [encode_sequence(seq) for seq in seqs]
+        c_engine = CScanEngine()
+        for name in SCAN_ENGINES:
+            if name == "moods" and MOODS is None:
+                continue
+            engine = SCAN_ENGINES[name]()
+            for cutoff in [None, 0.0, 5.0]:
+                compiled = engine.compile([(m, cutoff) for m in motifs])
+                for nreport in [0, 1, 10]:
+                    for scan_rc in [True, False]:
+                        self.assertEqual(
+                            c_engine.scan(seqs, compiled, nreport, scan_rc),
+                            engine.scan(seqs, compiled, nreport, scan_rc))
+                        self.assertEqual(
+                            [list(c) for c in c_engine.count(
+                                seqs, compiled, nreport, scan_rc)],
+                            [list(c) for c in engine.count(
+                                seqs, compiled, nreport, scan_rc)])
+                self.assertEqual(
+                        [list(s) for s in c_engine.best_score(
+                            seqs, compiled, True)],
+                        [list(s) for s in engine.best_score(
+                            seqs, compiled, True)])
+
+            s = Scanner(ncpus=1, engine=name)
+            s.set_motifs(self.motifs)
+            s.set_threshold(threshold=0.99)
+            self.assertEqual([[0], [2], [4]],
+                    [list(c) for c in s.count(self.fa, 10)])
+
+        with self.assertRaises(ValueError):
+            Scanner(engine="unknown")
+
+    def test15_scan_genome(self):
+        """ Scan a whole genome in tiles """
+        genome = os.path.join(self.data_dir, "genome.fa")
+        seq = Fasta(genome)["chr1"]
+        with open(self.motifs) as f:
+            motifs = read_motifs(f)
+
+        outfile = os.path.join(self.tmpdir, "hits.bin")
+        for ncpus in [1, 2]:
+            s = Scanner(ncpus=ncpus, backend="threads")
+            s.set_motifs(self.motifs)
+            s.set_threshold(threshold=0.0)
+
+            expected = scan_sequence(seq,
+                    [(m, s.threshold[m.id]) for m in motifs], 0, True)
+            expected = sorted([(match[1], i, -match[2])
+                for i, matches in enumerate(expected) for match in matches])
+
+            for tile_size in [10, 50, TILE_SIZE]:
+                s.scan_genome(genome, outfile, tile_size=tile_size)
+                index, hits = read_genome_hits(outfile)
+                self.assertEqual(["AP1"], index["motifs"])
+                self.assertEqual(len(hits), index["chroms"][0]["end"])
+                self.assertEqual(expected,
+                        [(h["pos"], h["motif"], -h["strand"]) for h in hits])
+
+                s.scan_genome(genome, outfile + ".bed", bed=True,
+                        tile_size=tile_size)
+                with open(outfile + ".bed") as f:
+                    lines = [line.split("\t") for line in f]
+                self.assertEqual(len(hits), len(lines))
+                self.assertEqual(["chr1", "0", "7", "AP1"], lines[0][:4])
+
+    def test16_hit_index(self):
+        """ Scan regions using a genome-wide hit index """
+        import gimmemotifs.scanner
+        index_dir = gimmemotifs.scanner.HIT_INDEX_DIR
+        gimmemotifs.scanner.HIT_INDEX_DIR = os.path.join(self.tmpdir, "hits")
+        try:
+            genome = os.path.join(self.data_dir, "genome.fa")
+            regions = ["chr1:{}-{}".format(start, start + 30) 
+                    for start in range(0, 174, 8)]
+            s = Scanner(ncpus=1)
+            s.set_motifs(self.motifs)
+            s.set_genome(genome)
+            for threshold in [0.0, 0.9]:
+                s.set_threshold(threshold=threshold)
+                self.assertIsNone(s._find_hit_index(True))
+                expected = [
+                        [list(x) for x in s.count(regions, nreport=3)],
+                        list(s.scan(regions, nreport=5)),
+                        list(s.scan(regions, nreport=0)),
+                        ]
+                # best_score() sets the threshold to 0.0
+                best = [list(x) for x in s.best_score(regions)]
+                
+                s.set_threshold(threshold=threshold)
+                s.build_hit_index()
+                self.assertIsNotNone(s._find_hit_index(True))
+                self.assertIsNone(s._find_hit_index(False))
+                self.assertEqual(expected, [
+                        [list(x) for x in s.count(regions, nreport=3)],
+                        list(s.scan(regions, nreport=5)),
+                        list(s.scan(regions, nreport=0)),
+                        ])
+                self.assertEqual(best, 
+                        [list(x) for x in s.best_score(regions)])
+                
+                # the index is looked up once and the file is logged
+                s.set_threshold(threshold=threshold)
+                with self.assertLogs("gimme.scanner", "DEBUG") as log:
+                    hit_index = s._get_hit_index(True)
+                self.assertIn(hit_index.fname, log.output[0])
+                self.assertIs(hit_index, s._get_hit_index(True))
+                
+                # unless the lookup is disabled
+                s_no_index = Scanner(ncpus=1, use_hit_index=False)
+                s_no_index.set_motifs(self.motifs)
+                s_no_index.set_genome(genome)
+                s_no_index.set_threshold(threshold=threshold)
+                self.assertIsNone(s_no_index._get_hit_index(True))
+                self.assertEqual(expected[0], 
+                        [list(x) for x in s_no_index.count(regions, nreport=3)])
+
+                # regions on the - strand are scanned, not looked up 
+                bedfile = os.path.join(self.tmpdir, "regions.bed")
+                with open(bedfile, "w") as f:
+                    for region in regions:
+                        f.write("{}\t{}\t{}\tpeak\t0\t-\n".format(
+                            *region.replace(":", "-").split("-")))
+                self.assertEqual(list(s_no_index.scan(bedfile, nreport=5)),
+                        list(s.scan(bedfile, nreport=5)))
+                self.assertNotEqual(expected[1], 
+                        list(s.scan(bedfile, nreport=5)))
+                
+                # an index with lower thresholds is used as well
+                s.set_threshold(threshold=0.95)
+                self.assertIsNotNone(s._find_hit_index(True))
+                self.assertIsNot(hit_index, s._get_hit_index(True))
+                shutil.rmtree(gimmemotifs.scanner.HIT_INDEX_DIR)
+        finally:
+            gimmemotifs.scanner.HIT_INDEX_DIR = index_dir
+
     def testThreshold(self):
         s = Scanner()
         s.set_motifs("test/data/pwms/motifs.pwm")
@@ -50,6 +50,61 @@ class TestUtils(unittest.TestCase):
         
         rmtree(tmpdir)
     
+    def test3_region_sequences(self):
+        """ read sequences of regions in chunks """
+        genome = "test/data/scanner/genome.fa"
+        g = Genome(genome)
+        seq = g["chr1"][:].seq
+        regions = ["chr1:{}-{}".format(start, start + size) 
+                for start in [150, 0, 33, 7, 190, 64] 
+                for size in [1, 10, 64]]
+        
+        for chunk_size, max_chunks in [(10, 2), (10, 100), (1000, 1)]:
+            cg = ChunkedGenome(genome, chunk_size, max_chunks)
+            result = list(region_sequences(regions, cg, batch_size=4))
+            self.assertEqual(regions, [region_id for region_id, _ in result])
+            for region, (_, region_seq) in zip(regions, result):
+                start, end = [int(x) for x in region.split(":")[1].split("-")]
+                self.assertEqual(seq[start:end], region_seq)
+            self.assertLessEqual(len(cg._chunks), max_chunks)
+
+        bedfile = "test/data/scanner/test.bed"
+        fa = as_fasta(bedfile, genome)
+        self.assertEqual(["chr1:24-72", "chr1:96-132", "chr1:156-204"], fa.ids)
+        self.assertEqual([seq[24:72], seq[96:132], seq[156:204]], fa.seqs)
+
+        # BED6: names are kept, regions on the - strand are reverse 
+        # complemented
+        tmpdir = mkdtemp()
+        bedfile = os.path.join(tmpdir, "test.bed")
+        with open(bedfile, "w") as f:
+            f.write("chr1\t24\t72\tpeak1\t0\t+\n")
+            f.write("chr1\t96\t132\tpeak2\t0\t-\n")
+            f.write("chr1\t156\t204\t\t0\t.\n")
+        fa = as_fasta(bedfile, genome)
+        self.assertEqual(
+                ["chr1:24-72 peak1", "chr1:96-132 peak2", "chr1:156-204"], 
+                fa.ids)
+        self.assertEqual([seq[24:72], rc(seq[96:132]), seq[156:204]], 
+                fa.seqs)
+        self.assertEqual(
+                [("chr1", 96, 132, "peak2", "-")], 
+                list(iter_regions(bedfile, bed_fields=True))[1:2])
+        self.assertEqual(
+                [("chr1", 24, 72), ("chr1", 96, 132), ("chr1", 156, 204)],
+                list(iter_regions(bedfile)))
+        rmtree(tmpdir)
+
+    def test4_get_seqs_type(self):
+        """ detect input type """
+        self.assertEqual("fastafile", get_seqs_type("test/data/scanner/test.fa"))
+        self.assertEqual("bedfile", get_seqs_type("test/data/scanner/test.bed"))
+        self.assertEqual("regionfile", 
+                get_seqs_type("test/data/scanner/test.txt"))
+        self.assertEqual("regions", get_seqs_type(["chr1:1-10"]))
+        with self.assertRaises(ValueError):
+            get_seqs_type("test/data/scanner/motif.pwm")
+
     def test_checkum(self):
         fname = "test/data/fasta/test.fa"
         md5 = "a34798835d4110c34df45bbd8ed2f910"